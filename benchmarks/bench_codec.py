@@ -0,0 +1,75 @@
+"""
+Compare wire codecs on typical publish payloads.
+
+Measures encode and decode throughput and the number of bytes each
+codec puts on the wire for a ``('send', (endpoint, data))`` packet.
+
+Run with::
+
+    python benchmarks/bench_codec.py
+"""
+
+import random
+import sys
+import timeit
+
+from robocluster.codec import available, get_codec
+
+
+def payloads():
+    rnd = random.Random(0)
+    return {
+        'float': rnd.random(),
+        'imu': {
+            'accel': [rnd.random() for _ in range(3)],
+            'gyro': [rnd.random() for _ in range(3)],
+            'time': 1510000000.123,
+        },
+        'gps': {'lat': 52.1332, 'lon': -106.67, 'fix': True, 'sats': 9},
+        'lidar': [rnd.uniform(0, 30) for _ in range(360)],
+        'thumbnail': bytes(rnd.getrandbits(8) for _ in range(8 * 1024)),
+    }
+
+
+def measure(codec, data, number):
+    packet = ('send', ('rover/telemetry', data))
+    try:
+        encoded = codec.encode(packet)
+    except (TypeError, ValueError):
+        return None
+    encode = timeit.timeit(lambda: codec.encode(packet), number=number)
+    decode = timeit.timeit(lambda: codec.decode(encoded), number=number)
+    return {
+        'bytes': len(encoded),
+        'encode_per_sec': number / encode,
+        'decode_per_sec': number / decode,
+    }
+
+
+def run(number=2000):
+    """Run the benchmark, returns a list of result dictionaries."""
+    results = []
+    for payload, data in payloads().items():
+        for name in available():
+            result = measure(get_codec(name), data, number)
+            if result is None:
+                continue
+            result.update(codec=name, payload=payload)
+            results.append(result)
+    return results
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    row = '{:<10} {:<8} {:>8} {:>14} {:>14}'
+    print(row.format('payload', 'codec', 'bytes', 'encode/s', 'decode/s'))
+    for result in run(number):
+        print(row.format(
+            result['payload'], result['codec'], result['bytes'],
+            '{:.0f}'.format(result['encode_per_sec']),
+            '{:.0f}'.format(result['decode_per_sec']),
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Measure how publish throughput scales with the loops of a ContextPool.
+
+Every loop of the pool runs a publisher and a subscriber in the same
+context, so messages are delivered without the network and the loop is
+the bottleneck. We run 1, 2 and 4 loops, once in threads and once in
+worker processes, and measure the messages per second delivered by all
+pairs together. Threads share the GIL and are not expected to scale,
+processes scale with the number of cores.
+
+Run with::
+
+    python benchmarks/bench_context_pool.py [count]
+"""
+
+import multiprocessing
+import sys
+import time
+from uuid import uuid4
+
+from robocluster.device import ContextPool, Device
+
+
+LOOPS = (1, 2, 4)
+MODES = ('threads', 'processes')
+
+
+def pair(context, count, payload, results):
+    """Start a publisher and a subscriber in context, report to results."""
+    group = str(uuid4())
+    publisher = Device('publisher', group, context=context, local=True,
+                       queue_policy='block')
+    subscriber = Device('subscriber', group, context=context, local=True)
+    received = 0
+    done = context.loop.create_future()
+
+    @subscriber.on('publisher/data')
+    async def on_data(event, data):  # pylint: disable=W0612
+        nonlocal received
+        received += 1
+        if received == count and not done.done():
+            done.set_result(None)
+
+    @publisher.task
+    async def publish():  # pylint: disable=W0612
+        start = time.time()
+        for _ in range(count):
+            await publisher.publish('data', payload)
+        await done
+        results.put((start, time.time(), received))
+        publisher.stop()
+        subscriber.stop()
+
+    subscriber.start()
+    publisher.start()
+
+
+def measure(mode, loops, count, payload):
+    manager = multiprocessing.Manager()
+    results = manager.Queue()
+    with ContextPool(loops, processes=mode == 'processes') as pool:
+        for _ in range(loops):
+            pool.spawn(pair, count, payload, results)
+        reports = [results.get(timeout=60) for _ in range(loops)]
+    manager.shutdown()
+    start = min(report[0] for report in reports)
+    end = max(report[1] for report in reports)
+    delivered = sum(report[2] for report in reports)
+    return {'publish_per_sec': delivered / (end - start)}
+
+
+def run(count=20000):
+    """Run the benchmark, returns a list of result dictionaries."""
+    payload = {'x': 1.5, 'y': -2.25, 'z': 0.125}
+    results = []
+    for mode in MODES:
+        for loops in LOOPS:
+            result = measure(mode, loops, count, payload)
+            result.update(mode=mode, loops=loops)
+            results.append(result)
+    return results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print('{} cpus'.format(multiprocessing.cpu_count()))
+    row = '{:<9} {:>5} {:>12} {:>8}'
+    print(row.format('mode', 'loops', 'publish/s', 'speedup'))
+    base = {}
+    for result in run(count):
+        base.setdefault(result['mode'], result['publish_per_sec'])
+        print(row.format(
+            result['mode'], result['loops'],
+            '{:.0f}'.format(result['publish_per_sec']),
+            '{:.2f}x'.format(
+                result['publish_per_sec'] / base[result['mode']]),
+        ))
+
+
+if __name__ == '__main__':
+    main()
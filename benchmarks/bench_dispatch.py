@@ -0,0 +1,100 @@
+"""
+Measure what finding the callbacks for a message costs.
+
+A member subscribes to a growing number of endpoints, either all literal
+or all globs, and we time delivering a message that matches one of them
+and one that matches none. Lookups are cached, so every case is timed
+once with a warm cache and once with a cache too small to help, like a
+member that receives more distinct endpoints than it can remember.
+How long it took to subscribe to all the endpoints is reported too.
+
+Run with::
+
+    python benchmarks/bench_dispatch.py [number]
+"""
+
+import asyncio
+import sys
+import time
+from uuid import uuid4
+
+from robocluster.device import group_to_port
+from robocluster.dispatch import EndpointIndex
+from robocluster.member import Member
+
+
+HANDLERS = (1, 10, 100, 1000)
+KINDS = ('literal', 'glob')
+CACHES = ('warm', 'cold')
+
+
+def patterns(kind, handlers):
+    if kind == 'literal':
+        return ['rover-{}/telemetry'.format(i) for i in range(handlers)]
+    return ['rover-{}/*'.format(i) for i in range(handlers)]
+
+
+def measure(loop, kind, handlers, cache, number):
+    port = group_to_port(str(uuid4()))
+    member = Member('bench', '127.0.0.1/32', port, loop=loop, local=None)
+    if cache == 'cold':
+        member._send_endpoints = EndpointIndex(cache_size=1)
+
+    def callback(endpoint, data):
+        pass
+
+    start = time.perf_counter()
+    for pattern in patterns(kind, handlers):
+        member._subscriptions.add(pattern)
+        member.on_recv(pattern, callback)
+    subscribe = time.perf_counter() - start
+
+    hit = 'rover-{}/telemetry'.format(handlers - 1)
+    miss = 'base/telemetry'
+    endpoints = (hit, miss, hit, miss)
+
+    async def deliver():
+        handle = member._handle_send
+        start = time.perf_counter()
+        for i in range(number):
+            await handle('rover', endpoints[i % 4], None)
+        return time.perf_counter() - start
+
+    elapsed = loop.run_until_complete(deliver())
+    return {
+        'ns_per_message': elapsed / number * 1e9,
+        'subscribe_us_per_handler': subscribe / handlers * 1e6,
+    }
+
+
+def run(number=20000, handlers=HANDLERS):
+    """Run the benchmark, returns a list of result dictionaries."""
+    results = []
+    loop = asyncio.new_event_loop()
+    try:
+        for kind in KINDS:
+            for count in handlers:
+                for cache in CACHES:
+                    result = measure(loop, kind, count, cache, number)
+                    result.update(kind=kind, handlers=count, cache=cache)
+                    results.append(result)
+    finally:
+        loop.close()
+    return results
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    row = '{:<8} {:>8} {:<5} {:>10} {:>14}'
+    print(row.format('kind', 'handlers', 'cache', 'ns/msg',
+                     'subscribe us'))
+    for result in run(number):
+        print(row.format(
+            result['kind'], result['handlers'], result['cache'],
+            '{:.0f}'.format(result['ns_per_message']),
+            '{:.0f}'.format(result['subscribe_us_per_handler']),
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Compare publishing over peer connections and over multicast.
+
+One member publishes to 1, 10 and 50 subscribers in the same process, once
+over the TCP connection to every subscriber and once as best effort
+multicast. We measure how many messages per second the publisher gets out,
+the bytes it hands to the kernel and how many messages were delivered.
+
+Run with::
+
+    python benchmarks/bench_fanout.py [count]
+"""
+
+import asyncio
+import sys
+import time
+from uuid import uuid4
+
+from robocluster.device import group_to_port
+from robocluster.member import Member
+
+
+SUBSCRIBERS = (1, 10, 50)
+MODES = ('tcp', 'multicast')
+
+
+async def wait_for_subscribers(publisher, endpoint, subscribers, timeout=30):
+    deadline = time.monotonic() + timeout
+    while ...:
+        ready = [
+            peer for peer in publisher._peers.values()
+            if peer.is_subscribed(endpoint) and peer.multicast
+        ]
+        if len(ready) == subscribers:
+            return
+        if time.monotonic() > deadline:
+            raise TimeoutError('subscribers not discovered')
+        await asyncio.sleep(0.05)
+
+
+async def measure(loop, mode, subscribers, count, payload):
+    port = group_to_port(str(uuid4()))
+    # every message has to get to every subscriber over TCP
+    publisher = Member('publisher', '0.0.0.0/0', port, loop=loop,
+                       multicast=True, queue_policy='block')
+    members = [publisher]
+    received = 0
+    expected = count * subscribers
+
+    def on_data(endpoint, data):
+        nonlocal received
+        received += 1
+
+    for i in range(subscribers):
+        member = Member('sub-{}'.format(i), '0.0.0.0/0', port, loop=loop,
+                        multicast=True)
+        member.subscribe('publisher', 'data', on_data)
+        members.append(member)
+    for member in members:
+        member.start()
+
+    try:
+        await wait_for_subscribers(publisher, 'publisher/data', subscribers)
+        # let the connections to the subscribers come up
+        await publisher.publish('data', payload)
+        await asyncio.sleep(0.5)
+        received = 0
+
+        best_effort = mode == 'multicast'
+        start = time.perf_counter()
+        for _ in range(count):
+            await publisher.publish('data', payload, best_effort=best_effort)
+            await asyncio.sleep(0)
+        elapsed = time.perf_counter() - start
+
+        deadline = time.monotonic() + 10
+        while received < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+    finally:
+        for member in members:
+            member.stop()
+        # let the connections close
+        await asyncio.sleep(0.1)
+
+    if best_effort:
+        size = len(publisher._multicaster.encode('publisher/data', payload))
+        sent_bytes = size * count
+    else:
+        peer = next(iter(publisher._peers.values()))
+        frame = peer.codec.encode(('send', ('publisher/data', payload)))
+        sent_bytes = (len(frame) + 4) * count * subscribers
+
+    return {
+        'publish_per_sec': count / elapsed,
+        'bytes_per_message': sent_bytes / count,
+        'delivered': received / expected,
+    }
+
+
+def run(count=1000):
+    """Run the benchmark, returns a list of result dictionaries."""
+    payload = {'x': 1.5, 'y': -2.25, 'z': 0.125}
+    results = []
+    for subscribers in SUBSCRIBERS:
+        for mode in MODES:
+            loop = asyncio.new_event_loop()
+            try:
+                result = loop.run_until_complete(
+                    measure(loop, mode, subscribers, count, payload))
+            finally:
+                loop.close()
+            result.update(subscribers=subscribers, mode=mode)
+            results.append(result)
+    return results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    row = '{:>11} {:<9} {:>12} {:>12} {:>10}'
+    print(row.format('subscribers', 'mode', 'publish/s', 'bytes/msg',
+                     'delivered'))
+    for result in run(count):
+        print(row.format(
+            result['subscribers'], result['mode'],
+            '{:.0f}'.format(result['publish_per_sec']),
+            '{:.0f}'.format(result['bytes_per_message']),
+            '{:.1%}'.format(result['delivered']),
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Measure what discovery costs as the group grows.
+
+Members that only gossip, with nothing to say to each other, run in one
+process on the same group. Once they have found each other and their
+heartbeats have backed off, we measure the CPU time the process uses and
+the discovery packets and bytes every member receives per second.
+
+Run with::
+
+    python benchmarks/bench_gossip.py [seconds]
+"""
+
+import asyncio
+import sys
+import time
+from uuid import uuid4
+
+from robocluster.device import group_to_port
+from robocluster.member import Member
+
+
+NODES = (2, 8, 32)
+
+
+async def measure(loop, nodes, seconds, settle):
+    port = group_to_port(str(uuid4()))
+    members = [
+        Member('node-{}'.format(i), '0.0.0.0/0', port, loop=loop, local=None)
+        for i in range(nodes)
+    ]
+    for member in members:
+        member.start()
+    try:
+        await asyncio.sleep(settle)
+        known = min(len(member._peers) for member in members)
+        received = sum(
+            member.metrics.counter('gossip.received_bytes').value
+            for member in members)
+        packets = sum(
+            member.metrics.counter('gossip.received').value
+            for member in members)
+        cpu, wall = time.process_time(), time.perf_counter()
+        await asyncio.sleep(seconds)
+        cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+        received = sum(
+            member.metrics.counter('gossip.received_bytes').value
+            for member in members) - received
+        packets = sum(
+            member.metrics.counter('gossip.received').value
+            for member in members) - packets
+    finally:
+        for member in members:
+            member.stop()
+        await asyncio.sleep(0.1)
+
+    return {
+        'discovered': known / (nodes - 1),
+        'cpu_percent': cpu / wall * 100,
+        'cpu_percent_per_node': cpu / wall * 100 / nodes,
+        'packets_per_node_per_sec': packets / nodes / wall,
+        'bytes_per_node_per_sec': received / nodes / wall,
+    }
+
+
+def run(seconds=5, settle=3):
+    """Run the benchmark, returns a list of result dictionaries."""
+    results = []
+    for nodes in NODES:
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(
+                measure(loop, nodes, seconds, settle))
+        finally:
+            loop.close()
+        result.update(nodes=nodes)
+        results.append(result)
+    return results
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    row = '{:>5} {:>10} {:>8} {:>10} {:>12} {:>12}'
+    print(row.format('nodes', 'discovered', 'cpu %', 'cpu %/node',
+                     'pkts/node/s', 'bytes/node/s'))
+    for result in run(seconds):
+        print(row.format(
+            result['nodes'],
+            '{:.0%}'.format(result['discovered']),
+            '{:.1f}'.format(result['cpu_percent']),
+            '{:.2f}'.format(result['cpu_percent_per_node']),
+            '{:.0f}'.format(result['packets_per_node_per_sec']),
+            '{:.0f}'.format(result['bytes_per_node_per_sec']),
+        ))
+
+
+if __name__ == '__main__':
+    main()
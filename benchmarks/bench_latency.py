@@ -0,0 +1,119 @@
+"""
+Measure send latency and request round trips over loopback.
+
+Two members in one process, once talking over a TCP connection and once
+handing messages over in the same process. Every message carries the
+time it was sent, the receiver records how long it took to get there.
+Messages are sent one at a time with a pause in between so we measure
+latency, not queueing.
+
+Run with::
+
+    python benchmarks/bench_latency.py [count]
+"""
+
+import asyncio
+import sys
+import time
+from uuid import uuid4
+
+from robocluster.device import group_to_port
+from robocluster.member import Member, UnknownPeer
+
+
+PATHS = ('tcp', 'local')
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def percentiles(values, prefix):
+    values = sorted(values)
+    result = {}
+    for percent in PERCENTILES:
+        index = min(int(len(values) * percent / 100), len(values) - 1)
+        name = '{}_p{}_us'.format(prefix, str(percent).replace('.', ''))
+        result[name] = values[index] * 1e6
+    result[prefix + '_max_us'] = values[-1] * 1e6
+    return result
+
+
+async def connect(member, peer, timeout=5):
+    """Wait until member can reach peer."""
+    deadline = time.monotonic() + timeout
+    while ...:
+        try:
+            return await member.request(peer, 'echo', None)
+        except UnknownPeer:
+            if time.monotonic() > deadline:
+                raise
+
+
+async def measure(loop, path, count, interval):
+    port = group_to_port(str(uuid4()))
+    local = {} if path == 'local' else None
+    a = Member('bench-a', '0.0.0.0/0', port, loop=loop, local=local)
+    b = Member('bench-b', '0.0.0.0/0', port, loop=loop, local=local)
+
+    latencies = []
+
+    def on_data(source, sent):
+        latencies.append(time.perf_counter() - sent)
+
+    b.on_request('echo', lambda data: data)
+    b.on_recv('data', on_data)
+    a.start()
+    b.start()
+    try:
+        await connect(a, 'bench-b')
+
+        for _ in range(count):
+            await a.send('bench-b', 'data', time.perf_counter())
+            await asyncio.sleep(interval)
+
+        round_trips = []
+        for _ in range(count):
+            start = time.perf_counter()
+            await a.request('bench-b', 'echo', None)
+            round_trips.append(time.perf_counter() - start)
+    finally:
+        a.stop()
+        b.stop()
+        # let the connections close
+        await asyncio.sleep(0.1)
+
+    result = {'delivered': len(latencies) / count}
+    result.update(percentiles(latencies, 'send'))
+    result.update(percentiles(round_trips, 'rtt'))
+    return result
+
+
+def run(count=2000, interval=0.0005):
+    """Run the benchmark, returns a list of result dictionaries."""
+    results = []
+    for path in PATHS:
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(
+                measure(loop, path, count, interval))
+        finally:
+            loop.close()
+        result.update(path=path)
+        results.append(result)
+    return results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    row = '{:<6} {:<5} {:>8} {:>8} {:>8} {:>8} {:>8}'
+    print(row.format('path', '', 'p50 us', 'p90 us', 'p99 us', 'p999 us',
+                     'max us'))
+    for result in run(count):
+        for prefix in ('send', 'rtt'):
+            print(row.format(
+                result['path'], prefix,
+                *('{:.0f}'.format(result['{}_{}_us'.format(prefix, name)])
+                  for name in ('p50', 'p90', 'p99', 'p999', 'max'))
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Measure throughput and round trips as messages get bigger.
+
+Two members in one process talk over loopback with msgpack, which sends
+bytes as they are. For every payload size we measure how many sends per
+second get through and the round trip of a request that echoes the
+payload, over TCP and over shared memory.
+
+Run with::
+
+    python benchmarks/bench_payload.py [count]
+"""
+
+import asyncio
+import statistics
+import sys
+import time
+from uuid import uuid4
+
+from robocluster.device import group_to_port
+from robocluster.member import Member, UnknownPeer
+
+
+SIZES = (16, 256, 4 * 1024, 64 * 1024, 1024 * 1024)
+PATHS = ('tcp', 'shm')
+
+
+async def connect(member, peer, timeout=5):
+    """Wait until member can reach peer."""
+    deadline = time.monotonic() + timeout
+    while ...:
+        try:
+            return await member.request(peer, 'echo', None)
+        except UnknownPeer:
+            if time.monotonic() > deadline:
+                raise
+
+
+async def measure(loop, path, size, count):
+    port = group_to_port(str(uuid4()))
+    options = dict(loop=loop, codec='msgpack', local=None,
+                   shared_memory=path == 'shm')
+    a = Member('bench-a', '0.0.0.0/0', port, **options)
+    b = Member('bench-b', '0.0.0.0/0', port, **options)
+    payload = bytes(size)
+
+    received = 0
+    done = asyncio.Event(loop=loop)
+
+    def on_data(source, data):
+        nonlocal received
+        received += 1
+        if received == count:
+            done.set()
+
+    b.on_request('echo', lambda data: data)
+    b.on_recv('data', on_data)
+    a.start()
+    b.start()
+    try:
+        await connect(a, 'bench-b')
+
+        start = time.perf_counter()
+        for _ in range(count):
+            await a.send('bench-b', 'data', payload)
+        await asyncio.wait_for(done.wait(), 60, loop=loop)
+        elapsed = time.perf_counter() - start
+
+        round_trips = []
+        for _ in range(max(count // 10, 10)):
+            start = time.perf_counter()
+            await a.request('bench-b', 'echo', payload)
+            round_trips.append(time.perf_counter() - start)
+    finally:
+        a.stop()
+        b.stop()
+        await asyncio.sleep(0.1)
+
+    return {
+        'send_per_sec': count / elapsed,
+        'mb_per_sec': count * size / elapsed / 1e6,
+        'rtt_p50_us': statistics.median(round_trips) * 1e6,
+    }
+
+
+def run(count=2000):
+    """Run the benchmark, returns a list of result dictionaries."""
+    results = []
+    for path in PATHS:
+        for size in SIZES:
+            # keep the bytes moved, and the time, in check for big payloads
+            number = max(min(count, count * 4096 // size), 20)
+            loop = asyncio.new_event_loop()
+            try:
+                result = loop.run_until_complete(
+                    measure(loop, path, size, number))
+            finally:
+                loop.close()
+            result.update(path=path, size=size)
+            results.append(result)
+    return results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    row = '{:<5} {:>8} {:>10} {:>10} {:>12}'
+    print(row.format('path', 'bytes', 'send/s', 'MB/s', 'rtt p50 us'))
+    for result in run(count):
+        print(row.format(
+            result['path'], result['size'],
+            '{:.0f}'.format(result['send_per_sec']),
+            '{:.1f}'.format(result['mb_per_sec']),
+            '{:.0f}'.format(result['rtt_p50_us']),
+        ))
+
+
+if __name__ == '__main__':
+    main()
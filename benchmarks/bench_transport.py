@@ -0,0 +1,132 @@
+"""
+Compare the socket and protocol transports over loopback.
+
+Two members in one process exchange messages and we measure request
+round trip latency and one way send throughput for every transport,
+on the default event loop and on uvloop if it is installed.
+
+Run with::
+
+    python benchmarks/bench_transport.py
+"""
+
+import asyncio
+import statistics
+import sys
+import time
+from uuid import uuid4
+
+from robocluster.device import group_to_port
+from robocluster.member import Member, UnknownPeer
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+TRANSPORTS = ('socket', 'protocol')
+
+
+def loop_factories():
+    factories = {'asyncio': asyncio.new_event_loop}
+    if uvloop is not None:
+        factories['uvloop'] = uvloop.new_event_loop
+    return factories
+
+
+async def connect(member, peer, timeout=5):
+    """Wait until member can reach peer."""
+    deadline = time.monotonic() + timeout
+    while ...:
+        try:
+            return await member.request(peer, 'echo', None)
+        except UnknownPeer:
+            if time.monotonic() > deadline:
+                raise
+
+
+async def measure(loop, transport, count, payload):
+    port = group_to_port(str(uuid4()))
+    a = Member('bench-a', '0.0.0.0/0', port, loop=loop, transport=transport)
+    b = Member('bench-b', '0.0.0.0/0', port, loop=loop, transport=transport)
+
+    received = 0
+    done = asyncio.Event(loop=loop)
+
+    def echo(data):
+        return data
+
+    def on_data(source, data):
+        nonlocal received
+        received += 1
+        if received == count:
+            done.set()
+
+    b.on_request('echo', echo)
+    b.on_recv('data', on_data)
+    a.start()
+    b.start()
+    try:
+        await connect(a, 'bench-b')
+
+        latencies = []
+        for _ in range(count):
+            start = time.perf_counter()
+            await a.request('bench-b', 'echo', payload)
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(count):
+            await a.send('bench-b', 'data', payload)
+        await asyncio.wait_for(done.wait(), 30, loop=loop)
+        elapsed = time.perf_counter() - start
+    finally:
+        a.stop()
+        b.stop()
+        # let the connections close
+        await asyncio.sleep(0.1)
+
+    latencies.sort()
+    return {
+        'rtt_mean_us': statistics.mean(latencies) * 1e6,
+        'rtt_p50_us': latencies[len(latencies) // 2] * 1e6,
+        'rtt_p99_us': latencies[int(len(latencies) * 0.99)] * 1e6,
+        'send_per_sec': count / elapsed,
+    }
+
+
+def run(count=2000):
+    """Run the benchmark, returns a list of result dictionaries."""
+    payload = {'x': 1.5, 'y': -2.25, 'z': 0.125}
+    results = []
+    for loop_name, factory in loop_factories().items():
+        for transport in TRANSPORTS:
+            loop = factory()
+            try:
+                result = loop.run_until_complete(
+                    measure(loop, transport, count, payload))
+            finally:
+                loop.close()
+            result.update(loop=loop_name, transport=transport)
+            results.append(result)
+    return results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    row = '{:<8} {:<9} {:>12} {:>12} {:>12} {:>12}'
+    print(row.format('loop', 'transport', 'rtt mean us', 'rtt p50 us',
+                     'rtt p99 us', 'send/s'))
+    for result in run(count):
+        print(row.format(
+            result['loop'], result['transport'],
+            '{:.0f}'.format(result['rtt_mean_us']),
+            '{:.0f}'.format(result['rtt_p50_us']),
+            '{:.0f}'.format(result['rtt_p99_us']),
+            '{:.0f}'.format(result['send_per_sec']),
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""
+Run the benchmarks and save their results as JSON.
+
+Every bench_*.py module in this directory has a run() function that
+returns a list of result dictionaries. Text values in a result say what
+was measured (codec, transport, size, ...), numbers are the measurements.
+This runs the selected benchmarks, or all of them, and writes::
+
+    {
+        "meta": {"time": ..., "python": ..., "platform": ..., "commit": ...},
+        "benchmarks": {"<name>": {"seconds": ..., "results": [...]}}
+    }
+
+Comparing with an earlier file prints how much every measurement changed.
+
+Run with::
+
+    python benchmarks/run.py [-o results.json] [--quick] [--compare old.json] [name ...]
+"""
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# arguments to run() that keep every benchmark to a few seconds
+QUICK = {
+    'codec': {'number': 200},
+    'context_pool': {'count': 2000},
+    'dispatch': {'number': 2000, 'handlers': (1, 10, 100)},
+    'fanout': {'count': 100},
+    'gossip': {'seconds': 1, 'settle': 2},
+    'latency': {'count': 200},
+    'payload': {'count': 100},
+    'transport': {'count': 200},
+}
+
+
+# numbers in results that say what was measured, not measurements
+CASE_FIELDS = ('handlers', 'loops', 'nodes', 'size', 'subscribers')
+
+
+def available():
+    """Names of the benchmarks in this directory."""
+    return sorted(
+        name[len('bench_'):-len('.py')] for name in os.listdir(HERE)
+        if name.startswith('bench_') and name.endswith('.py')
+    )
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names, quick=False):
+    """Run the benchmarks called names, returns the results document."""
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)
+    document = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'commit': commit(),
+            'quick': quick,
+        },
+        'benchmarks': {},
+    }
+    for name in names:
+        module = importlib.import_module('bench_' + name)
+        kwargs = QUICK.get(name, {}) if quick else {}
+        print('running', name, file=sys.stderr)
+        start = time.perf_counter()
+        results = module.run(**kwargs)
+        document['benchmarks'][name] = {
+            'seconds': time.perf_counter() - start,
+            'results': results,
+        }
+    return document
+
+
+def _key(result):
+    return tuple(sorted(
+        (name, value) for name, value in result.items()
+        if not isinstance(value, (int, float)) or isinstance(value, bool)
+        or name in CASE_FIELDS
+    ))
+
+
+def compare(old, new):
+    """
+    Relative change of every measurement in new from old.
+
+    Returns:
+        list: (benchmark, case, measurement, old, new) tuples for the
+            measurements found in both.
+    """
+    changes = []
+    for name, bench in sorted(new['benchmarks'].items()):
+        try:
+            before = {
+                _key(result): result
+                for result in old['benchmarks'][name]['results']
+            }
+        except KeyError:
+            continue
+        for result in bench['results']:
+            key = _key(result)
+            previous = before.get(key)
+            if previous is None:
+                continue
+            case = ' '.join('{}={}'.format(*item) for item in key)
+            for measurement, value in sorted(result.items()):
+                if (measurement in dict(key)
+                        or not isinstance(value, (int, float))
+                        or not isinstance(previous.get(measurement), (int, float))):
+                    continue
+                changes.append(
+                    (name, case, measurement, previous[measurement], value))
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='benchmarks to run: ' + ', '.join(available()))
+    parser.add_argument('-o', '--output', help='write the results here')
+    parser.add_argument('--quick', action='store_true',
+                        help='smaller runs, for a quick check')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    names = args.names or available()
+    unknown = set(names) - set(available())
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(sorted(unknown)))
+
+    document = run(names, quick=args.quick)
+    text = json.dumps(document, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    elif not args.compare:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        row = '{:<12} {:<40} {:<24} {:>12} {:>12} {:>8}'
+        print(row.format('benchmark', 'case', 'measurement', 'old', 'new',
+                         'change'))
+        for name, case, measurement, before, after in compare(old, document):
+            change = (after - before) / before if before else float('nan')
+            print(row.format(
+                name, case, measurement, '{:.4g}'.format(before),
+                '{:.4g}'.format(after), '{:+.1%}'.format(change)))
+
+
+if __name__ == '__main__':
+    main()
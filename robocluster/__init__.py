@@ -1,2 +1,2 @@
-from .device import Device
+from .device import ContextPool, Device
 from .member import Member
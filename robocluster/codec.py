@@ -0,0 +1,271 @@
+"""
+Wire codecs for robocluster.
+
+A codec turns the packets exchanged between peers into bytes and back.
+Peers agree on a codec while connecting, see :class:`~robocluster.member.Member`.
+
+Two codecs are always available:
+
+- ``json``: human readable and supported everywhere, but numbers are sent
+  as text and bytes can not be encoded.
+- ``msgpack``: a compact binary encoding. If the msgpack package is installed
+  it is used, otherwise a built-in pure python encoder is used that produces
+  the same wire format.
+"""
+
+import json
+import struct
+from collections import OrderedDict
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+__all__ = [
+    'JsonCodec',
+    'MsgpackCodec',
+    'available',
+    'get_codec',
+    'register',
+]
+
+
+class JsonCodec:
+    """Encode packets as UTF-8 JSON."""
+
+    name = 'json'
+
+    @staticmethod
+    def encode(obj):
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+    @staticmethod
+    def decode(data):
+        return json.loads(str(data, 'utf-8'))
+
+
+_pack_double = struct.Struct('>Bd').pack
+_unpack_float = struct.Struct('>f').unpack_from
+_unpack_double = struct.Struct('>d').unpack_from
+
+# (tag, struct) pairs used to encode integers, smallest first
+_UINTS = (
+    (0xcc, struct.Struct('>BB'), 1 << 8),
+    (0xcd, struct.Struct('>BH'), 1 << 16),
+    (0xce, struct.Struct('>BI'), 1 << 32),
+    (0xcf, struct.Struct('>BQ'), 1 << 64),
+)
+_INTS = (
+    (0xd0, struct.Struct('>Bb'), 1 << 7),
+    (0xd1, struct.Struct('>Bh'), 1 << 15),
+    (0xd2, struct.Struct('>Bi'), 1 << 31),
+    (0xd3, struct.Struct('>Bq'), 1 << 63),
+)
+
+# tag: struct of the fixed size integer that follows
+_FIXED = {
+    0xcc: struct.Struct('>B'), 0xcd: struct.Struct('>H'),
+    0xce: struct.Struct('>I'), 0xcf: struct.Struct('>Q'),
+    0xd0: struct.Struct('>b'), 0xd1: struct.Struct('>h'),
+    0xd2: struct.Struct('>i'), 0xd3: struct.Struct('>q'),
+}
+_LENGTHS = {
+    1: struct.Struct('>B'), 2: struct.Struct('>H'), 4: struct.Struct('>I'),
+}
+
+
+def _pack_length(out, length, fix, fix_max, tags):
+    """Write a length header, tags is the tag for a 1, 2 and 4 byte length."""
+    if fix is not None and length < fix_max:
+        out.append(fix | length)
+        return
+    for tag, size in zip(tags, (1, 2, 4)):
+        if tag is not None and length < 1 << (8 * size):
+            out.append(tag)
+            out += _LENGTHS[size].pack(length)
+            return
+    raise ValueError('object too large to encode')
+
+
+def _pack(out, obj):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xff)
+        else:
+            for tag, fmt, limit in (_UINTS if obj >= 0 else _INTS):
+                if -limit <= obj < limit:
+                    out += fmt.pack(tag, obj)
+                    break
+            else:
+                raise ValueError('integer too large to encode')
+    elif isinstance(obj, float):
+        out += _pack_double(0xcb, obj)
+    elif isinstance(obj, str):
+        data = obj.encode()
+        _pack_length(out, len(data), 0xa0, 32, (0xd9, 0xda, 0xdb))
+        out += data
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        _pack_length(out, len(obj), None, 0, (0xc4, 0xc5, 0xc6))
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        _pack_length(out, len(obj), 0x90, 16, (None, 0xdc, 0xdd))
+        for item in obj:
+            _pack(out, item)
+    elif isinstance(obj, dict):
+        _pack_length(out, len(obj), 0x80, 16, (None, 0xde, 0xdf))
+        for key, value in obj.items():
+            _pack(out, key)
+            _pack(out, value)
+    else:
+        raise TypeError('can not encode {!r}'.format(type(obj)))
+
+
+def _unpack(data, offset):
+    """Decode one object from data at offset, return (object, new offset)."""
+    tag = data[offset]
+    offset += 1
+    if tag < 0x80:
+        return tag, offset
+    if tag >= 0xe0:
+        return tag - 0x100, offset
+    if 0xa0 <= tag < 0xc0:
+        end = offset + (tag & 0x1f)
+        return str(data[offset:end], 'utf-8'), end
+    if 0x90 <= tag < 0xa0:
+        return _unpack_array(data, offset, tag & 0x0f)
+    if 0x80 <= tag < 0x90:
+        return _unpack_map(data, offset, tag & 0x0f)
+    if tag == 0xc0:
+        return None, offset
+    if tag == 0xc2:
+        return False, offset
+    if tag == 0xc3:
+        return True, offset
+    if tag == 0xcb:
+        return _unpack_double(data, offset)[0], offset + 8
+    if tag == 0xca:
+        return _unpack_float(data, offset)[0], offset + 4
+    fmt = _FIXED.get(tag)
+    if fmt is not None:
+        return fmt.unpack_from(data, offset)[0], offset + fmt.size
+    for tags, kind in (
+            ((0xd9, 0xda, 0xdb), 'str'),
+            ((0xc4, 0xc5, 0xc6), 'bin'),
+            ((None, 0xdc, 0xdd), 'array'),
+            ((None, 0xde, 0xdf), 'map')):
+        if tag in tags:
+            fmt = _LENGTHS[(1, 2, 4)[tags.index(tag)]]
+            length = fmt.unpack_from(data, offset)[0]
+            offset += fmt.size
+            break
+    else:
+        raise ValueError('invalid tag 0x{:02x}'.format(tag))
+    if kind == 'array':
+        return _unpack_array(data, offset, length)
+    if kind == 'map':
+        return _unpack_map(data, offset, length)
+    end = offset + length
+    if end > len(data):
+        raise ValueError('truncated data')
+    if kind == 'str':
+        return str(data[offset:end], 'utf-8'), end
+    return bytes(data[offset:end]), end
+
+
+def _unpack_array(data, offset, length):
+    result = []
+    for _ in range(length):
+        item, offset = _unpack(data, offset)
+        result.append(item)
+    return result, offset
+
+
+def _unpack_map(data, offset, length):
+    result = {}
+    for _ in range(length):
+        key, offset = _unpack(data, offset)
+        value, offset = _unpack(data, offset)
+        try:
+            result[key] = value
+        except TypeError:
+            raise ValueError('unhashable map key')
+    return result, offset
+
+
+class MsgpackCodec:
+    """Encode packets with the msgpack binary format."""
+
+    name = 'msgpack'
+
+    @staticmethod
+    def encode(obj):
+        out = bytearray()
+        _pack(out, obj)
+        return bytes(out)
+
+    @staticmethod
+    def decode(data):
+        data = memoryview(data)
+        try:
+            obj, offset = _unpack(data, 0)
+        except (IndexError, struct.error):
+            raise ValueError('truncated data')
+        if offset != len(data):
+            raise ValueError('extra data')
+        return obj
+
+
+if msgpack is not None:
+    class MsgpackCodec(MsgpackCodec):  # pylint: disable=E0102
+        """Encode packets with the msgpack binary format."""
+
+        @staticmethod
+        def encode(obj):
+            return msgpack.packb(obj, use_bin_type=True)
+
+        @staticmethod
+        def decode(data):
+            try:
+                return msgpack.unpackb(data, raw=False)
+            except ValueError:
+                raise
+            except Exception as e:
+                raise ValueError(e)
+
+
+_CODECS = OrderedDict()
+
+
+def register(codec):
+    """
+    Register a codec so peers can use it.
+
+    A codec is any object with a ``name`` and ``encode`` and ``decode``
+    functions. ``decode`` must raise ValueError for invalid data.
+    """
+    _CODECS[codec.name] = codec
+    return codec
+
+
+def get_codec(name):
+    """Get a registered codec by name, raises KeyError if it is unknown."""
+    return _CODECS[name]
+
+
+def available():
+    """Names of every registered codec."""
+    return list(_CODECS)
+
+
+register(JsonCodec)
+register(MsgpackCodec)
@@ -2,6 +2,8 @@
 
 import asyncio
 import hashlib
+import itertools
+import multiprocessing
 import threading
 from collections import defaultdict
 from contextlib import suppress
@@ -39,7 +41,9 @@ def group_to_port(group):
 class Device(Looper):
     """A device to interact with the robocluster network."""
 
-    def __init__(self, name, group, network=None, context=None):
+    STATS_ENDPOINT = Member.STATS_ENDPOINT
+
+    def __init__(self, name, group, network=None, context=None, **options):
         """
         Initialize the device.
 
@@ -51,15 +55,74 @@ class Device(Looper):
             network (str): IPv4 network to broadcast on (default 0.0.0.0/0)
             loop (asyncio.AbstractEventLoop, optional): Event loop to use.
                 Defaults to the current event loop.
+            context (Context, ContextPool, optional): Where the device runs.
+                Given a pool, the device gets the pool's next context.
+                Defaults to a context shared by the whole process.
+            **options: Passed on to :class:`~robocluster.member.Member`.
+                codec (str): Preferred wire codec, 'json' (default)
+                or 'msgpack'.
+                flush (str): When queued messages are written to peers,
+                'immediate' (default), 'batch' to coalesce messages sent
+                within a millisecond, or 'threshold' to wait for 16 KiB
+                of messages or 50 ms.
+                queue_size (int): How many published messages can wait
+                to be sent to each subscriber (default 1024).
+                queue_policy (str): What publish does when a subscriber's
+                queue is full, 'drop-oldest' (default), 'drop-newest' or
+                'block' until there is room. A subscriber that went away
+                without being noticed yet blocks publish until it is
+                evicted.
+                transport (str): How connections are made, 'socket'
+                (default) or 'protocol' to use asyncio protocols.
+                request_timeout (float): Default seconds to wait for
+                a reply to a request (default 10).
+                discovery_timeout (float): Seconds to wait for a device
+                that has not been seen yet before giving up with
+                UnknownPeer (default 0.5).
+                probe (bool): Ask a device that has not been seen yet to
+                announce itself instead of waiting for its heartbeat
+                (default True).
+                multicast (bool): Join the group's multicast channel for
+                best effort publishing (default False).
+                shared_memory (bool): Talk to devices on the same host
+                that also set it through shared memory instead of TCP
+                (default False). Only safe on hosts that keep stores in
+                order, like x86, see :mod:`robocluster.shm`.
+                local (bool): Hand messages to devices in the same context,
+                or ContextPool, that also set it directly, without the
+                network (default False).
+                local_copy (bool): Copy data sent to devices in the same
+                context instead of handing over the same objects
+                (default False).
+                replay_size (int): How many messages to each device are
+                kept to send again when its connection drops before they
+                are written (default 256).
+                trace_rate (float): Fraction of sent and published
+                messages to trace, from 0 (default) to 1, see
+                :meth:`export_trace`.
+                watchdog (float): Watch the event loop for callbacks and
+                tasks that block it for longer than this many seconds,
+                see :meth:`watchdog_report` (default None, off).
+                watchdog_log (bool): Log a warning for every step that
+                blocked the loop (default False).
         """
+        if isinstance(context, ContextPool):
+            context = context.context()
         self.context = context or Context.instance()
         self.context._ready.wait()
+        # devices in the same context can talk without the network
+        local = options.get('local', False)
+        if local is True:
+            local = self.context.local
+        elif local is False:
+            local = None
+        options['local'] = local
         super().__init__(self.context.loop)
 
         if network is None:
             network = '0.0.0.0/0'
         port = group_to_port(group)
-        self._member = Member(name, network, port, loop=self.loop)
+        self._member = Member(name, network, port, loop=self.loop, **options)
 
         self._storage = AttributeDict()
 
@@ -89,7 +152,7 @@ class Device(Looper):
         """
         await self._member.send(dest, endpoint, data)
 
-    async def publish(self, topic, data):
+    async def publish(self, topic, data, best_effort=False):
         """
         Publish to topic.
 
@@ -98,15 +161,17 @@ class Device(Looper):
             data: Any arbitrary data that can be encoded and sent
                 over the network. For the default json encoding,
                 dictionaries are a good way to package data.
-            port (str, list, optional): Specify which ports to publish to.
-                Ports are identified by their name as a string.
-                You can also provide a list of port names to
-                publish over multiple ports.
-                Defaults to 'multicast'.
+            best_effort (bool): When the device was created with
+                multicast enabled, send the data to every subscriber
+                with multicast in a single datagram. Messages may be
+                lost, use this for data that is sent often, like sensor
+                readings. Messages that do not fit in 1400 bytes are
+                published over the peer connections instead.
         """
-        await self._member.publish(topic, data)
+        await self._member.publish(topic, data, best_effort=best_effort)
 
-    def on(self, event, callback=None):
+    def on(self, event, callback=None, dispatch='inline', limit=None,
+           executor=None, max_rate=None):
         """
         Add a callback for an event.
 
@@ -126,21 +191,63 @@ class Device(Looper):
                 You can also provide a list of port names to
                 listen to multiple ports.
                 Defaults to None, which listens to all ports.
+            dispatch (str, optional): How the callback is run.
+                'inline' (default) makes messages from the same device
+                wait for the callback, 'task' runs every message in its own
+                task and 'ordered' runs messages one by one in a separate
+                task. 'conflate' is like 'ordered' but only keeps the newest
+                message for every event, older ones that have not been
+                handled yet are dropped. Use it for data like sensor
+                readings, where only the latest value matters.
+                See :class:`~robocluster.dispatch.Handler`.
+            limit (int, optional): With 'task', the most callbacks to run
+                at once. With 'ordered', the most messages to queue.
+            executor (concurrent.futures.Executor, bool, optional): Run a
+                normal (not async) callback in this executor instead of the
+                event loop, True for the default thread pool.
+            max_rate (float, optional): For published events, the most
+                messages per second to get. Publishers drop the rest
+                before sending, which saves bandwidth on slow links.
+                When several subscriptions of the device match a
+                message, it comes as often as the fastest one asks for.
         """
+        options = dict(dispatch=dispatch, limit=limit, executor=executor)
+
         def decorator(callback):
             peer, _, endpoint = event.partition('/')
             if endpoint:
-                self._member.subscribe(peer, endpoint, callback)
+                self._member.subscribe(
+                    peer, endpoint, callback, max_rate=max_rate, **options)
             else:
                 # peer is actually the endpoint
-                self._member.on_recv(peer, callback)
+                self._member.on_recv(peer, callback, **options)
             return callback
 
         if callback is None:
             return decorator
         return decorator(callback)
 
-    async def request(self, dest, endpoint, *args, **kwargs):
+    def latest(self, topic, default=None):
+        """
+        The last data received on a subscribed topic, without waiting.
+
+        The value is updated as messages arrive, before the callbacks run,
+        so it can be newer than what a slow callback is working on.
+        Example::
+
+            @device.on('imu/orientation', dispatch='conflate')
+            async def log_orientation(event, data):
+                ...
+
+            orientation = device.latest('imu/orientation')
+
+        Args:
+            topic (str): The full 'device/topic' name, not a pattern.
+            default: Returned when nothing was received on topic yet.
+        """
+        return self._member.latest(topic, default)
+
+    async def request(self, dest, endpoint, *args, timeout=None, **kwargs):
         """
         Request data from another device.
 
@@ -148,23 +255,184 @@ class Device(Looper):
             dest (str): The device name to request data from.
             endpoint (str): The endpoint to request.
             *args: Arguments passed to the endpoint.
+            timeout (float, optional): Seconds to wait for the reply.
+                Defaults to the request_timeout option of the device (10).
             **kwargs: Keyword Arguments passed to the endpoint.
 
         Return:
             The return value of the endpoint that you requested.
+
+        Raises:
+            RequestTimeout: No reply within timeout, the request is
+                cancelled on the other device.
+            ConnectionLost: The connection dropped before the reply came.
+            RemoteError: The endpoint raised an exception.
+        """
+        return await self._member.request(
+            dest, endpoint, *args, timeout=timeout, **kwargs)
+
+    async def request_many(self, requests, timeout=None, return_exceptions=False,
+                           coalesce=False):
+        """
+        Make many requests at once.
+
+        Requests to the same device are sent together over one connection,
+        without waiting for each reply. Every request is served, even
+        identical ones, unless coalesce is set. Example::
+
+            left, right = await device.request_many([
+                ('motor-left', 'speed'),
+                ('motor-right', 'speed'),
+            ])
+
+        Args:
+            requests: Tuples of (dest, endpoint), optionally followed by
+                a tuple of arguments and a dictionary of keyword arguments.
+            timeout (float, optional): Seconds to wait for all replies.
+                Defaults to the request_timeout option of the device (10).
+            return_exceptions (bool): Return exceptions in place of results
+                instead of raising the first one.
+            coalesce (bool): Send identical requests only once and give
+                them all the same reply. Only use this for requests that
+                have no side effects, like reading a sensor.
+
+        Return:
+            list: The return values, in the same order as requests.
+        """
+        return await self._member.request_many(
+            requests, timeout=timeout, return_exceptions=return_exceptions,
+            coalesce=coalesce)
+
+    def request_stats(self):
+        """
+        Latency of the requests this device made.
+
+        Return:
+            dict: For every 'dest/endpoint', the count, min, max, mean,
+                p50, p90 and p99 latency in seconds.
+        """
+        return self._member.request_stats()
+
+    def stats(self):
+        """
+        Metrics of this device.
+
+        Counters and gauges for every device it talks to, how long its
+        callbacks take and what discovery costs, see
+        :meth:`~robocluster.member.Member.stats`. Ask another device for
+        its metrics with::
+
+            await device.request('other-device', Device.STATS_ENDPOINT)
+
+        Return:
+            dict: Values by metric name, histograms as a dictionary with
+                the count, min, max, mean, p50, p90 and p99.
+        """
+        return self._member.stats()
+
+    def export_trace(self, path):
+        """
+        Write the traces this device recorded to a file.
+
+        With a trace_rate, some of the messages a device sends or publishes
+        carry a trace, and every device they reach records when they were
+        encoded, written, read, decoded and handled. The file is in the
+        Chrome trace format, merge the files of several devices with
+        :func:`robocluster.trace.merge` and open it in
+        https://ui.perfetto.dev or chrome://tracing.
+
+        Args:
+            path (str): File to write.
+        """
+        self._member.export_trace(path)
+
+    def watchdog_report(self):
+        """
+        What the watchdog of the event loop measured.
+
+        Devices in the same context share an event loop, a callback that
+        blocks it delays every one of them. With the watchdog option, the
+        loop's lag is measured and every step of a task or callback, the
+        code between two awaits, is timed. Example::
+
+            device = Device('rover', 'group', watchdog=0.05)
+            ...
+            for step in device.watchdog_report()['worst']:
+                print(step['name'], step['seconds'])
+                print(step['stack'])
+
+        Return:
+            dict: The loop's lag as a histogram summary, how many steps
+                were timed and how many were slow, and the slowest steps
+                kept, with their name, seconds, time and the stack of the
+                loop's thread if one was captured while it ran. None when
+                the watchdog is off, or every device that turned it on
+                has stopped.
+        """
+        watchdog = self.watchdog
+        return watchdog.report() if watchdog is not None else None
+
+    def on_request(self, endpoint, callback=None, limit=None, executor=None):
+        """
+        Add a callback for a request.
+
+        Every request is handled in its own task.
+
+        Args:
+            endpoint (str): The endpoint name to serve.
+            limit (int, optional): The most requests to handle at once.
+            executor (concurrent.futures.Executor, bool, optional): Run a
+                normal (not async) callback in this executor instead of the
+                event loop, True for the default thread pool.
+        """
+        def decorator(callback):
+            self._member.on_request(
+                endpoint, callback, limit=limit, executor=executor)
+            return callback
+
+        if callback is None:
+            return decorator
+        return decorator(callback)
+
+    def on_connection(self, callback=None, executor=None):
         """
-        return await self._member.request(dest, endpoint, *args, **kwargs)
+        Add a callback for changes of the connection to other devices.
 
-    def on_request(self, endpoint, callback=None):
-        """Add a callback for a request."""
+        Example::
+
+            @device.on_connection
+            async def connection(name, state):
+                print(name, state)
+
+        The states are 'connecting', 'connected', 'backoff' when connecting
+        failed and the device waits to try again, 'disconnected' when the
+        connection is not needed anymore and 'stopped' when the other
+        device left. Callbacks run one at a time, in order. Devices in the
+        same context talk without a connection and never show up here.
+
+        Args:
+            executor (concurrent.futures.Executor, bool, optional): Run a
+                normal (not async) callback in this executor instead of the
+                event loop, True for the default thread pool.
+        """
         def decorator(callback):
-            self._member.on_request(endpoint, callback)
+            self._member.on_connection(callback, executor=executor)
             return callback
 
         if callback is None:
             return decorator
         return decorator(callback)
 
+    def connection_state(self, name):
+        """
+        State of the connection to another device.
+
+        Return:
+            str: One of the states passed to :meth:`on_connection`, or
+                None if the device has not been seen.
+        """
+        return self._member.connection_state(name)
+
     def task(self, task):
         """
         Create a background task.
@@ -235,10 +503,23 @@ class Context(threading.Thread):
             Context.__DEFAULT.start()
         return Context.__DEFAULT
 
-    def __init__(self):
+    def __init__(self, loop_factory=None, local=None):
+        """
+        Initialize the context.
+
+        Args:
+            loop_factory (callable, optional): Creates the event loop,
+                for example uvloop.new_event_loop.
+                Defaults to asyncio.new_event_loop.
+            local (dict, optional): Registry of the members that can be
+                reached without the network, shared by the contexts of a
+                :class:`ContextPool`.
+        """
         super().__init__(daemon=True)
-        self.loop = asyncio.new_event_loop()
+        self.loop = (loop_factory or asyncio.new_event_loop)()
         self._ready = threading.Event()
+        # the members of the devices using this context
+        self.local = {} if local is None else local
 
     def run(self):
         asyncio.set_event_loop(self.loop)
@@ -257,3 +538,152 @@ class Context(threading.Thread):
             self.join()
         except KeyboardInterrupt:
             pass
+
+    def stop(self):
+        """Stop the event loop, from any thread."""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def _worker(queue, loop_factory):
+    """Run a Context in a worker process of a ContextPool."""
+    context = Context(loop_factory)
+    context.start()
+    context._ready.wait()
+    spawned = []
+    while ...:
+        job = queue.get()
+        if job is None:
+            break
+        factory, args = job
+        try:
+            spawned.append(factory(context, *args))
+        except Exception:  # pylint: disable=W0703
+            import traceback
+            traceback.print_exc()
+    context.stop()
+    context.join()
+
+
+class ContextPool:
+    """
+    Spread devices over several event loops.
+
+    In thread mode every context runs its event loop in its own thread of
+    this process, devices in different contexts still talk without the
+    network. Python only runs one thread at a time, so this helps devices
+    that spend their time in the network or in code that releases the GIL.
+
+    In process mode every context runs in a worker process. Devices in
+    different workers talk like devices on different hosts, or through
+    shared memory, and use every core.
+
+    Example::
+
+        pool = ContextPool(4)
+        sensors = [Device('sensor-{}'.format(i), 'group', context=pool)
+                   for i in range(8)]
+    """
+
+    def __init__(self, size=None, loop_factory=None, processes=False):
+        """
+        Initialize the pool.
+
+        Args:
+            size (int, optional): Number of contexts.
+                Defaults to the number of CPUs.
+            loop_factory (callable, optional): Creates the event loops,
+                see :class:`Context`. It must be picklable in process mode.
+            processes (bool): Run the contexts in worker processes
+                instead of threads (default False).
+        """
+        self.size = size or multiprocessing.cpu_count()
+        self.processes = processes
+        self.local = {}
+        self._lock = threading.Lock()
+        self._next = itertools.cycle(range(self.size))
+        self.contexts = []
+        self._workers = []
+        if processes:
+            for _ in range(self.size):
+                queue = multiprocessing.Queue()
+                worker = multiprocessing.Process(
+                    target=_worker, args=(queue, loop_factory), daemon=True)
+                worker.start()
+                self._workers.append((worker, queue))
+        else:
+            for _ in range(self.size):
+                context = Context(loop_factory, local=self.local)
+                context.start()
+                self.contexts.append(context)
+
+    def _index(self, affinity):
+        if affinity is None:
+            with self._lock:
+                return next(self._next)
+        if not 0 <= affinity < self.size:
+            raise IndexError('no context {} in a pool of {}'.format(
+                affinity, self.size))
+        return affinity
+
+    def context(self, affinity=None):
+        """
+        Pick a context in thread mode.
+
+        Args:
+            affinity (int, optional): Index of the context to use.
+                Defaults to the next context, round robin.
+        """
+        if self.processes:
+            raise RuntimeError('contexts of a process pool live in the workers')
+        return self.contexts[self._index(affinity)]
+
+    def spawn(self, factory, *args, affinity=None):
+        """
+        Call factory(context, *args) with a context of the pool.
+
+        This is how devices are created in process mode, where factory
+        and args are sent to the worker and must be picklable. The factory
+        creates and starts its devices. Example::
+
+            def sensor(context, name):
+                device = Device(name, 'group', context=context)
+                ...
+                device.start()
+
+            pool.spawn(sensor, 'sensor-1')
+
+        Args:
+            affinity (int, optional): Index of the context to use.
+                Defaults to the next context, round robin.
+
+        Return:
+            The return value of factory in thread mode, None in process mode.
+        """
+        index = self._index(affinity)
+        if self.processes:
+            _, queue = self._workers[index]
+            queue.put((factory, args))
+            return None
+        context = self.contexts[index]
+        context._ready.wait()
+        return factory(context, *args)
+
+    def close(self, timeout=5):
+        """Stop every context and wait for them to exit."""
+        for worker, queue in self._workers:
+            queue.put(None)
+        for worker, _ in self._workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+        for context in self.contexts:
+            context.stop()
+        for context in self.contexts:
+            context.join(timeout)
+        self._workers, self.contexts = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,293 @@
+"""Endpoint matching and dispatch for robocluster."""
+
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict
+from fnmatch import translate
+
+from .util import as_coroutine
+
+
+__all__ = [
+    'EndpointIndex',
+    'Handler',
+]
+
+
+log = logging.getLogger(__name__)
+
+
+def is_glob(pattern):
+    """Check if pattern contains any fnmatch special characters."""
+    return any(c in pattern for c in '*?[')
+
+
+class EndpointIndex:
+    """
+    A mapping of endpoint patterns to values.
+
+    Patterns can be literal endpoints or fnmatch style globs.
+    Literal patterns are found with a single hash lookup, globs are
+    precompiled and combined into one regular expression so that
+    endpoints that match no glob are rejected in a single pass.
+    The result of every lookup is cached until the index is modified.
+    """
+
+    CACHE_SIZE = 1024
+
+    def __init__(self, cache_size=None):
+        self._cache_size = cache_size or self.CACHE_SIZE
+        self._entries = OrderedDict()
+        self._literals = {}
+        self._globs = []
+        self._any_glob = None
+        self._cache = OrderedDict()
+
+    @classmethod
+    def fromkeys(cls, patterns, value=None):
+        """Create an index where every pattern maps to value."""
+        index = cls()
+        index._entries = OrderedDict.fromkeys(patterns, value)
+        index._rebuild()
+        return index
+
+    def __setitem__(self, pattern, value):
+        self._entries[pattern] = value
+        self._rebuild()
+
+    def __getitem__(self, pattern):
+        return self._entries[pattern]
+
+    def __delitem__(self, pattern):
+        del self._entries[pattern]
+        self._rebuild()
+
+    def __contains__(self, pattern):
+        return pattern in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def items(self):
+        return self._entries.items()
+
+    def clear(self):
+        self._entries.clear()
+        self._rebuild()
+
+    def _rebuild(self):
+        self._literals = {}
+        self._globs = []
+        for order, pattern in enumerate(self._entries):
+            if is_glob(pattern):
+                self._globs.append((order, pattern, re.compile(translate(pattern))))
+            else:
+                self._literals[pattern] = order
+        if self._globs:
+            combined = '|'.join(
+                '(?:{})'.format(regex.pattern) for _, _, regex in self._globs
+            )
+            self._any_glob = re.compile(combined)
+        else:
+            self._any_glob = None
+        self._cache.clear()
+
+    def match(self, endpoint):
+        """
+        Find every pattern that matches endpoint.
+
+        Returns:
+            tuple: (pattern, value) pairs, in the order the patterns
+                were first added.
+        """
+        cache = self._cache
+        try:
+            result = cache[endpoint]
+        except KeyError:
+            pass
+        else:
+            cache.move_to_end(endpoint)
+            return result
+
+        matches = []
+        order = self._literals.get(endpoint)
+        if order is not None:
+            matches.append((order, endpoint))
+        if self._any_glob is not None and self._any_glob.match(endpoint):
+            for order, pattern, regex in self._globs:
+                if regex.match(endpoint):
+                    matches.append((order, pattern))
+        matches.sort()
+
+        entries = self._entries
+        result = tuple((pattern, entries[pattern]) for _, pattern in matches)
+        cache[endpoint] = result
+        if len(cache) > self._cache_size:
+            cache.popitem(last=False)
+        return result
+
+
+class Handler:
+    """
+    A callback with a dispatch policy.
+
+    The dispatch policy decides whether whoever delivers a message has to
+    wait for the callback:
+
+    - 'inline': the callback is awaited, nothing else is read from the
+      connection the message came in on until it is done.
+    - 'task': every call runs in its own task. With a limit, at most
+      limit calls run at once and further calls wait for a free slot.
+    - 'ordered': calls are queued and a worker task runs them one at a
+      time, in the order they arrived. With a limit, at most limit calls
+      are queued and further calls wait for room.
+    - 'conflate': like 'ordered', but only the latest call for every
+      endpoint is kept. The endpoint is the key given to
+      :meth:`call_keyed`, or else the first argument. A call that is still
+      waiting when a newer one for the same endpoint arrives is dropped,
+      so a slow callback always gets the newest data. Calls never wait.
+
+    For 'inline', limit caps how many calls may run at once, which matters
+    when the handler is called from several tasks, like request handlers.
+    """
+
+    DISPATCH_MODES = ('inline', 'task', 'ordered', 'conflate')
+
+    def __init__(self, callback, loop, dispatch='inline', limit=None,
+                 executor=None, latency=None, watchdog=None):
+        """
+        Initialize the handler.
+
+        Args:
+            callback: The function or coroutine to call.
+            loop (asyncio.AbstractEventLoop): Event loop to run tasks on.
+            dispatch (str): The dispatch policy.
+            limit (int, optional): Bound for the dispatch policy.
+            executor (concurrent.futures.Executor, bool, optional): Run
+                a normal function in this executor, see
+                :func:`~robocluster.util.as_coroutine`.
+            latency (Histogram, optional): Records how long every call of
+                the callback takes.
+            watchdog (Watchdog, optional): Times every step of the
+                callback, see :mod:`robocluster.watchdog`.
+        """
+        if dispatch not in self.DISPATCH_MODES:
+            raise ValueError('unknown dispatch mode {!r}'.format(dispatch))
+        self.callback = callback
+        self.loop = loop
+        self.dispatch = dispatch
+        self.latency = latency
+        self.watchdog = watchdog
+        self._name = getattr(callback, '__qualname__', None) or repr(callback)
+        self._coro = as_coroutine(callback, executor=executor)
+        self._tasks = set()
+        self._slots = None
+        self._queue = None
+        self._worker = None
+        self._pending = OrderedDict()
+        # calls replaced by a newer one before they ran, with 'conflate'
+        self.dropped = 0
+        if dispatch == 'ordered':
+            self._queue = asyncio.Queue(maxsize=limit or 0, loop=loop)
+        elif limit and dispatch != 'conflate':
+            self._slots = asyncio.Semaphore(limit, loop=loop)
+
+    async def __call__(self, *args, **kwargs):
+        """
+        Dispatch a call to the callback.
+
+        Returns:
+            The callback's result for 'inline', otherwise None.
+        """
+        return await self.call_keyed(args[0] if args else None, *args, **kwargs)
+
+    async def call_keyed(self, key, *args, **kwargs):
+        """
+        Dispatch a call, with 'conflate' replacing waiting calls with key.
+
+        Returns:
+            The callback's result for 'inline', otherwise None.
+        """
+        if self.dispatch == 'inline':
+            if self.latency is None:
+                return await self._inline(args, kwargs)
+            start = time.monotonic()
+            try:
+                return await self._inline(args, kwargs)
+            finally:
+                self.latency.record(time.monotonic() - start)
+        elif self.dispatch == 'task':
+            if self._slots is not None:
+                await self._slots.acquire()
+            task = self.loop.create_task(self._run(args, kwargs))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif self.dispatch == 'conflate':
+            if key in self._pending:
+                self.dropped += 1
+            # a replaced call keeps its place in line
+            self._pending[key] = (args, kwargs)
+            if self._worker is None or self._worker.done():
+                self._worker = self.loop.create_task(self._work_latest())
+        else:
+            await self._queue.put((args, kwargs))
+            if self._worker is None or self._worker.done():
+                self._worker = self.loop.create_task(self._work())
+        return None
+
+    def _call(self, args, kwargs):
+        coro = self._coro(*args, **kwargs)
+        if self.watchdog is None:
+            return coro
+        return self.watchdog.timed(coro, self._name)
+
+    async def _inline(self, args, kwargs):
+        if self._slots is None:
+            return await self._call(args, kwargs)
+        async with self._slots:
+            return await self._call(args, kwargs)
+
+    async def _run(self, args, kwargs):
+        start = time.monotonic()
+        try:
+            await self._call(args, kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception:  # pylint: disable=W0703
+            log.exception('handler %r failed', self.callback)
+        finally:
+            if self.latency is not None:
+                self.latency.record(time.monotonic() - start)
+            if self._slots is not None:
+                self._slots.release()
+
+    async def _work(self):
+        while ...:
+            args, kwargs = await self._queue.get()
+            await self._run(args, kwargs)
+
+    async def _work_latest(self):
+        pending = self._pending
+        while pending:
+            _, (args, kwargs) = pending.popitem(last=False)
+            await self._run(args, kwargs)
+
+    def stop(self):
+        """Cancel calls that are still running or queued."""
+        def _stop():
+            for task in list(self._tasks):
+                task.cancel()
+            if self._worker is not None:
+                self._worker.cancel()
+                self._worker = None
+            if self._queue is not None:
+                while not self._queue.empty():
+                    self._queue.get_nowait()
+            self._pending.clear()
+        # stop can be called from outside the event loop's thread
+        self.loop.call_soon_threadsafe(_stop)
@@ -1,5 +1,7 @@
 import asyncio
 
+from .watchdog import Watchdog
+
 
 class Looper:
     """
@@ -26,16 +28,61 @@ class Looper:
     def loop(self):
         return self._loop
 
+    @property
+    def watchdog(self):
+        """The :class:`~robocluster.watchdog.Watchdog` of the loop, or None."""
+        return Watchdog.of(self.loop)
+
+    def enable_watchdog(self, threshold=0.1, log_slow=False):
+        """
+        Watch the event loop for steps that block it.
+
+        The watchdog is shared by every looper on the loop, it times the
+        tasks they create from now on and runs until the last looper that
+        enabled it stops. If the loop already has one, that one is
+        returned unchanged.
+
+        Args:
+            threshold (float): Seconds a step may block the loop before it
+                is reported.
+            log_slow (bool): Log a warning for every slow step.
+
+        Returns:
+            Watchdog: The watchdog of the loop.
+        """
+        watchdog = self.watchdog
+        if watchdog is None:
+            watchdog = Watchdog(self.loop, threshold, log_slow)
+        self.create_daemon(watchdog.run)
+        return watchdog
+
+    def _task_name(self, coro):
+        name = getattr(coro, '__qualname__', None) or repr(coro)
+        owner = getattr(self, 'name', None)
+        return '{} ({})'.format(name, owner) if owner else name
+
     def create_task(self, coro, *args, **kwargs):
         """Create a task in the event loop."""
         if self._running_tasks is None:
             self._tasks.append((coro, args, kwargs))
             return
-        self._create_task(self._coro_wrapper(coro, *args, **kwargs))
+        self._create_task(self._coro_wrapper(coro, *args, **kwargs), coro)
+
+    def _create_task(self, coro, function):
+        watchdog = self.watchdog
+        if watchdog is not None:
+            coro = watchdog.timed(coro, self._task_name(function))
 
-    def _create_task(self, coro):
         def _create_task():
-            self._running_tasks.append(self.loop.create_task(coro))
+            tasks = self._running_tasks
+            if tasks is None:
+                # stopped before the task could start
+                coro.close()
+                return
+            task = self.loop.create_task(coro)
+            tasks.add(task)
+            # finished tasks are forgotten, fire and forget ones add up
+            task.add_done_callback(tasks.discard)
         self.loop.call_soon_threadsafe(_create_task)
 
     def create_daemon(self, coro, *args, **kwargs):
@@ -48,7 +95,8 @@ class Looper:
         # TODO: make this a class level decorator?
         self._daemons.append((coro, args, kwargs))
         if self._running_tasks is not None:
-            self._create_task(self._daemon_wrapper(coro, *args, *kwargs))
+            self._create_task(
+                self._daemon_wrapper(coro, *args, **kwargs), coro)
 
     def sleep(self, seconds):
         """
@@ -63,12 +111,12 @@ class Looper:
         if self._running_tasks is not None:
             return
 
-        self._running_tasks = []
+        self._running_tasks = set()
         for coro, args, kwargs in self._daemons:
-            self._create_task(self._daemon_wrapper(coro, *args, **kwargs))
+            self._create_task(self._daemon_wrapper(coro, *args, **kwargs), coro)
 
         for coro, args, kwargs in self._tasks:
-            self._create_task(self._coro_wrapper(coro, *args, **kwargs))
+            self._create_task(self._coro_wrapper(coro, *args, **kwargs), coro)
         self._tasks = []
 
     async def _coro_wrapper(self, coro, *args, **kwargs):
@@ -85,7 +133,8 @@ class Looper:
             try:
                 await coro(*args, **kwargs)
                 print('daemon exited', coro)
-            except asyncio.CancelledError:
+            except (asyncio.CancelledError, GeneratorExit):
+                # GeneratorExit when a daemon of a closed loop is collected
                 raise
             except:  # pylint: disable=W0702
                 import traceback
@@ -1,18 +1,34 @@
 import asyncio
+import copy
 import socket
-import json
 import os
 import logging
+import random
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
 from fnmatch import fnmatch
+from functools import partial
+from itertools import count
 from ipaddress import IPv4Network
+from types import MappingProxyType
 
-from .net import AsyncSocket
+from . import shm
+from .codec import JsonCodec, MsgpackCodec, available as available_codecs, get_codec
+from .dispatch import EndpointIndex, Handler
+from .net import FrameWriter, key_to_multicast
 from .looper import Looper
-from .util import as_coroutine
+from .metrics import Registry
+from .trace import Tracer
+from .transport import get_transport
 
 
 log = logging.getLogger(__name__)
 
+# guards the registries of local members, which are shared between threads
+_local_lock = threading.Lock()
+
 
 class Error(Exception):
     pass
@@ -22,21 +38,121 @@ class UnknownPeer(Error):
     pass
 
 
+class RequestTimeout(Error, asyncio.TimeoutError):
+    pass
+
+
+class ConnectionLost(Error):
+    pass
+
+
+class RemoteError(Error):
+    pass
+
+
 class Member(Looper):
-    def __init__(self, name, network, port, key=None, loop=None):
+    # request endpoint every member serves its metrics on
+    STATS_ENDPOINT = 'robocluster.stats'
+
+    # (delay, threshold) for the FrameWriter of every peer connection
+    FLUSH_POLICIES = {
+        'immediate': (0, 0),
+        'batch': (0.001, 256 * 1024),
+        'threshold': (0.05, 16 * 1024),
+    }
+
+    # bytes in each direction of a shared memory connection
+    SHARED_MEMORY_SIZE = 1024 * 1024
+
+    QUEUE_POLICIES = ('block', 'drop-oldest', 'drop-newest')
+
+    def __init__(self, name, network, port, key=None, loop=None, codec='json',
+                 flush='immediate', queue_size=1024, queue_policy='drop-oldest',
+                 transport='socket', request_timeout=10,
+                 discovery_timeout=0.5, probe=True, multicast=False,
+                 shared_memory=False, local=None, local_copy=False,
+                 replay_size=256, trace_rate=0.0, watchdog=None,
+                 watchdog_log=False):
         super().__init__(loop)
+        if watchdog is not None:
+            self.enable_watchdog(watchdog, watchdog_log)
         self.name = name
+        self.transport = get_transport(transport, self.loop)
         self.uid = int.from_bytes(os.urandom(4), 'big')
+        self.codec = get_codec(codec)
+        if isinstance(flush, str):
+            flush = self.FLUSH_POLICIES[flush]
+        self.flush_delay, self.flush_threshold = flush
+        if queue_policy not in self.QUEUE_POLICIES:
+            raise ValueError('unknown queue policy {!r}'.format(queue_policy))
+        self.queue_size = queue_size
+        self.queue_policy = queue_policy
+        self.replay_size = replay_size
+        self.request_timeout = request_timeout
+        self.discovery_timeout = discovery_timeout
+        self.shared_memory = shared_memory and shm.available()
+        # members in this process, by gossip key and name
+        self._local = local
+        self.local_copy = local_copy
+        self.probe = probe
         self._wanted = set()
 
         self._subscriptions = set()
-
-        self._send_endpoints = {}
-        self._request_endpoints = {}
+        # most messages per second wanted on a subscription, by endpoint
+        self._rates = {}
+        # when every local member that publishes to us is due next
+        self._local_throttles = {}
+
+        self._send_endpoints = EndpointIndex()
+        self.metrics = Registry()
+        # what members in this process send us, see _LocalPeer
+        self._inbox = asyncio.Queue(maxsize=queue_size, loop=self.loop)
+        self._inbox_dropped = self.metrics.counter('local.dropped')
+        self.metrics.gauge('local.queued', self._inbox.qsize)
+        if local is not None:
+            self.create_daemon(self._local_loop)
+        watchdog = self.watchdog
+        if watchdog is not None:
+            self.metrics.gauge('loop.lag', lambda: watchdog.last_lag)
+            self.metrics.gauge('loop.slow_steps', lambda: watchdog.slow_steps)
+        self.tracer = Tracer(name, trace_rate)
+        self._request_endpoints = {
+            self.STATS_ENDPOINT: Handler(
+                self.stats, self.loop, watchdog=self.watchdog),
+        }
+        self._connection_handlers = []
+        # the last data received for every subscribed endpoint
+        self._latest = {}
 
         self._peers = {}
+        self._discovering = {}
         self._accepter = _Accepter(self)
         self._gossiper = _Gossiper(self, network, port, key=key)
+        self._multicaster = None
+        if multicast:
+            self._multicaster = _Multicaster(self, self._gossiper.key)
+            for key in self._multicaster.stats:
+                self.metrics.gauge(
+                    'multicast.' + key,
+                    partial(self._multicaster.stats.get, key))
+
+    @property
+    def codecs(self):
+        """Names of the codecs this member can speak, preferred first."""
+        names = available_codecs()
+        names.remove(self.codec.name)
+        return [self.codec.name] + names
+
+    def negotiate(self, offered):
+        """Pick the codec to use from the codecs a connecting peer offered."""
+        if self.codec.name in offered:
+            return self.codec
+        for name in offered:
+            try:
+                return get_codec(name)
+            except (KeyError, TypeError):
+                continue
+        return JsonCodec
 
     def is_wanted(self, name):
         for want in self._wanted:
@@ -44,48 +160,432 @@ class Member(Looper):
                 return True
         return False
 
-    async def try_peer(self, peer):
-        for _ in range(5):
+    def want(self, name):
+        """Ask the peer called name to connect to us."""
+        self._update_state(wanted=[name])
+
+    def _update_state(self, wanted=(), subscriptions=(), rates=None):
+        wanted = [name for name in wanted if name not in self._wanted]
+        subscriptions = [
+            endpoint for endpoint in subscriptions
+            if endpoint not in self._subscriptions
+        ]
+        rates = {
+            endpoint: rate for endpoint, rate in (rates or {}).items()
+            if self._rates.get(endpoint) != rate
+        }
+        if not wanted and not subscriptions and not rates:
+            return
+        self._wanted.update(wanted)
+        self._subscriptions.update(subscriptions)
+        for endpoint, rate in rates.items():
+            if rate:
+                self._rates[endpoint] = rate
+            else:
+                del self._rates[endpoint]
+        self._gossiper.changed(
+            wanted_added=wanted, subscriptions_added=subscriptions,
+            rates=rates)
+        if wanted:
+            for peer in tuple(self._peers.values()):
+                peer.update_wanted()
+
+    async def try_peer(self, name, timeout=None):
+        """
+        Get the peer called name, waiting for it to be discovered.
+
+        This method is a coroutine.
+
+        Args:
+            name (str): Name of the peer.
+            timeout (float, optional): Seconds to wait for the peer,
+                defaults to the member's discovery_timeout.
+
+        Raises:
+            UnknownPeer: If the peer is not found in time.
+        """
+        local = self._local_members().get(name)
+        if local is not None:
+            return _LocalPeer(self, local)
+        try:
+            return self._peers[name]
+        except KeyError:
+            pass
+        if timeout is None:
+            timeout = self.discovery_timeout
+
+        waiters = self._discovering.setdefault(name, [])
+        if not waiters and self.probe:
+            # ask the peer to announce itself instead of waiting for gossip
+            self._gossiper.probe(name)
+        future = self.loop.create_future()
+        waiters.append(future)
+        try:
+            return await asyncio.wait_for(future, timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            raise UnknownPeer(name) from None
+        finally:
+            # the waiters are gone once the peer is discovered
+            if self._discovering.get(name) is waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._discovering[name]
+
+    def _post(self, policy, handle, args):
+        """
+        Queue a call from a member in this process, on our loop.
+
+        Returns:
+            None if the call was queued or dropped, otherwise a coroutine
+            to await until there is room when policy is 'block'.
+        """
+        put, dropped = _put(self._inbox, (handle, args), policy)
+        if dropped:
+            self._inbox_dropped.inc()
+        return put
+
+    async def _post_wait(self, handle, args):
+        """Queue a call, waiting for room, from a member on another loop."""
+        put = self._post('block', handle, args)
+        if put is not None:
+            await put
+
+    async def _local_loop(self):
+        inbox = self._inbox
+        while ...:
+            handle, args = await inbox.get()
             try:
-                return self._peers[peer]
-            except KeyError:
-                await self.sleep(self._gossiper.GOSSIP_RATE)
-        raise UnknownPeer(peer)
-
-    def on_recv(self, endpoint, callback):
-        self._send_endpoints[endpoint] = as_coroutine(callback)
+                await handle(*args)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # pylint: disable=W0703
+                log.exception(e)
 
-    def subscribe(self, peer, endpoint, callback):
+    async def _handle_local_publish(self, source, endpoint, data, trace):
+        """Handle a publish from a local member unless it came too soon."""
+        try:
+            throttle = self._local_throttles[source]
+        except KeyError:
+            throttle = self._local_throttles[source] = _Throttle()
+        if throttle.due(endpoint, self._interval(endpoint), time.monotonic()):
+            await self._handle_publish(endpoint, data, trace)
+
+    def _register_local(self, add):
+        """Add us to or remove us from the registry of local members."""
+        key = self._gossiper.key
+        with _local_lock:
+            # readers iterate the old mapping without the lock, so it is
+            # replaced instead of changed
+            members = dict(self._local.get(key, {}))
+            if add:
+                members[self.name] = self
+            elif members.get(self.name) is self:
+                del members[self.name]
+            else:
+                return
+            self._local[key] = MappingProxyType(members)
+
+    def _local_members(self):
+        """Other members in this process, by name."""
+        if self._local is None:
+            return {}
+        # a snapshot, see _register_local
+        members = self._local.get(self._gossiper.key, {})
+        return {
+            name: member for name, member in members.items()
+            if member is not self
+        }
+
+    def _discovered(self, peer):
+        for future in self._discovering.pop(peer.name, ()):
+            if not future.done():
+                future.set_result(peer)
+
+    def on_recv(self, endpoint, callback, **options):
+        """Options are passed to :class:`~robocluster.dispatch.Handler`."""
+        latency = self.metrics.histogram('handler.' + endpoint)
+        self._send_endpoints[endpoint] = Handler(
+            callback, self.loop, latency=latency, watchdog=self.watchdog,
+            **options)
+
+    def subscribe(self, peer, endpoint, callback, max_rate=None, **options):
+        """
+        Subscribe to what peer publishes on endpoint.
+
+        With max_rate, publishers send at most that many messages per
+        second on every endpoint that matches, the rest are never sent.
+        """
         endpoint = '{}/{}'.format(peer, endpoint)
-        self._wanted.add(peer)
-        self.on_recv(endpoint, callback)
-        self._subscriptions.add(endpoint)
+        self.on_recv(endpoint, callback, **options)
+        self._update_state(
+            wanted=[peer], subscriptions=[endpoint],
+            rates={endpoint: max_rate})
+
+    def _interval(self, endpoint):
+        """Seconds between the messages on endpoint we want, 0 for all."""
+        patterns = [
+            end for end, _ in self._send_endpoints.match(endpoint)
+            if end in self._subscriptions
+        ]
+        return _interval(patterns, self._rates)
 
     async def send(self, peer, endpoint, data):
         peer = await self.try_peer(peer)
         await peer.send(endpoint, data)
 
-    async def publish(self, endpoint, data):
+    async def publish(self, endpoint, data, best_effort=False):
+        """
+        Publish data to every peer subscribed to endpoint.
+
+        With best_effort, when multicast is enabled, the data goes to all
+        subscribers that joined the multicast group in one datagram. It may
+        be lost or arrive out of order, late messages are dropped.
+        """
         endpoint = '{}/{}'.format(self.name, endpoint)
-        # grab list of peers before we give up control
-        peers = tuple(self._peers.values())
-        for peer in peers:
-            await peer.publish(endpoint, data)
-
-    async def _handle_send(self, source, endpoint, data):
-        for end, callback in self._send_endpoints.items():
-            if fnmatch(endpoint, end):
-                if end in self._subscriptions:
+        packet = 'send', (endpoint, data)
+        # best effort datagrams have no room for a trace
+        trace = None if best_effort else self.tracer.sample()
+        if trace is not None:
+            packet += trace,
+        local = self._local_members()
+        multicaster = self._multicaster if best_effort else None
+        datagram = None
+        # every peer speaking the same codec shares the same framed bytes
+        frames = {}
+        # queue on every peer before we give up control, only peers with
+        # a full queue under the block policy are waited on, all at once
+        blocked = []
+        now = time.monotonic()
+        for peer in self._peers.values():
+            if (not peer.is_subscribed(endpoint) or peer.name in local
+                    or not peer.due(endpoint, now)):
+                continue
+            if multicaster is not None and peer.multicast:
+                if datagram is None:
+                    datagram = multicaster.encode(endpoint, data)
+                if datagram is not None:
+                    continue
+                # too large for a datagram, use the peer connections
+                multicaster = None
+            codec = peer.codec
+            try:
+                frame = frames[codec]
+            except KeyError:
+                frame = frames[codec] = self._frame(codec, packet, trace)
+            put = peer.queue((packet, codec, frame))
+            if put is not None:
+                blocked.append(put)
+        if datagram is not None:
+            await self._multicaster.send(datagram)
+        for name, member in local.items():
+            # what we gossiped about them, the member itself belongs to
+            # another thread
+            peer = self._peers.get(name)
+            if peer is None or not peer.is_subscribed(endpoint):
+                continue
+            await _LocalPeer(self, member).publish(endpoint, data, trace)
+        if blocked:
+            await asyncio.gather(*blocked, loop=self.loop)
+        if trace is not None:
+            self.tracer.span('publish ' + endpoint, trace, trace[2], time.time())
+
+    def _frame(self, codec, packet, trace=None):
+        """Encode and frame packet, recording how long it took if traced."""
+        if trace is None:
+            return FrameWriter.frame(codec.encode(packet))
+        start = time.time()
+        frame = FrameWriter.frame(codec.encode(packet))
+        self.tracer.span('encode', trace, start, time.time(), codec=codec.name)
+        return frame
+
+    async def _handle_send(self, source, endpoint, data, trace=None):
+        for end, callback in self._send_endpoints.match(endpoint):
+            if end in self._subscriptions:
+                self._latest[endpoint] = data
+                args = endpoint, data
+            else:
+                args = source, data
+            # conflated per endpoint, whoever sent it
+            call = partial(callback.call_keyed, endpoint)
+            if trace is None:
+                await call(*args)
+            else:
+                await self._traced(trace, end, call, args)
+
+    async def _handle_publish(self, endpoint, data, trace=None):
+        # everyone in the multicast group gets every message, only the
+        # callbacks for subscriptions are called
+        for end, callback in self._send_endpoints.match(endpoint):
+            if end in self._subscriptions:
+                self._latest[endpoint] = data
+                if trace is None:
                     await callback(endpoint, data)
                 else:
-                    await callback(source, data)
-
-    def on_request(self, endpoint, callback):
-        self._request_endpoints[endpoint] = as_coroutine(callback)
+                    await self._traced(trace, end, callback, (endpoint, data))
 
-    async def request(self, peer, endpoint, *args, **kwargs):
+    async def _traced(self, trace, end, callback, args):
+        start = time.time()
+        try:
+            await callback(*args)
+        finally:
+            self.tracer.span('callback ' + end, trace, start, time.time())
+
+    def export_trace(self, path):
+        """Write the spans of traced messages to path, see :mod:`.trace`."""
+        self.tracer.export(path)
+
+    def latest(self, endpoint, default=None):
+        """The last data received for a subscribed 'peer/endpoint'."""
+        return self._latest.get(endpoint, default)
+
+    def multicast_stats(self):
+        """
+        Counters of the multicast channel.
+
+        Returns:
+            dict: Datagrams 'sent' and 'received', and how many were 'lost'
+                or arrived 'late', or None if multicast is disabled.
+        """
+        if self._multicaster is None:
+            return None
+        return dict(self._multicaster.stats)
+
+    def on_connection(self, callback, executor=None):
+        """
+        Call callback(name, state) when the connection to a peer changes.
+
+        The states are those of :attr:`_Peer.STATES`. Callbacks run one at
+        a time, in the order the changes happened.
+        """
+        self._connection_handlers.append(Handler(
+            callback, self.loop, dispatch='ordered', executor=executor,
+            watchdog=self.watchdog))
+
+    def _connection_changed(self, name, state):
+        for handler in self._connection_handlers:
+            self.create_task(handler, name, state)
+
+    def connection_state(self, name):
+        """State of the connection to the peer called name, None if unknown."""
+        peer = self._peers.get(name)
+        return None if peer is None else peer.state
+
+    def on_request(self, endpoint, callback, limit=None, executor=None):
+        """
+        Requests are always served in their own task, limit caps how many
+        run at once, see :class:`~robocluster.dispatch.Handler`.
+        """
+        latency = self.metrics.histogram('request.' + endpoint)
+        self._request_endpoints[endpoint] = Handler(
+            callback, self.loop, limit=limit, executor=executor,
+            latency=latency, watchdog=self.watchdog)
+
+    async def request(self, peer, endpoint, *args, timeout=None, **kwargs):
         peer = await self.try_peer(peer)
-        return await peer.request(endpoint, *args, **kwargs)
+        if timeout is None:
+            timeout = self.request_timeout
+        return await peer.request(endpoint, *args, timeout=timeout, **kwargs)
+
+    async def request_many(self, calls, timeout=None, return_exceptions=False,
+                           coalesce=False):
+        """
+        Make many requests at once.
+
+        Requests to the same peer are written back to back on its
+        connection and the replies are matched up as they arrive.
+
+        Args:
+            calls: (peer, endpoint[, args[, kwargs]]) tuples.
+            timeout (float, optional): Seconds to wait for all replies.
+            return_exceptions (bool): Return exceptions in place of results
+                instead of raising the first one.
+            coalesce (bool): Request identical calls only once and share
+                the reply. Only for requests without side effects.
+
+        Returns:
+            list: The results, in the order of calls.
+        """
+        if timeout is None:
+            timeout = self.request_timeout
+
+        keys = []
+        unique = OrderedDict()
+        for call in calls:
+            peer, endpoint, args, kwargs = (tuple(call) + ((), {}))[:4]
+            call = peer, endpoint, tuple(args), dict(kwargs)
+            key = object()
+            if coalesce:
+                try:
+                    key = call[:3] + (tuple(sorted(call[3].items())),)
+                    hash(key)
+                except TypeError:
+                    # unhashable arguments are never coalesced
+                    key = object()
+            keys.append(key)
+            unique.setdefault(key, call)
+
+        by_peer = OrderedDict()
+        for key, (peer, endpoint, args, kwargs) in unique.items():
+            by_peer.setdefault(peer, []).append((key, (endpoint, args, kwargs)))
+
+        async def _request_peer(name, items):
+            peer = await self.try_peer(name)
+            return await peer.request_many([call for _, call in items], timeout)
+
+        replies = await asyncio.gather(
+            *(_request_peer(name, items) for name, items in by_peer.items()),
+            loop=self.loop, return_exceptions=True)
+
+        outcomes = {}
+        for items, reply in zip(by_peer.values(), replies):
+            for index, (key, _) in enumerate(items):
+                if isinstance(reply, BaseException):
+                    outcomes[key] = reply
+                elif reply[index].exception() is not None:
+                    outcomes[key] = reply[index].exception()
+                else:
+                    outcomes[key] = reply[index].result()
+
+        results = []
+        for key in keys:
+            outcome = outcomes[key]
+            if isinstance(outcome, BaseException) and not return_exceptions:
+                raise outcome
+            results.append(outcome)
+        return results
+
+    def _record_latency(self, key, start, future):
+        if future.cancelled() or future.exception() is not None:
+            self.metrics.counter('requests_failed.' + key).inc()
+            return
+        self.metrics.histogram('latency.' + key).record(
+            time.monotonic() - start)
+
+    def request_stats(self):
+        """Latency summary of successful requests, by peer/endpoint."""
+        return {
+            name[len('latency.'):]: summary
+            for name, summary in self.metrics.snapshot('latency.').items()
+        }
+
+    def stats(self):
+        """
+        Every metric of the member, by name.
+
+        - handler.<endpoint>, request.<endpoint>: how long our callbacks
+          take.
+        - latency.<peer>/<endpoint>: round trip of our requests that
+          succeeded, requests_failed.<peer>/<endpoint> counts the others.
+        - peer.<name>.*: messages and bytes sent and received, connects,
+          connect failures, queued, replay and dropped messages, and the
+          connection state.
+        - gossip.*: discovery packets and bytes, pulls, fetches, evicted
+          peers, known peers and the heartbeat interval.
+        - multicast.*: see :meth:`multicast_stats`.
+
+        Other members get the same with a request to STATS_ENDPOINT.
+        """
+        return self.metrics.snapshot()
 
     async def _handle_request(self, endpoint, *args, **kwargs):
         try:
@@ -97,15 +597,29 @@ class Member(Looper):
 
     def start(self):
         super().start()
+        if self._local is not None:
+            self._register_local(True)
         self._accepter.start()
         self._gossiper.start()
+        if self._multicaster is not None:
+            self._multicaster.start()
 
     def stop(self):
         super().stop()
+        if self._local is not None:
+            self._register_local(False)
         self._accepter.stop()
         self._gossiper.stop()
+        if self._multicaster is not None:
+            self._multicaster.stop()
         for peer in self._peers.values():
             peer.stop()
+        for _, handler in self._send_endpoints.items():
+            handler.stop()
+        for handler in self._request_endpoints.values():
+            handler.stop()
+        for handler in self._connection_handlers:
+            handler.stop()
 
 
 class _Component(Looper):
@@ -113,26 +627,98 @@ class _Component(Looper):
         self.member = member
         super().__init__(self.member.loop)
 
-    def socket(self, kind, bind=None):
-        try:
-            kind = {
-                'tcp': socket.SOCK_STREAM,
-                'udp': socket.SOCK_DGRAM,
-            }[kind]
-        except KeyError:
-            raise ValueError
+    @property
+    def transport(self):
+        return self.member.transport
+
+
+def _put(queue, item, policy):
+    """
+    Put item on queue, following policy when the queue is full.
+
+    Returns:
+        tuple: A coroutine to await until there is room when the queue is
+            full and policy is 'block', otherwise None, and whether an
+            item was dropped.
+    """
+    try:
+        queue.put_nowait(item)
+        return None, False
+    except asyncio.QueueFull:
+        pass
+    if policy == 'block':
+        return queue.put(item), False
+    if policy == 'drop-oldest':
+        queue.get_nowait()
+        queue.put_nowait(item)
+    return None, True
+
+
+def _interval(patterns, rates):
+    """
+    Seconds between messages for a subscriber.
+
+    A subscriber gets a message as often as the fastest of the matching
+    subscriptions asks for, 0 if any of them wants every message.
+    """
+    interval = None
+    for pattern in patterns:
+        rate = rates.get(pattern)
+        if not rate:
+            return 0
+        interval = 1 / rate if interval is None else min(interval, 1 / rate)
+    return interval or 0
+
+
+class _Throttle:
+    """When a subscriber is due for its next message on every endpoint."""
 
-        s = AsyncSocket(socket.AF_INET, kind, loop=self.loop)
-        if bind is not None:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            if hasattr(socket, 'SO_REUSEPORT'):
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-            s.bind(bind)
-        return s
+    def __init__(self):
+        self._next = {}
+
+    def due(self, endpoint, interval, now):
+        """Check if a message sent now is due, and if so count it as sent."""
+        if not interval:
+            return True
+        due = self._next.get(endpoint, 0)
+        if now < due:
+            return False
+        # keep the cadence, unless nothing was sent for a while
+        due += interval
+        self._next[endpoint] = due if due > now else now + interval
+        return True
 
 
 class _Peer(_Component):
-    CONNECTION_RETRY_RATE = 0.1
+    """
+    A connection to another member.
+
+    The member with the lower uid connects, the other one waits for it.
+    The connection goes through these states:
+
+    - 'disconnected': nobody wants the connection.
+    - 'connecting': connecting and exchanging hellos, or waiting for the
+      other side to connect.
+    - 'connected': messages flow.
+    - 'backoff': connecting failed, waiting before the next attempt.
+      The wait doubles with every failure up to MAX_RECONNECT_DELAY, and
+      is cut by up to RECONNECT_JITTER so members do not retry in step.
+    - 'stopped': the peer left or the member stopped.
+
+    Messages that could not be written when the connection dropped are
+    kept, up to the member's replay_size, and sent first once connected
+    again. Some of them may have made it to the other side, so they can
+    arrive twice. Requests are not replayed, they fail with ConnectionLost.
+    """
+
+    STATES = ('disconnected', 'connecting', 'connected', 'backoff', 'stopped')
+
+    RECONNECT_DELAY = 0.1
+    MAX_RECONNECT_DELAY = 5.0
+    RECONNECT_BACKOFF = 2
+    RECONNECT_JITTER = 0.5
+    CONNECT_TIMEOUT = 2.0
+    HANDSHAKE_TIMEOUT = 1.0
 
     def __init__(self, member, name, uid):
         super().__init__(member)
@@ -141,17 +727,58 @@ class _Peer(_Component):
         self.uid = uid
 
         self._address = None
-        self._subscriptions = set()
+        self._subscriptions = EndpointIndex()
 
         self._wanted = set()
         self._is_wanted = asyncio.Event(loop=self.loop)
 
-        self._pending = {}
+        # gossip state version, and when we last asked for the full state
+        self.version = None
+        self.pulled = 0
+        # when the peer is considered dead without further gossip
+        self.expires = None
+        # whether the peer is in the multicast group
+        self.multicast = False
+        # most messages per second the peer wants, by subscription
+        self.rates = {}
+        self._throttle = _Throttle()
 
-        self._socket = None
+        self._pending = {}
+        self._rids = count()
+        self._serving = {}
+
+        self._outbox = asyncio.Queue(maxsize=member.queue_size, loop=self.loop)
+        # messages to send again once reconnected
+        self._replay = deque(maxlen=member.replay_size)
+        self.dropped = 0
+
+        self.state = 'disconnected'
+        # connection attempts that failed in a row
+        self.failures = 0
+
+        metrics = member.metrics
+        prefix = 'peer.{}.'.format(name)
+        self._sent = metrics.counter(prefix + 'sent')
+        self._sent_bytes = metrics.counter(prefix + 'sent_bytes')
+        self._received = metrics.counter(prefix + 'received')
+        self._received_bytes = metrics.counter(prefix + 'received_bytes')
+        self._connects = metrics.counter(prefix + 'connects')
+        self._connect_failures = metrics.counter(prefix + 'connect_failures')
+        metrics.gauge(prefix + 'queued', self._outbox.qsize)
+        metrics.gauge(prefix + 'replay', self._replay.__len__)
+        metrics.gauge(prefix + 'dropped', lambda: self.dropped)
+        metrics.gauge(prefix + 'state', lambda: self.state)
+
+        self._conn = None
+        self._reader = None
+        self._writer = None
+        self._codec = JsonCodec
         self._connected = asyncio.Event(loop=self.loop)
+        # when the last packet was read, for traces
+        self._read_at = None
 
         self.create_daemon(self._recv_loop)
+        self.create_daemon(self._send_loop)
 
     @property
     def address(self):
@@ -169,124 +796,489 @@ class _Peer(_Component):
 
     async def send(self, endpoint, data, register=True):
         # TODO: timeout?
-        self.member._wanted.add(self.name)
+        self.member.want(self.name)
         await self.connected
         packet = 'send', (endpoint, data)
-        await self._send(packet)
+        trace = self.member.tracer.sample()
+        if trace is not None:
+            packet += trace,
+        codec = self._codec
+        frame = self.member._frame(codec, packet, trace)
+        await self._send_framed([(packet, codec, frame)])
+        if trace is not None:
+            self.member.tracer.span(
+                'send {}/{}'.format(self.name, endpoint), trace, trace[2],
+                time.time())
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        log.debug('connection to %s is %s', self.name, state)
+        self.state = state
+        if state == 'connected':
+            self._connects.inc()
+            if self._replay:
+                # resend what the last connection could not send right
+                # away, not only when the next message goes out
+                self.create_task(self._send_framed, [])
+        elif state == 'backoff':
+            self._connect_failures.inc()
+        self.member._connection_changed(self.name, state)
+
+    def _reconnect_delay(self):
+        delay = min(
+            self.MAX_RECONNECT_DELAY,
+            self.RECONNECT_DELAY * self.RECONNECT_BACKOFF ** (self.failures - 1))
+        return delay * random.uniform(1 - self.RECONNECT_JITTER, 1)
+
+    @property
+    def codec(self):
+        return self._codec
 
-    async def publish(self, endpoint, data):
-        for subscription in self._subscriptions:
-            if fnmatch(endpoint, subscription):
-                # peer should already be wanted from the other end
-                await self.connected
-                packet = 'send', (endpoint, data)
-                await self._send(packet)
+    @property
+    def subscriptions(self):
+        return set(self._subscriptions)
+
+    @subscriptions.setter
+    def subscriptions(self, subscriptions):
+        # keep the index and its cache of matches if nothing changed
+        if subscriptions != set(self._subscriptions):
+            self._subscriptions = EndpointIndex.fromkeys(subscriptions, True)
+
+    def is_subscribed(self, endpoint):
+        return bool(self._subscriptions.match(endpoint))
+
+    def due(self, endpoint, now):
+        """Check if the peer wants a message published on endpoint now."""
+        if not self.rates:
+            return True
+        patterns = [pattern for pattern, _ in self._subscriptions.match(endpoint)]
+        return self._throttle.due(
+            endpoint, _interval(patterns, self.rates), now)
+
+    def queue(self, packet):
+        """
+        Queue a packet to be sent once connected.
+
+        A packet is a (packet, codec, frame) tuple where frame is packet
+        already encoded with codec and framed for FrameWriter.write_framed.
+
+        Returns:
+            None if the packet was queued or dropped, otherwise a coroutine
+            to await until there is room when the queue policy is 'block'.
+        """
+        put, dropped = _put(self._outbox, packet, self.member.queue_policy)
+        if dropped:
+            self.dropped += 1
+        return put
 
-    async def _handle_send(self, packet):
+    async def _send_loop(self):
+        outbox = self._outbox
+        while ...:
+            packet = await outbox.get()
+            # peer should already be wanted from the other end
+            await self.connected
+            # write out whatever else piled up while we were waiting
+            packets = [packet]
+            while not outbox.empty():
+                packets.append(outbox.get_nowait())
+            await self._send_framed(packets)
+
+    async def _handle_send(self, packet, trace=None):
         endpoint, data = packet
-        await self.member._handle_send(self.name, endpoint, data)
+        await self.member._handle_send(self.name, endpoint, data, trace)
+
+    async def request(self, endpoint, *args, timeout=None, **kwargs):
+        future, = await self.request_many([(endpoint, args, kwargs)], timeout)
+        return future.result()
+
+    async def request_many(self, calls, timeout=None):
+        """
+        Pipeline requests on this connection.
+
+        Args:
+            calls: (endpoint, args, kwargs) tuples.
+            timeout (float, optional): Seconds to wait for all replies.
+
+        Returns:
+            list: A finished future for every call, requests without
+                a reply in time fail with RequestTimeout.
+        """
+        self.member.want(self.name)
+        rids = [next(self._rids) for _ in calls]
+        futures = [asyncio.Future(loop=self.loop) for _ in calls]
+
+        async def _request():
+            await self.connected
+            writer, encode = self._writer, self._codec.encode
+            start = time.monotonic()
+            for rid, future, (endpoint, args, kwargs) in zip(rids, futures, calls):
+                packet = 'request', (rid, endpoint, args, kwargs)
+                try:
+                    frame = encode(packet)
+                except (TypeError, ValueError) as e:
+                    future.set_exception(e)
+                    continue
+                self._pending[rid] = future
+                future.add_done_callback(partial(
+                    self.member._record_latency,
+                    '{}/{}'.format(self.name, endpoint), start))
+                writer.write(frame)
+                self._sent.inc()
+                self._sent_bytes.inc(len(frame) + 4)
+            await self._drain()
+            await asyncio.wait(futures, loop=self.loop)
 
-    async def request(self, endpoint, *args, **kwargs):
-        self.member._wanted.add(self.name)
-        await self.connected
-        rid = int.from_bytes(os.urandom(4), 'big')
-        packet = 'request', (rid, endpoint, args, kwargs)
-        future = self._pending[rid] = asyncio.Future(loop=self.loop)
-        await self._send(packet)
-        return await future
+        try:
+            await asyncio.wait_for(_request(), timeout, loop=self.loop)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            # we gave up on these, so should the other side
+            abandoned = [rid for rid in rids if self._pending.pop(rid, None)]
+            if abandoned:
+                self.create_task(self._send_all, [('cancel', rid) for rid in abandoned])
+
+        for future, (endpoint, _, _) in zip(futures, calls):
+            if not future.done():
+                future.set_exception(RequestTimeout(self.name, endpoint))
+        return futures
 
     async def _handle_request(self, packet):
         rid, endpoint, args, kwargs = packet
-        result = await self.member._handle_request(endpoint, *args, **kwargs)
-        packet = 'response', (rid, result)
-        await self._send(packet)
+        # serve in the background so the request can be cancelled
+        task = self.loop.create_task(self._serve(rid, endpoint, args, kwargs))
+        self._serving[rid] = task
+        task.add_done_callback(lambda _: self._serving.pop(rid, None))
+
+    async def _serve(self, rid, endpoint, args, kwargs):
+        try:
+            result = await self.member._handle_request(endpoint, *args, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception(e)
+            packet = 'error', (rid, '{}: {}'.format(type(e).__name__, e))
+        else:
+            packet = 'response', (rid, result)
+        try:
+            frame = self._codec.encode(packet)
+        except (TypeError, ValueError) as e:
+            # the result, not the connection, is at fault
+            log.error('cannot encode the reply to %s for %s: %r',
+                      endpoint, self.name, e)
+            frame = self._codec.encode(
+                ('error', (rid, '{}: {}'.format(type(e).__name__, e))))
+        await self._send_frame(frame)
+
+    async def _handle_cancel(self, rid):
+        task = self._serving.pop(rid, None)
+        if task is not None:
+            task.cancel()
 
     async def _handle_response(self, packet):
         rid, result = packet
         future = self._pending.pop(rid, None)
-        if future:
+        if future and not future.done():
             future.set_result(result)
 
-    async def accept(self, conn):
-        if self._socket is not None:
-            conn.close()
-        self._socket = conn
+    async def _handle_error(self, packet):
+        rid, message = packet
+        future = self._pending.pop(rid, None)
+        if future and not future.done():
+            future.set_exception(RemoteError(self.name, message))
+
+    async def accept(self, conn, codec, reply=True, shared_memory=None):
+        if self._conn is not None:
+            # the other side reconnected, the old connection is dead
+            self.close()
+        self._conn = conn
+        self._reader = conn.reader
+        self._writer = self._create_writer(conn)
+        if shared_memory is not None:
+            if self.member.shared_memory:
+                shared_memory = shm.accept(shared_memory, conn, self.loop)
+            else:
+                shared_memory = None
+            # tell the connecting side which codec we picked, and if
+            # we will talk over shared memory
+            await self._send(
+                [codec.name, shared_memory is not None], flush=True)
+            if shared_memory is not None:
+                self._use(shared_memory)
+        elif reply:
+            # tell the connecting side which codec we picked
+            await self._send(codec.name, flush=True)
+        if self._conn is None:
+            # the reply could not be sent
+            return
+        self._codec = codec
         self._connected.set()
+        self.failures = 0
+        self._set_state('connected')
+
+    def _use(self, conn):
+        """Switch to conn, which wraps the current connection."""
+        self._writer.close()
+        self._conn = conn
+        self._reader = conn.reader
+        self._writer = self._create_writer(conn)
 
-    async def _send(self, packet):
-        packet = json.dumps(packet).encode()
-        size = len(packet).to_bytes(4, 'big')
+    def _create_writer(self, conn):
+        member = self.member
+        return conn.writer(
+            delay=member.flush_delay,
+            threshold=member.flush_threshold,
+            on_error=self._on_write_error,
+        )
+
+    def _on_write_error(self, error):
+        log.error('write to %s failed', self.name, exc_info=error)
+        self.close()
+
+    async def _send(self, packet, flush=False):
+        if self._writer is None:
+            log.debug('not connected to %s, dropped %r', self.name, packet)
+            return
         try:
-            return await self._socket.send(size + packet)
+            frame = self._codec.encode(packet)
+        except (TypeError, ValueError) as e:
+            log.error('cannot encode %r for %s: %r', packet, self.name, e)
+            return
+        await self._send_frame(frame, flush)
+
+    async def _send_frame(self, frame, flush=False):
+        if self._writer is None:
+            log.debug('not connected to %s, dropped a frame', self.name)
+            return
+        try:
+            await self._writer.send(frame)
+            self._sent.inc()
+            self._sent_bytes.inc(len(frame) + 4)
+            if flush:
+                await self._writer.flush()
         except asyncio.CancelledError:
             raise
         except Exception as e:
             log.exception(e)
             self.close()
-            return 0
 
-    async def _recv(self, size):
+    async def _drain(self):
         try:
-            data = await self._socket.recv(size)
-            if not data:
-                self.close()
-            return data
+            await self._writer.drain()
         except asyncio.CancelledError:
             raise
         except Exception as e:
             log.exception(e)
             self.close()
 
-    async def _recv_loop(self):
-        member = self.member
-
-        while ...:
-            await self._is_wanted.wait()
-
-            if member.uid >= self.uid:
-                # The other side will connect to me
-                await self._connected.wait()
-            elif not self._connected.is_set():
-                # I am responsible for doing the connect!
-                self._socket = self.socket('tcp')
+    async def _send_all(self, packets):
+        try:
+            encode, writer = self._codec.encode, self._writer
+            for packet in packets:
+                frame = encode(packet)
+                writer.write(frame)
+                self._sent.inc()
+                self._sent_bytes.inc(len(frame) + 4)
+            await writer.drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception(e)
+            self.close()
 
-                try:
-                    await self._socket.connect(self._address)
-                except (ConnectionResetError, ConnectionRefusedError, OSError):
-                    self.close()
-                    await self.sleep(self.CONNECTION_RETRY_RATE)
+    async def _send_framed(self, packets):
+        if self._replay:
+            # whatever the last connection could not send goes first
+            packets = list(self._replay) + packets
+            self._replay.clear()
+        writer = self._writer
+        if writer is None:
+            self._keep(packets)
+            return
+        start = time.time()
+        try:
+            for packet, codec, frame in packets:
+                if codec is not self._codec:
+                    # the connection was negotiated after this was queued
+                    try:
+                        frame = FrameWriter.frame(self._codec.encode(packet))
+                    except (TypeError, ValueError) as e:
+                        log.error('cannot encode %r for %s: %r',
+                                  packet, self.name, e)
+                        continue
+                writer.write_framed(frame)
+                self._sent.inc()
+                self._sent_bytes.inc(len(frame))
+            await writer.drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning('write to %s failed: %r', self.name, e)
+            self._keep(packets)
+            self.close()
+            return
+        tracer = self.member.tracer
+        if not tracer.rate:
+            # only the member that sampled a message traces its write
+            return
+        end = time.time()
+        for packet, _, _ in packets:
+            if len(packet) > 2:
+                tracer.span('write', packet[2], start, end, peer=self.name)
+                tracer.flow_start(packet[2], self.name, end)
+
+    def _keep(self, packets):
+        """Keep packets to send once reconnected, dropping the oldest."""
+        replay = self._replay
+        for packet in packets:
+            if len(replay) == replay.maxlen:
+                self.dropped += 1
+                if not replay.maxlen:
                     continue
+            replay.append(packet)
 
-                await self._send(member.name)
-                self._connected.set()
+    async def _recv_packet(self):
+        try:
+            frame = await self._reader.read()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception(e)
+            frame = None
+        if frame is None:
+            # Other side has been closed
+            self.close()
+            raise ValueError('connection closed')
+        self._received.inc()
+        self._received_bytes.inc(len(frame) + 4)
+        self._read_at = time.time()
+        return self._codec.decode(frame)
 
-            size = await self._recv(4)
-            if not size:
-                # Other side has been closed
-                continue
+    async def _recv_loop(self):
+        member = self.member
 
-            size = int.from_bytes(size, 'big')
-            data = await self._recv(size)
+        while ...:
+            if not self._connected.is_set():
+                if not self._is_wanted.is_set():
+                    self._set_state('disconnected')
+                    await self._is_wanted.wait()
+                    continue
+                self._set_state('connecting')
+                if member.uid >= self.uid:
+                    # The other side will connect to me
+                    await self._connected.wait()
+                elif not await self._connect():
+                    # I am responsible for doing the connect!
+                    self.failures += 1
+                    self._set_state('backoff')
+                    await self.sleep(self._reconnect_delay())
+                    continue
 
             try:
-                data = json.loads(data.decode())
-            except (UnicodeDecodeError, json.JSONDecodeError):
+                data = await self._recv_packet()
+            except ValueError:
                 continue
 
             try:
-                kind, packet = data
-            except ValueError:
+                # newer members may add fields after the packet
+                kind, packet, *extra = data
+            except (TypeError, ValueError):
                 continue
 
             handler = getattr(self, '_handle_' + kind, None)
-            if handler:
+            if not handler:
+                continue
+            if kind == 'send' and extra:
+                await handler(packet, self._received_trace(extra[0]))
+            else:
                 await handler(packet)
 
+    def _received_trace(self, trace):
+        """Record the arrival of a traced message, returns its context."""
+        try:
+            trace_id, origin, sent_at = trace
+            trace = [int(trace_id), str(origin), float(sent_at)]
+        except (TypeError, ValueError):
+            return None
+        tracer = self.member.tracer
+        tracer.flow_end(trace, self._read_at)
+        tracer.span('decode', trace, self._read_at, time.time(), peer=self.name)
+        return trace
+
+    async def _connect(self):
+        """Connect and exchange hellos, returns whether it worked."""
+        member = self.member
+        try:
+            self._conn = await asyncio.wait_for(
+                self.transport.connect(self._address),
+                self.CONNECT_TIMEOUT, loop=self.loop)
+        except (OSError, asyncio.TimeoutError) as e:
+            log.debug('could not connect to %s: %r', self.name, e)
+            return False
+        self._reader = self._conn.reader
+        self._writer = self._create_writer(self._conn)
+
+        hello = [member.name, member.codecs]
+        offer = None
+        if member.shared_memory:
+            offer = shm.offer(member.SHARED_MEMORY_SIZE)
+        if offer is not None:
+            hello.append(offer.describe())
+        await self._send(hello, flush=True)
+        try:
+            reply = await asyncio.wait_for(
+                self._recv_packet(), self.HANDSHAKE_TIMEOUT, loop=self.loop)
+            if isinstance(reply, str):
+                reply = reply, False
+            name, accepted = reply
+            self._codec = get_codec(name)
+        except (KeyError, TypeError, ValueError, asyncio.TimeoutError) as e:
+            log.debug('no hello from %s: %r', self.name, e)
+            if offer is not None:
+                offer.close()
+            self.close()
+            return False
+        if offer is not None:
+            if accepted and self._conn is not None:
+                self._use(offer.connect(self._conn, self.loop))
+            else:
+                offer.close()
+        if self._conn is None:
+            return False
+        self._connected.set()
+        self.failures = 0
+        self._set_state('connected')
+        return True
+
     def close(self):
-        if self._socket is not None:
+        if self._conn is not None:
             self._connected.clear()
-            self._socket.close()
-            self._socket = None
+            self._writer.close()
+            self._conn.close()
+            self._conn = None
+            # nothing will come back on this connection
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionLost(self.name))
+            self._pending.clear()
+            for task in self._serving.values():
+                task.cancel()
+            self._serving.clear()
+            self._reader = None
+            self._writer = None
+            self._codec = JsonCodec
+            if self.state == 'connected':
+                self._set_state('disconnected')
+
+    def stop(self):
+        super().stop()
+        # stop can be called from outside the event loop's thread
+        self.loop.call_soon_threadsafe(self._stopped)
+
+    def _stopped(self):
+        self.close()
+        self._set_state('stopped')
 
     def is_wanted(self, name):
         for want in self._wanted:
@@ -300,16 +1292,176 @@ class _Peer(_Component):
 
     @wanted.setter
     def wanted(self, names):
-        member = self.member
         self._wanted = names
-        if member.is_wanted(self.name) or self.is_wanted(member.name):
+        self.update_wanted()
+
+    def update_wanted(self):
+        member = self.member
+        if self.name in member._local_members():
+            # messages are handed over directly, see _LocalPeer
+            self._is_wanted.clear()
+        elif member.is_wanted(self.name) or self.is_wanted(member.name):
             self._is_wanted.set()
         else:
             self._is_wanted.clear()
 
 
+class _LocalPeer:
+    """
+    A member in the same process.
+
+    Messages are handed to the other member's handlers directly, without
+    being encoded, and only copied if the member has local_copy set.
+    Handler errors stay with the receiving member and failed requests
+    raise RemoteError, like they would over a connection.
+
+    Sends and publishes are queued for the other member, which handles
+    them in order in a task of its own, like the messages from a
+    connection. They never wait for its handlers, only for room in its
+    queue, which holds the other member's queue_size messages and is
+    handled with our queue_policy, like the outbox of a connection. When
+    the other member runs on another event loop, like in a ContextPool,
+    the message is queued from that loop's thread. Publishes that come
+    sooner than the other member's max_rate are dropped there too, so
+    nothing of the other member is touched from our thread.
+    """
+
+    def __init__(self, member, other):
+        self.member = member
+        self.other = other
+        self.name = other.name
+        self.loop = member.loop
+
+    def _copy(self, data):
+        return copy.deepcopy(data) if self.member.local_copy else data
+
+    async def _call(self, handle, *args):
+        # the other member's state is only touched on its own loop
+        other = self.other
+        policy = self.member.queue_policy
+        if other.loop is self.loop:
+            put = other._post(policy, handle, args)
+            if put is not None:
+                await put
+        elif policy == 'block':
+            await asyncio.wrap_future(
+                asyncio.run_coroutine_threadsafe(
+                    other._post_wait(handle, args), other.loop),
+                loop=self.loop)
+        else:
+            other.loop.call_soon_threadsafe(other._post, policy, handle, args)
+
+    async def send(self, endpoint, data):
+        trace = self.member.tracer.sample()
+        await self._call(
+            self.other._handle_send, self.member.name, endpoint,
+            self._copy(data), trace)
+        if trace is not None:
+            self.member.tracer.span(
+                'send {}/{}'.format(self.name, endpoint), trace, trace[2],
+                time.time())
+
+    async def publish(self, endpoint, data, trace=None):
+        await self._call(
+            self.other._handle_local_publish, self.member.name, endpoint,
+            self._copy(data), trace)
+
+    async def request(self, endpoint, *args, timeout=None, **kwargs):
+        future, = await self.request_many([(endpoint, args, kwargs)], timeout)
+        return future.result()
+
+    async def request_many(self, calls, timeout=None):
+        """Serve calls right away, see :meth:`_Peer.request_many`."""
+        start = time.monotonic()
+        tasks = []
+        for endpoint, args, kwargs in calls:
+            coro = self._serve(endpoint, args, kwargs)
+            if self.other.loop is self.loop:
+                task = self.loop.create_task(coro)
+            else:
+                task = asyncio.wrap_future(
+                    asyncio.run_coroutine_threadsafe(coro, self.other.loop),
+                    loop=self.loop)
+            task.add_done_callback(partial(
+                self.member._record_latency,
+                '{}/{}'.format(self.name, endpoint), start))
+            tasks.append(task)
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout, loop=self.loop)
+
+        futures = []
+        for task, (endpoint, _, _) in zip(tasks, calls):
+            if task.done():
+                futures.append(task)
+                continue
+            task.cancel()
+            future = self.loop.create_future()
+            future.set_exception(RequestTimeout(self.name, endpoint))
+            futures.append(future)
+        return futures
+
+    async def _serve(self, endpoint, args, kwargs):
+        args, kwargs = self._copy(args), self._copy(kwargs)
+        try:
+            result = await self.other._handle_request(endpoint, *args, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception(e)
+            raise RemoteError(
+                self.name, '{}: {}'.format(type(e).__name__, e)) from None
+        return self._copy(result)
+
+
 class _Gossiper(_Component):
+    """
+    Find peers by broadcasting over UDP.
+
+    Every member has a version number for its state, the names it wants
+    and the endpoints it subscribes to, that goes up whenever the state
+    changes. Heartbeats only carry the version. A change is broadcast as a
+    delta from the previous version, and anyone who missed a version pulls
+    the full state, which is then broadcast for everyone.
+
+    Heartbeats start fast and back off exponentially while nothing
+    changes, anything new, a peer joining, leaving or changing its state,
+    brings them back to the fast rate. Every heartbeat advertises how long
+    until the next one, a peer that misses several is evicted.
+
+    Packets are the key followed by a msgpack list of the kind of packet,
+    the sender's name, uid and TCP port, and then::
+
+        ['hb', ..., version, interval]
+        ['state', ..., version, wanted, subscriptions, options, rates]
+        ['delta', ..., base_version, version, wanted_added, wanted_removed,
+         subscriptions_added, subscriptions_removed, rates]
+        ['pull', ..., name_of_member_to_send_its_state]
+        ['fetch', ..., version]
+
+    rates maps subscriptions to the most messages per second the member
+    wants on them, it is left out when empty. In a delta it only holds
+    the rates that changed, None for a rate that was removed.
+
+    A packet that does not fit in one datagram is zlib compressed, endpoint
+    names compress well. If it still does not fit, or would inflate to more
+    than MAX_INFLATED, it is replaced by 'fetch', and whoever needs the
+    state gets it from the member's _Accepter over TCP. Anyone can send a
+    datagram, receivers never inflate one past MAX_INFLATED.
+    """
+
     GOSSIP_RATE = 0.1
+    MAX_GOSSIP_RATE = 1.0
+    GOSSIP_BACKOFF = 2
+    MISSED_HEARTBEATS = 3
+    FAILURE_TIMEOUT = 1.0
+
+    CODEC = MsgpackCodec
+    # stay below the usual MTU so datagrams are never fragmented
+    MAX_DATAGRAM = 1400
+    MAX_INFLATED = 4 * MAX_DATAGRAM
+    FETCH_TIMEOUT = 1.0
+    # hello that asks an _Accepter for the state instead of a connection
+    STATE_HELLO = ['state']
 
     def __init__(self, member, network, port, key=None):
         super().__init__(member)
@@ -323,96 +1475,435 @@ class _Gossiper(_Component):
         else:
             self._key = key
 
-        self._socket = self.socket('udp', bind=('', self._address[1]))
+        self._socket = self.transport.datagram(('', self._address[1]))
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
 
+        self.version = 0
+        self.interval = self.GOSSIP_RATE
+        self._state_queued = False
+
+        metrics = member.metrics
+        self._sent = metrics.counter('gossip.sent')
+        self._sent_bytes = metrics.counter('gossip.sent_bytes')
+        self._received = metrics.counter('gossip.received')
+        self._received_bytes = metrics.counter('gossip.received_bytes')
+        self._pulls = metrics.counter('gossip.pulls')
+        self._fetches = metrics.counter('gossip.fetches')
+        self._evictions = metrics.counter('gossip.evictions')
+        metrics.gauge('gossip.peers', member._peers.__len__)
+        metrics.gauge('gossip.interval', lambda: self.interval)
+
         self.create_daemon(self._recv_loop)
         self.create_daemon(self._send_loop)
+        self.create_daemon(self._reap_loop)
 
-    async def _recv_loop(self):
+    @property
+    def key(self):
+        return self._key
+
+    def _header(self, kind):
         member = self.member
+        return [kind, member.name, member.uid, member._accepter.port]
+
+    def changed(self, wanted_added=(), wanted_removed=(),
+                subscriptions_added=(), subscriptions_removed=(), rates=None):
+        """Bump the state version and broadcast what changed."""
+        base = self.version
+        self.version += 1
+        self.interval = self.GOSSIP_RATE
+        if self._running_tasks is None:
+            # nobody has seen the old version yet
+            return
+        packet = self._header('delta') + [
+            base, self.version,
+            list(wanted_added), list(wanted_removed),
+            list(subscriptions_added), list(subscriptions_removed),
+        ]
+        if rates:
+            packet.append(dict(rates))
+        self.create_task(self._send, packet)
+
+    def _encode(self, data):
+        payload = self.CODEC.encode(data)
+        if (len(self._key) + len(payload) > self.MAX_DATAGRAM
+                and len(payload) <= self.MAX_INFLATED):
+            # a zlib stream starts with 0x78, which no encoded list does
+            payload = zlib.compress(payload)
+        return self._key + payload
+
+    def _decode(self, payload):
+        if payload[:1] == b'\x78':
+            inflater = zlib.decompressobj()
+            try:
+                payload = inflater.decompress(payload, self.MAX_INFLATED)
+            except zlib.error as e:
+                raise ValueError(e)
+            if inflater.unconsumed_tail:
+                raise ValueError('packet inflates past MAX_INFLATED')
+        return self.CODEC.decode(payload)
+
+    async def _send(self, data):
+        packet = self._encode(data)
+        if len(packet) > self.MAX_DATAGRAM:
+            packet = self._encode(self._header('fetch') + [self.version])
+        try:
+            await self._socket.sendto(packet, self._address)
+        except OSError as e:
+            log.exception(e)
+            return
+        self._sent.inc()
+        self._sent_bytes.inc(len(packet))
+
+    def _queue_state(self):
+        # many members may pull at once, they all get the same broadcast
+        if not self._state_queued:
+            self._state_queued = True
+            self.create_task(self._send_state)
+
+    def state(self):
+        """The 'state' packet with the member's full state."""
+        member = self.member
+        packet = self._header('state') + [
+            self.version,
+            list(member._wanted),
+            list(member._subscriptions),
+            {'multicast': member._multicaster is not None},
+        ]
+        if member._rates:
+            packet.append(dict(member._rates))
+        return packet
+
+    async def _send_state(self):
+        self._state_queued = False
+        await self._send(self.state())
+
+    def _pull(self, peer):
+        now = time.monotonic()
+        if now - peer.pulled < self.GOSSIP_RATE:
+            return
+        peer.pulled = now
+        self._pulls.inc()
+        self.probe(peer.name)
+
+    def _fetch(self, peer):
+        now = time.monotonic()
+        if now - peer.pulled < self.GOSSIP_RATE:
+            return
+        peer.pulled = now
+        self._fetches.inc()
+        self.create_task(self._fetch_state, peer.address)
+
+    async def _fetch_state(self, address):
+        try:
+            conn = await asyncio.wait_for(
+                self.transport.connect(address),
+                self.FETCH_TIMEOUT, loop=self.loop)
+        except (OSError, asyncio.TimeoutError) as e:
+            log.warning('could not fetch state from %s: %r', address, e)
+            return
+        writer = conn.writer()
+        try:
+            await writer.send(JsonCodec.encode(self.STATE_HELLO))
+            await writer.flush()
+            frame = await asyncio.wait_for(
+                conn.reader.read(), self.FETCH_TIMEOUT, loop=self.loop)
+            if frame is None:
+                raise ConnectionResetError('connection closed')
+            self._dispatch(self.CODEC.decode(frame), address[0])
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            log.warning('could not fetch state from %s: %r', address, e)
+        finally:
+            writer.close()
+            conn.close()
+
+    def probe(self, name):
+        """Ask the member called name to broadcast its state."""
+        self.create_task(self._send, self._header('pull') + [name])
+
+    def _peer(self, name, uid, address, interval=None):
+        member = self.member
+        peer = member._peers.get(name)
+        if peer is not None and peer.uid != uid:
+            # the device restarted
+            peer.stop()
+            peer = None
+        if peer is None:
+            peer = member._peers[name] = _Peer(member, name, uid)
+            peer.address = address
+            peer.start()
+            member._discovered(peer)
+            # let the newcomer know about us without waiting a heartbeat
+            self.interval = self.GOSSIP_RATE
+            self._queue_state()
+        else:
+            peer.address = address
+        expires = time.monotonic() + max(
+            (interval or self.GOSSIP_RATE) * self.MISSED_HEARTBEATS,
+            self.FAILURE_TIMEOUT)
+        # only heartbeats say when the next one is due
+        if interval is not None or peer.expires is None or expires > peer.expires:
+            peer.expires = expires
+        return peer
+
+    def _evict(self, peer):
+        log.info('peer %s stopped gossiping', peer.name)
+        del self.member._peers[peer.name]
+        peer.stop()
+        self._evictions.inc()
+        self.member.metrics.remove('peer.{}.'.format(peer.name))
+        self.interval = self.GOSSIP_RATE
+
+    async def _recv_loop(self):
+        klen = len(self._key)
         while ...:
-            packet, source = await self._socket.recvfrom(1024)
+            packet, source = await self._socket.recvfrom(65535)
 
-            klen = len(self._key)
-            if len(packet) < klen:
-                continue
-            key, packet = packet[:klen], packet[klen:]
-            if key != self._key:
+            if len(packet) < klen or packet[:klen] != self._key:
                 continue
+            self._received.inc()
+            self._received_bytes.inc(len(packet))
 
             try:
-                data = json.loads(packet.decode())
-            except (UnicodeDecodeError, json.JSONDecodeError):
+                data = self._decode(packet[klen:])
+            except ValueError:
                 continue
 
-            try:
-                name, uid, port, wanted, subscriptions = data
-                address = source[0], port
-                subscriptions = set(subscriptions)
-                wanted = set(wanted)
-            except (TypeError, ValueError):
-                continue
+            self._dispatch(data, source[0])
 
-            if uid == member.uid:
-                continue
+    def _dispatch(self, data, host):
+        try:
+            kind, name, uid, port = data[:4]
+            handler = self._handlers[kind]
+            address = host, int(port)
+        except (TypeError, ValueError, KeyError):
+            return
 
-            try:
-                peer = member._peers[name]
-            except KeyError:
-                peer = member._peers[name] = _Peer(member, name, uid)
+        if uid == self.member.uid:
+            return
 
-            peer.address = address
-            peer._subscriptions = subscriptions
-            peer.wanted = wanted
-            peer.start()
+        try:
+            handler(self, name, uid, address, *data[4:])
+        except (TypeError, ValueError):
+            pass
+
+    def _handle_hb(self, name, uid, address, version, interval=None):
+        peer = self._peer(name, uid, address, float(interval or 0) or None)
+        if peer.version != version:
+            self._pull(peer)
+
+    def _handle_state(self, name, uid, address, version, wanted,
+                      subscriptions, options=None, rates=None):
+        peer = self._peer(name, uid, address)
+        if isinstance(options, dict):
+            peer.multicast = bool(options.get('multicast'))
+        peer.subscriptions = set(subscriptions)
+        peer.rates = {
+            endpoint: float(rate) for endpoint, rate in dict(rates or {}).items()
+            if rate
+        }
+        peer.wanted = set(wanted)
+        peer.version = version
+
+    def _handle_delta(self, name, uid, address, base, version,
+                      wanted_added, wanted_removed,
+                      subscriptions_added, subscriptions_removed, rates=None):
+        peer = self._peer(name, uid, address)
+        if peer.version != base:
+            if peer.version != version:
+                self._pull(peer)
+            return
+        peer_rates = dict(peer.rates)
+        for endpoint, rate in dict(rates or {}).items():
+            if rate:
+                peer_rates[endpoint] = float(rate)
+            else:
+                peer_rates.pop(endpoint, None)
+        for endpoint in subscriptions_removed:
+            peer_rates.pop(endpoint, None)
+        subscriptions = peer.subscriptions
+        subscriptions.difference_update(subscriptions_removed)
+        subscriptions.update(subscriptions_added)
+        peer.subscriptions = subscriptions
+        peer.rates = peer_rates
+        peer.wanted = (peer.wanted - set(wanted_removed)) | set(wanted_added)
+        peer.version = version
+
+    def _handle_pull(self, name, uid, address, target):
+        if target == self.member.name:
+            # whoever asked is about to talk to us
+            self._peer(name, uid, address)
+            self._queue_state()
+
+    def _handle_fetch(self, name, uid, address, version):
+        peer = self._peer(name, uid, address)
+        if peer.version != version:
+            self._fetch(peer)
+
+    _handlers = {
+        'hb': _handle_hb,
+        'state': _handle_state,
+        'delta': _handle_delta,
+        'pull': _handle_pull,
+        'fetch': _handle_fetch,
+    }
 
     async def _send_loop(self):
+        # introduce ourselves with the full state
+        await self._send_state()
+        while ...:
+            interval = self.interval
+            self.interval = min(
+                interval * self.GOSSIP_BACKOFF, self.MAX_GOSSIP_RATE)
+            await self.sleep(interval)
+            await self._send(
+                self._header('hb') + [self.version, self.interval])
+
+    def reap(self):
+        """Evict peers that missed too many heartbeats."""
+        now = time.monotonic()
+        for peer in list(self.member._peers.values()):
+            if peer.expires is not None and peer.expires < now:
+                self._evict(peer)
+
+    async def _reap_loop(self):
+        while ...:
+            await self.sleep(self.GOSSIP_RATE)
+            self.reap()
+
+
+class _Multicaster(_Component):
+    """
+    Publish best effort messages to all subscribers with one datagram.
+
+    Every member with multicast enabled joins the group derived from the
+    gossip key. Packets are the key followed by a msgpack list::
+
+        [name, uid, sequence, endpoint, data]
+
+    The sequence goes up by one with every datagram a member sends, so
+    receivers can count the ones that never arrived.
+    """
+
+    CODEC = MsgpackCodec
+    # a fragmented datagram is lost with any of its fragments, larger
+    # messages go over the peer connections
+    MAX_DATAGRAM = _Gossiper.MAX_DATAGRAM
+
+    def __init__(self, member, key):
+        super().__init__(member)
+        self._key = key
+        self._address = key_to_multicast(key)
+        self._socket = self.transport.multicast(self._address)
+        self._sequence = 0
+        # last sequence received from every sender
+        self._received = {}
+        self.stats = {'sent': 0, 'received': 0, 'lost': 0, 'late': 0}
+
+        self.create_daemon(self._recv_loop)
+
+    def encode(self, endpoint, data):
+        """The datagram for a message, or None if it is too large."""
         member = self.member
+        packet = self._key + self.CODEC.encode(
+            [member.name, member.uid, self._sequence + 1, endpoint, data])
+        if len(packet) > self.MAX_DATAGRAM:
+            return None
+        self._sequence += 1
+        return packet
+
+    async def send(self, packet):
+        try:
+            await self._socket.sendto(packet, self._address)
+        except OSError as e:
+            log.exception(e)
+        else:
+            self.stats['sent'] += 1
+
+    def _track(self, uid, sequence):
+        last = self._received.get(uid)
+        if last is not None and sequence <= last:
+            self.stats['late'] += 1
+            return False
+        if last is not None:
+            self.stats['lost'] += sequence - last - 1
+        self._received[uid] = sequence
+        self.stats['received'] += 1
+        return True
+
+    async def _recv_loop(self):
+        member = self.member
+        klen = len(self._key)
         while ...:
-            data = (
-                member.name,
-                member.uid,
-                member._accepter.port,
-                tuple(member._wanted),
-                tuple(member._subscriptions),
-            )
-            packet = self._key + json.dumps(data).encode()
+            packet, _ = await self._socket.recvfrom(65535)
+            if packet[:klen] != self._key:
+                continue
             try:
-                await self._socket.sendto(packet, self._address)
-            except OSError as e:
-                log.exception(e)
-            await self.sleep(self.GOSSIP_RATE)
+                _, uid, sequence, endpoint, data = self.CODEC.decode(packet[klen:])
+                if uid == member.uid or not self._track(uid, int(sequence)):
+                    continue
+            except (ValueError, TypeError):
+                continue
+            await member._handle_publish(endpoint, data)
 
 
 class _Accepter(_Component):
+    # seconds a new connection has to send its hello
+    HANDSHAKE_TIMEOUT = 1.0
+
     def __init__(self, member):
         super().__init__(member)
-        self._socket = self.socket('tcp', bind=('', 0))
-        self._socket.listen()
+        self._listener = self.transport.listen(('', 0))
 
         self.create_daemon(self._accept_loop)
 
     @property
     def port(self):
-        return self._socket.getsockname()[1]
+        return self._listener.port
 
     async def _accept_loop(self):
-        member = self.member
         while ...:
-            conn, _ = await self._socket.accept()
-            size = await conn.recv(4)
-            size = int.from_bytes(size, 'big')
-            name = await conn.recv(size)
+            conn = await self._listener.accept()
+            # a slow hello must not hold up everyone else
+            self.create_task(self._handshake, conn)
 
-            try:
-                name = json.loads(name.decode())
-                peer = member._peers[name]
-            except (UnicodeDecodeError, KeyError, json.JSONDecodeError):
-                conn.close()
-                continue
+    async def _handshake(self, conn):
+        member = self.member
+        try:
+            frame = await asyncio.wait_for(
+                conn.reader.read(), self.HANDSHAKE_TIMEOUT, loop=self.loop)
+            hello = JsonCodec.decode(frame)
+            if hello == _Gossiper.STATE_HELLO:
+                await self._send_state(conn)
+                return
+            shared_memory = None
+            if isinstance(hello, str):
+                # older peers only send their name and speak json
+                name, offered, reply = hello, [JsonCodec.name], False
+            elif len(hello) > 2:
+                # the connecting side offers shared memory
+                (name, offered, shared_memory), reply = hello, True
+            else:
+                (name, offered), reply = hello, True
+            peer = member._peers[name]
+        except (ValueError, KeyError, TypeError, OSError,
+                asyncio.TimeoutError):
+            conn.close()
+            return
 
-            await peer.accept(conn)
+        await peer.accept(conn, member.negotiate(offered), reply=reply,
+                          shared_memory=shared_memory)
+
+    async def _send_state(self, conn):
+        gossiper = self.member._gossiper
+        writer = conn.writer()
+        try:
+            await writer.send(gossiper.CODEC.encode(gossiper.state()))
+            await writer.flush()
+        except OSError as e:
+            log.warning('could not send state: %r', e)
+        finally:
+            writer.close()
+            conn.close()
 
 
 if __name__ == '__main__':
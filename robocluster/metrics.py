@@ -0,0 +1,182 @@
+"""Measurements for robocluster."""
+
+
+__all__ = [
+    'Counter',
+    'Gauge',
+    'Histogram',
+    'Registry',
+]
+
+
+class Counter:
+    """A count that only goes up."""
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def summary(self):
+        return self.value
+
+
+class Gauge:
+    """
+    A value that goes up and down.
+
+    Given a function, the value is whatever it returns when read, which
+    costs nothing until someone looks.
+    """
+
+    def __init__(self, function=None):
+        self.function = function
+        self._value = 0
+
+    @property
+    def value(self):
+        if self.function is not None:
+            return self.function()
+        return self._value
+
+    def set(self, value):
+        self._value = value
+
+    def summary(self):
+        return self.value
+
+
+class Histogram:
+    """
+    Distribution of recorded values in log-linear buckets.
+
+    Like HdrHistogram, values are kept to a fixed number of significant
+    bits, so recording is constant time and memory only grows with the
+    range of values seen, never with the number of values.
+    """
+
+    def __init__(self, unit=1e-6, precision=5):
+        """
+        Initialize the histogram.
+
+        Args:
+            unit (float): Resolution of recorded values, the default keeps
+                seconds to the microsecond.
+            precision (int): Significant bits kept for every value, the
+                relative error of percentiles is at most 2 ** -precision.
+        """
+        self.unit = unit
+        self.precision = precision
+        self._buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        """Add a value to the histogram."""
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        scaled = int(value / self.unit)
+        if scaled < 0:
+            scaled = 0
+        shift = max(scaled.bit_length() - self.precision, 0)
+        key = shift, scaled >> shift
+        self._buckets[key] = self._buckets.get(key, 0) + 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, percent):
+        """Value below which percent of the recorded values fall."""
+        if not self.count:
+            return None
+        rank = self.count * percent / 100
+        seen = 0
+        for (shift, mantissa), count in sorted(
+                self._buckets.items(), key=lambda item: item[0][1] << item[0][0]):
+            seen += count
+            if seen >= rank:
+                low = mantissa << shift
+                middle = low + ((1 << shift) - 1) / 2
+                return min(max(middle * self.unit, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        """The count, min, max, mean and common percentiles as a dictionary."""
+        return {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class Registry:
+    """
+    Metrics by name.
+
+    Names are dotted paths like 'peer.rover.sent'. Asking for a metric
+    that exists returns it, so code that updates a metric can look it up
+    once and keep it.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _get(self, name, cls, *args, **kwargs):
+        try:
+            metric = self._metrics[name]
+        except KeyError:
+            metric = self._metrics[name] = cls(*args, **kwargs)
+            return metric
+        if not isinstance(metric, cls):
+            raise TypeError('{} is a {}, not a {}'.format(
+                name, type(metric).__name__, cls.__name__))
+        return metric
+
+    def counter(self, name):
+        """The Counter called name."""
+        return self._get(name, Counter)
+
+    def gauge(self, name, function=None):
+        """The Gauge called name, function replaces the one it had."""
+        gauge = self._get(name, Gauge)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, **kwargs):
+        """The Histogram called name, kwargs are used to create it."""
+        return self._get(name, Histogram, **kwargs)
+
+    def remove(self, prefix):
+        """Forget every metric whose name starts with prefix."""
+        for name in [name for name in self._metrics if name.startswith(prefix)]:
+            del self._metrics[name]
+
+    def items(self, prefix=''):
+        """(name, metric) pairs, for names that start with prefix."""
+        # metrics may be added by another thread while we look
+        return [
+            (name, metric) for name, metric in list(self._metrics.items())
+            if name.startswith(prefix)
+        ]
+
+    def snapshot(self, prefix=''):
+        """
+        The current value of every metric as a dictionary.
+
+        Counters and gauges give their value, histograms their summary.
+        """
+        return {name: metric.summary() for name, metric in self.items(prefix)}
@@ -1,15 +1,25 @@
 import asyncio
+import hashlib
 import json
 import os
 import socket as socket_m
 import struct
+from contextlib import suppress
 from functools import partial, wraps
 
 
 __all__ = [
     'AsyncSocket',
+    'FrameReader',
+    'FrameWriter',
+    'key_to_multicast',
 ]
 
+try:
+    IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
 
 class AsyncSocket:
     """Socket wrapper for asyncio."""
@@ -17,6 +27,7 @@ class AsyncSocket:
     def __init__(self, *args, socket=None, loop=None, **kwargs):
         self._loop = loop if loop else asyncio.get_event_loop()
         self._socket = socket if socket else socket_m.socket(*args, **kwargs)
+        self._waiting = set()
         # TODO: ensure this never changes, async sockets cannot be blocking
         self.setblocking(False)
 
@@ -48,6 +59,20 @@ class AsyncSocket:
         #       send methods due to it's use of os.sendfile.
         raise NotImplementedError
 
+    @wraps(socket_m.socket.close)
+    def close(self):
+        fd = self._socket.fileno()
+        if fd >= 0:
+            # the fd can be reused as soon as it is closed, so it must not
+            # stay registered with the event loop
+            self._loop.remove_reader(fd)
+            self._loop.remove_writer(fd)
+        self._socket.close()
+        for future in self._waiting:
+            if not future.done():
+                future.set_exception(ConnectionAbortedError('socket closed'))
+        self._waiting.clear()
+
     @wraps(socket_m.socket.dup)
     def dup(self):
         return self.__class__.from_socket(self._socket.dup(), loop=self._loop)
@@ -71,6 +96,8 @@ class AsyncSocket:
     def _wrap_io(self, func, adder, remover):
         fd = self.fileno()
         future = self._loop.create_future()
+        self._waiting.add(future)
+        future.add_done_callback(self._waiting.discard)
         @wraps(func)
         def wrapper(*args, **kwargs):
             remover(fd)
@@ -88,4 +115,239 @@ class AsyncSocket:
         return wrapper
 
 
-key_to_multicast = None
+class FrameReader:
+    """
+    Read length prefixed frames from an AsyncSocket.
+
+    Each frame is a 4 byte big endian size followed by size bytes.
+    Data is read with recv_into into a reusable buffer, as much as the
+    kernel has available, so several frames can be parsed out of one
+    system call. Only a trailing partial frame is ever moved, to the
+    front of the buffer, and the buffer only grows when a single frame
+    does not fit in it.
+    """
+
+    BUFFER_SIZE = 64 * 1024
+    MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+    _header = struct.Struct('>I')
+
+    def __init__(self, socket, size=None):
+        self._socket = socket
+        self._buffer = bytearray(size or self.BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+    async def read(self):
+        """
+        Read the next frame.
+
+        This method is a coroutine.
+
+        Returns:
+            memoryview: The frame, only valid until the next call to read.
+                None when the other side closed the connection.
+        """
+        while ...:
+            available = self._end - self._start
+            if available >= 4:
+                size = self._header.unpack_from(self._buffer, self._start)[0]
+                if available - 4 >= size:
+                    start = self._start + 4
+                    self._start = start + size
+                    return self._view[start:self._start]
+                needed = size + 4
+                if needed > self.MAX_FRAME_SIZE:
+                    # a broken or hostile peer, nothing after this is framed
+                    self._socket.close()
+                    raise ConnectionError('frame too large: {}'.format(size))
+            else:
+                needed = 4
+
+            self._reserve(needed)
+            count = await self._socket.recv_into(self._view[self._end:])
+            if not count:
+                return None
+            self._end += count
+
+    def _reserve(self, needed):
+        """Make room after the unread data for a frame of needed bytes."""
+        available = self._end - self._start
+        if not available:
+            self._start = self._end = 0
+        if self._start + needed <= len(self._buffer):
+            return
+        if needed <= len(self._buffer):
+            # compact, frames handed out before this are invalidated
+            self._buffer[:available] = self._buffer[self._start:self._end]
+        else:
+            size = max(needed, 2 * len(self._buffer))
+            buffer = bytearray(size)
+            buffer[:available] = self._buffer[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        self._start = 0
+        self._end = available
+
+
+class FrameWriter:
+    """
+    Write length prefixed frames to an AsyncSocket.
+
+    Frames are queued and written together with one sendmsg call where
+    the platform supports it, and writes are retried until every byte is
+    out. When frames are flushed depends on delay and threshold:
+
+    - delay 0: every frame is flushed as soon as it is sent.
+    - otherwise queued frames are flushed delay seconds after the
+      first one, or as soon as threshold bytes are queued.
+
+    Since frames are coalesced here, Nagle's algorithm is disabled on
+    the socket.
+    """
+
+    _header = struct.Struct('>I')
+
+    def __init__(self, socket, loop=None, delay=0, threshold=0, on_error=None):
+        self._socket = socket
+        self._loop = loop if loop else asyncio.get_event_loop()
+        self.delay = delay
+        self.threshold = threshold
+        self._on_error = on_error
+
+        self._buffers = []
+        self._size = 0
+        self._flushing = None
+        self._handle = None
+        self._sendmsg = hasattr(socket_m.socket, 'sendmsg')
+
+        with suppress(OSError, AttributeError):
+            socket.setsockopt(socket_m.IPPROTO_TCP, socket_m.TCP_NODELAY, 1)
+
+    @property
+    def pending(self):
+        """Number of bytes waiting to be written."""
+        return self._size
+
+    @classmethod
+    def frame(cls, data):
+        """Prefix data with its size, ready for write_framed."""
+        return cls._header.pack(len(data)) + data
+
+    def write(self, frame):
+        """Queue a frame without flushing it."""
+        header = self._header.pack(len(frame))
+        self._buffers.append(header)
+        self._buffers.append(frame)
+        self._size += len(header) + len(frame)
+
+    def write_framed(self, data):
+        """
+        Queue data that already starts with its size.
+
+        The same framed data can be shared between many writers.
+        """
+        self._buffers.append(data)
+        self._size += len(data)
+
+    async def send(self, frame):
+        """
+        Queue a frame and flush according to the flush policy.
+
+        This method is a coroutine.
+        """
+        self.write(frame)
+        await self.drain()
+
+    async def drain(self):
+        """
+        Flush queued frames according to the flush policy.
+
+        This method is a coroutine.
+        """
+        if not self._buffers:
+            return
+        if not self.delay or self._size >= self.threshold:
+            await self.flush()
+        elif self._handle is None:
+            self._handle = self._loop.call_later(self.delay, self._flush_later)
+
+    def _flush_later(self):
+        self._handle = None
+        self._loop.create_task(self._flush_background())
+
+    async def _flush_background(self):
+        try:
+            await self.flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:  # pylint: disable=W0703
+            if self._on_error is None:
+                raise
+            self._on_error(e)
+
+    async def flush(self):
+        """
+        Write every queued frame.
+
+        This method is a coroutine.
+        """
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        while self._buffers:
+            if self._flushing is not None:
+                # someone else is writing, they may not pick up our frames
+                await asyncio.shield(self._flushing, loop=self._loop)
+                continue
+            self._flushing = self._loop.create_future()
+            try:
+                buffers, self._buffers = self._buffers, []
+                self._size = 0
+                await self._write(buffers)
+            finally:
+                self._flushing.set_result(None)
+                self._flushing = None
+
+    async def _write(self, buffers):
+        while buffers:
+            batch = buffers[:IOV_MAX]
+            if self._sendmsg:
+                sent = await self._socket.sendmsg(batch)
+            else:
+                sent = await self._socket.send(b''.join(batch))
+            # drop everything that was fully written
+            done = 0
+            for buffer in batch:
+                if sent < len(buffer):
+                    break
+                sent -= len(buffer)
+                done += 1
+            del buffers[:done]
+            if sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
+
+    def close(self):
+        """Drop queued frames and stop any scheduled flush."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._buffers = []
+        self._size = 0
+
+
+def key_to_multicast(key):
+    """
+    Derive a multicast group address from a key.
+
+    The group is in the organization local scope, 239.255.0.0/16, and the
+    port is never a privileged one.
+
+    Returns:
+        tuple: The (host, port) address.
+    """
+    digest = hashlib.sha256(key).digest()
+    host = '239.255.{}.{}'.format(digest[0], digest[1])
+    port = 1024 + int.from_bytes(digest[2:4], 'big') % (65536 - 1024)
+    return host, port
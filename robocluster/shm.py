@@ -0,0 +1,424 @@
+"""
+Shared memory connections between members on the same host.
+
+Once two members on the same host have connected over TCP, the connecting
+side can offer a pair of ring buffers in memory mapped files, one for each
+direction. Each ring has a named pipe as its doorbell, a byte is written to
+it to wake the other side whenever there is something new to read or room
+to write again. Frames then never go through the network stack.
+
+The ring counters are plain memory, Python has no way to put a barrier
+between writing the data and moving the counter. That holds on x86, where
+stores are seen in order, but not on weaker memory models like ARM, which
+is why members only use shared memory when asked to.
+
+The TCP connection stays open but idle, it tells either side when the
+other one goes away. When shared memory is not available, or the other
+side is on another host, the members just keep using TCP.
+"""
+
+import binascii
+import errno
+import logging
+import mmap
+import os
+import socket
+import struct
+import tempfile
+
+from .net import FrameReader, FrameWriter
+
+
+__all__ = [
+    'SharedMemoryConnection',
+    'accept',
+    'available',
+    'host_id',
+    'offer',
+]
+
+
+log = logging.getLogger(__name__)
+
+
+def available():
+    """Check if shared memory connections work on this platform."""
+    return hasattr(os, 'mkfifo') and hasattr(os, 'O_NONBLOCK')
+
+
+def host_id():
+    """An identifier that is the same for every process on this host."""
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            boot_id = f.read().strip()
+    except OSError:
+        boot_id = ''
+    return '{}/{}'.format(socket.gethostname(), boot_id)
+
+
+def _directory():
+    # /dev/shm is memory backed, files there never touch a disk
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+class Ring:
+    """
+    A single producer, single consumer byte ring in a memory mapped file.
+
+    The file starts with a header holding the total number of bytes ever
+    written and read and a flag for a closed ring. Only the writer moves
+    the write count and only the reader moves the read count.
+    """
+
+    HEADER_SIZE = 64
+    _count = struct.Struct('=Q')
+    WRITTEN, READ, CLOSED = 0, 8, 16
+
+    def __init__(self, fd, size):
+        self.size = size
+        self._map = mmap.mmap(fd, self.HEADER_SIZE + size)
+        self._data = memoryview(self._map)[self.HEADER_SIZE:]
+
+    @classmethod
+    def create(cls, path, size):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            os.ftruncate(fd, cls.HEADER_SIZE + size)
+            return cls(fd, size)
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def open(cls, path, size):
+        fd = os.open(path, os.O_RDWR)
+        try:
+            if os.fstat(fd).st_size != cls.HEADER_SIZE + size:
+                raise OSError(errno.EINVAL, 'ring has the wrong size', path)
+            return cls(fd, size)
+        finally:
+            os.close(fd)
+
+    def _get(self, offset):
+        return self._count.unpack_from(self._map, offset)[0]
+
+    def _set(self, offset, value):
+        self._count.pack_into(self._map, offset, value)
+
+    def flag(self, offset):
+        return bool(self._map[offset])
+
+    def set_flag(self, offset, value):
+        self._map[offset] = int(value)
+
+    @property
+    def used(self):
+        return self._get(self.WRITTEN) - self._get(self.READ)
+
+    def write(self, data):
+        """Copy as much of data as fits, returns the number of bytes copied."""
+        written = self._get(self.WRITTEN)
+        count = min(self.size - (written - self._get(self.READ)), len(data))
+        if count <= 0:
+            return 0
+        start = written % self.size
+        first = min(count, self.size - start)
+        self._data[start:start + first] = data[:first]
+        if count > first:
+            self._data[:count - first] = data[first:count]
+        self._set(self.WRITTEN, written + count)
+        return count
+
+    def read_into(self, view):
+        """Copy as much as is available into view, returns the number of bytes."""
+        read = self._get(self.READ)
+        count = min(self._get(self.WRITTEN) - read, len(view))
+        if count <= 0:
+            return 0
+        start = read % self.size
+        first = min(count, self.size - start)
+        view[:first] = self._data[start:start + first]
+        if count > first:
+            view[first:count] = self._data[:count - first]
+        self._set(self.READ, read + count)
+        return count
+
+    def close(self):
+        self._data.release()
+        self._map.close()
+
+
+class Channel:
+    """
+    A byte stream over two rings, with the recv_into of a socket.
+
+    Writing rings the other side's doorbell once per sendall, and before
+    waiting for room, reading rings it after taking anything out. The pipe
+    holds the byte until it is read, so there is no flag to check and set
+    that a wakeup could slip through, and nothing needs polling.
+    """
+
+    def __init__(self, inbound, outbound, bell_in, bell_out, loop):
+        self._inbound = inbound
+        self._outbound = outbound
+        self._bell_in = bell_in
+        self._bell_out = bell_out
+        self._loop = loop
+        self._waiters = []
+        self.closed = False
+        loop.add_reader(bell_in, self._on_bell)
+
+    def _on_bell(self):
+        try:
+            while os.read(self._bell_in, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.close()
+        self._wakeup()
+
+    def _wakeup(self):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _ring(self):
+        try:
+            os.write(self._bell_out, b'\0')
+        except BlockingIOError:
+            # the pipe is full, the other side has plenty of wakeups
+            pass
+
+    async def _wait(self):
+        waiter = self._loop.create_future()
+        self._waiters.append(waiter)
+        await waiter
+
+    def _is_closed(self):
+        return (self.closed
+                or self._inbound.flag(Ring.CLOSED)
+                or self._outbound.flag(Ring.CLOSED))
+
+    async def recv_into(self, view):
+        """
+        Read into view.
+
+        This method is a coroutine.
+
+        Returns:
+            int: Number of bytes read, 0 once the channel is closed.
+        """
+        ring = self._inbound
+        while ...:
+            if self.closed:
+                return 0
+            count = ring.read_into(view)
+            if count:
+                # there is room now, in case the writer is waiting for it
+                self._ring()
+                return count
+            if self._is_closed():
+                return 0
+            await self._wait()
+
+    async def sendall(self, buffers):
+        """
+        Write every buffer.
+
+        This method is a coroutine.
+        """
+        ring = self._outbound
+        written = False
+        for buffer in buffers:
+            view = memoryview(buffer).cast('B')
+            while view:
+                if self._is_closed():
+                    raise ConnectionResetError('shared memory channel closed')
+                count = ring.write(view)
+                if count:
+                    view = view[count:]
+                    written = True
+                    continue
+                if written:
+                    # the ring is full, the reader has to empty it first
+                    self._ring()
+                    written = False
+                await self._wait()
+        if written:
+            self._ring()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._loop.remove_reader(self._bell_in)
+        for ring in (self._inbound, self._outbound):
+            ring.set_flag(Ring.CLOSED, True)
+        self._ring()
+        self._wakeup()
+        for fd in (self._bell_in, self._bell_out):
+            os.close(fd)
+        self._inbound.close()
+        self._outbound.close()
+
+
+class ChannelWriter(FrameWriter):
+    """FrameWriter that writes to a shared memory Channel."""
+
+    def __init__(self, channel, **kwargs):
+        self._channel = channel
+        super().__init__(channel, **kwargs)
+
+    async def _write(self, buffers):
+        await self._channel.sendall(buffers)
+
+
+class SharedMemoryConnection:
+    """
+    A framed connection over a shared memory Channel.
+
+    The connection it replaces is kept to notice the other side going away.
+    """
+
+    def __init__(self, conn, channel, loop):
+        self._conn = conn
+        self.channel = channel
+        self.loop = loop
+        self.reader = FrameReader(channel)
+        self._watcher = loop.create_task(self._watch())
+
+    async def _watch(self):
+        try:
+            # nothing is sent over the connection any more
+            await self._conn.reader.read()
+        except Exception:  # pylint: disable=W0703
+            pass
+        self.channel.close()
+
+    def writer(self, **kwargs):
+        return ChannelWriter(self.channel, loop=self.loop, **kwargs)
+
+    def close(self):
+        self._watcher.cancel()
+        self.channel.close()
+        self._conn.close()
+
+
+def _paths(prefix):
+    return {
+        name: '{}.{}'.format(prefix, name)
+        for name in ('a.ring', 'b.ring', 'a.bell', 'b.bell')
+    }
+
+
+def _open_bell(path):
+    # opening for reading and writing never blocks waiting for the other end
+    return os.open(path, os.O_RDWR | os.O_NONBLOCK)
+
+
+class Offer:
+    """Rings created by the connecting side, until the other side answers."""
+
+    def __init__(self, size):
+        self.size = size
+        self.prefix = os.path.join(_directory(), 'robocluster-{}'.format(
+            binascii.hexlify(os.urandom(8)).decode()))
+        self._paths = _paths(self.prefix)
+        self._rings = []
+        self._bells = []
+        try:
+            # the connecting side writes ring a and reads ring b
+            for name in ('a', 'b'):
+                self._rings.append(
+                    Ring.create(self._paths[name + '.ring'], size))
+                os.mkfifo(self._paths[name + '.bell'], 0o600)
+                self._bells.append(_open_bell(self._paths[name + '.bell']))
+        except BaseException:
+            self.close()
+            raise
+
+    def describe(self):
+        """What the other side needs to open the rings, for the hello."""
+        return {'host': host_id(), 'path': self.prefix, 'size': self.size}
+
+    def connect(self, conn, loop):
+        """Use the rings for conn, once the other side has opened them."""
+        outbound, inbound = self._rings
+        bell_out, bell_in = self._bells
+        self._rings, self._bells = [], []
+        self._unlink()
+        channel = Channel(inbound, outbound, bell_in, bell_out, loop)
+        return SharedMemoryConnection(conn, channel, loop)
+
+    def _unlink(self):
+        for path in self._paths.values():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def close(self):
+        """Give up on the offer."""
+        for ring in self._rings:
+            ring.close()
+        for fd in self._bells:
+            os.close(fd)
+        self._rings, self._bells = [], []
+        self._unlink()
+
+
+def offer(size):
+    """
+    Create rings of size bytes to offer to the other side of a connection.
+
+    Returns:
+        Offer: The offer, or None if shared memory is not available.
+    """
+    if not available():
+        return None
+    try:
+        return Offer(size)
+    except OSError as e:
+        log.warning('shared memory not available: %r', e)
+        return None
+
+
+def accept(description, conn, loop):
+    """
+    Open the rings offered by the connecting side of conn.
+
+    Returns:
+        SharedMemoryConnection: The connection, or None if the offer
+            cannot be used here.
+    """
+    if not available():
+        return None
+    try:
+        if description['host'] != host_id():
+            return None
+        prefix, size = description['path'], int(description['size'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not os.path.basename(prefix).startswith('robocluster-'):
+        return None
+
+    paths = _paths(prefix)
+    opened = []
+    try:
+        inbound = Ring.open(paths['a.ring'], size)
+        opened.append(inbound.close)
+        outbound = Ring.open(paths['b.ring'], size)
+        opened.append(outbound.close)
+        bell_in = _open_bell(paths['a.bell'])
+        opened.append(lambda: os.close(bell_in))
+        bell_out = _open_bell(paths['b.bell'])
+    except (OSError, ValueError) as e:
+        log.warning('could not open shared memory %s: %r', prefix, e)
+        for close in opened:
+            close()
+        return None
+    channel = Channel(inbound, outbound, bell_in, bell_out, loop)
+    return SharedMemoryConnection(conn, channel, loop)
@@ -0,0 +1,130 @@
+"""
+Message tracing for robocluster.
+
+A member samples some of the messages it sends or publishes and adds a
+trace context to their packet, ``['send', [endpoint, data], context]``
+where the context is ``[trace_id, origin, sent_at]``. Every member the
+message goes through records spans for it, whatever its own rate:
+
+- the sender: the publish or send call, encoding and writing to each
+  peer, with a flow that starts when the frame was written.
+- the receiver: the flow ends when the frame was read, then decoding
+  and every callback.
+
+The spans are kept in memory, a bounded number per member, and can be
+written to a file in the Chrome trace event format. Open it in
+chrome://tracing or https://ui.perfetto.dev, after merging the files of
+several devices with :func:`merge` to follow messages between them.
+Timestamps come from the wall clock, spans recorded on different hosts
+only line up as well as their clocks do.
+"""
+
+import json
+import os
+import random
+import time
+import zlib
+from collections import deque
+
+
+__all__ = [
+    'Tracer',
+    'merge',
+]
+
+
+class Tracer:
+    """Samples messages and records the spans of a member."""
+
+    BUFFER_SIZE = 100000
+
+    def __init__(self, name, rate=0.0, size=None):
+        """
+        Initialize the tracer.
+
+        Args:
+            name (str): Name of the member, shown as its thread.
+            rate (float): Fraction of messages to trace, 0 to 1.
+            size (int, optional): Most events to keep, the oldest are
+                dropped. Defaults to BUFFER_SIZE.
+        """
+        self.name = name
+        self.rate = rate
+        self.events = deque(maxlen=size or self.BUFFER_SIZE)
+        self._pid = os.getpid()
+        self._tid = zlib.crc32(name.encode()) & 0x7fffffff
+
+    def sample(self):
+        """
+        Decide if the next message is traced.
+
+        Returns:
+            list: The trace context to send with it, or None.
+        """
+        if not self.rate or random.random() >= self.rate:
+            return None
+        return [random.getrandbits(53), self.name, time.time()]
+
+    def _event(self, name, phase, ts, context, **fields):
+        event = {
+            'name': name,
+            'cat': 'robocluster',
+            'ph': phase,
+            'ts': ts * 1e6,
+            'pid': self._pid,
+            'tid': self._tid,
+            'args': {'trace': context[0], 'origin': context[1]},
+        }
+        event.update(fields)
+        self.events.append(event)
+        return event
+
+    def span(self, name, context, start, end, **args):
+        """Record that name took from start to end, for the traced message."""
+        event = self._event(name, 'X', start, context, dur=(end - start) * 1e6)
+        event['args'].update(args)
+
+    def flow_start(self, context, receiver, ts):
+        """The message left for receiver at ts."""
+        self._event('message', 's', ts, context,
+                    id=_flow_id(context, receiver))
+
+    def flow_end(self, context, ts):
+        """The message arrived here at ts."""
+        event = self._event('message', 'f', ts, context,
+                            id=_flow_id(context, self.name), bp='e')
+        # only meaningful if the clocks are in sync
+        event['args']['since_sent_ms'] = (ts - context[2]) * 1e3
+
+    def metadata(self):
+        """Events that name the member's thread."""
+        return [{
+            'name': 'thread_name',
+            'ph': 'M',
+            'pid': self._pid,
+            'tid': self._tid,
+            'args': {'name': self.name},
+        }]
+
+    def export(self, path):
+        """Write the recorded events to path as a Chrome trace."""
+        _write(path, self.metadata() + list(self.events))
+
+
+def _flow_id(context, receiver):
+    # one flow per receiver of a message
+    return zlib.crc32('{}/{}'.format(context[0], receiver).encode())
+
+
+def _write(path, events):
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def merge(paths, output):
+    """Combine the trace files of several devices into one."""
+    events = []
+    for path in paths:
+        with open(path) as f:
+            events.extend(json.load(f)['traceEvents'])
+    _write(output, events)
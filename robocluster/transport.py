@@ -0,0 +1,373 @@
+"""
+Transports for robocluster peer and gossip traffic.
+
+A transport creates the connections a :class:`~robocluster.member.Member`
+uses. Two transports are available:
+
+- ``socket``: :class:`~robocluster.net.AsyncSocket` based, every read and
+  write registers with the event loop's selector.
+- ``protocol``: built on asyncio protocols and transports, the event loop
+  reads and writes on its own and only hands complete frames over. This
+  also works with alternative event loops such as uvloop.
+"""
+
+import asyncio
+import socket
+import struct
+from collections import deque
+
+from .net import AsyncSocket, FrameReader, FrameWriter
+
+
+__all__ = [
+    'ProtocolTransport',
+    'SocketTransport',
+    'get_transport',
+]
+
+
+def create_socket(kind, bind=None):
+    """Create a non blocking tcp or udp socket, bound to bind if given."""
+    try:
+        kind = {
+            'tcp': socket.SOCK_STREAM,
+            'udp': socket.SOCK_DGRAM,
+        }[kind]
+    except KeyError:
+        raise ValueError
+
+    s = socket.socket(socket.AF_INET, kind)
+    s.setblocking(False)
+    if bind is not None:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind(bind)
+    return s
+
+
+def create_multicast_socket(address, interface='0.0.0.0'):
+    """
+    Create a non blocking udp socket that is a member of a multicast group.
+
+    Datagrams sent from the socket stay on the local network and are looped
+    back, so members on the same host get them too.
+    """
+    group, port = address
+    s = create_socket('udp', bind=('', port))
+    membership = struct.pack(
+        '4s4s', socket.inet_aton(group), socket.inet_aton(interface))
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    return s
+
+
+class SocketConnection:
+    """A framed connection over an AsyncSocket."""
+
+    def __init__(self, sock, loop):
+        self.socket = sock
+        self.loop = loop
+        self.reader = FrameReader(sock)
+
+    def writer(self, **kwargs):
+        return FrameWriter(self.socket, loop=self.loop, **kwargs)
+
+    def close(self):
+        self.socket.close()
+
+
+class SocketListener:
+    """Accept SocketConnections."""
+
+    def __init__(self, sock, loop):
+        self._socket = AsyncSocket.from_socket(sock, loop=loop)
+        self._socket.listen()
+        self.loop = loop
+
+    @property
+    def port(self):
+        return self._socket.getsockname()[1]
+
+    async def accept(self):
+        conn, _ = await self._socket.accept()
+        return SocketConnection(conn, self.loop)
+
+    def close(self):
+        self._socket.close()
+
+
+class SocketTransport:
+    """Transport using AsyncSocket."""
+
+    name = 'socket'
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    async def connect(self, address):
+        sock = AsyncSocket(socket.AF_INET, socket.SOCK_STREAM, loop=self.loop)
+        try:
+            await sock.connect(address)
+        except BaseException:
+            sock.close()
+            raise
+        return SocketConnection(sock, self.loop)
+
+    def listen(self, bind):
+        return SocketListener(create_socket('tcp', bind=bind), self.loop)
+
+    def datagram(self, bind):
+        sock = create_socket('udp', bind=bind)
+        return AsyncSocket.from_socket(sock, loop=self.loop)
+
+    def multicast(self, address):
+        sock = create_multicast_socket(address)
+        return AsyncSocket.from_socket(sock, loop=self.loop)
+
+
+class FrameProtocol(asyncio.Protocol):
+    """
+    Split a byte stream into length prefixed frames.
+
+    A frame larger than FrameReader.MAX_FRAME_SIZE closes the connection.
+    """
+
+    def __init__(self, loop, on_connect=None):
+        self.loop = loop
+        self.transport = None
+        self._on_connect = on_connect
+        self._buffer = bytearray()
+        self._frames = deque()
+        self._waiter = None
+        self._closed = False
+        self._error = None
+        self._paused = False
+        self._drain_waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self._on_connect is not None:
+            self._on_connect(self)
+
+    def data_received(self, data):
+        if self._closed:
+            return
+        buffer = self._buffer
+        buffer += data
+        start, end = 0, len(buffer)
+        while end - start >= 4:
+            size = int.from_bytes(buffer[start:start + 4], 'big')
+            if size + 4 > FrameReader.MAX_FRAME_SIZE:
+                # a broken or hostile peer, nothing after this is framed
+                self._error = ConnectionError(
+                    'frame too large: {}'.format(size))
+                self._closed = True
+                del buffer[:]
+                self.transport.close()
+                self._wakeup()
+                return
+            if end - start - 4 < size:
+                break
+            start += 4
+            self._frames.append(bytes(buffer[start:start + size]))
+            start += size
+        del buffer[:start]
+        if self._frames:
+            self._wakeup()
+
+    def eof_received(self):
+        self._closed = True
+        self._wakeup()
+
+    def connection_lost(self, exc):
+        self._closed = True
+        self._wakeup()
+        if self._paused:
+            self.resume_writing()
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def _wakeup(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def read(self):
+        """
+        Read the next frame.
+
+        This method is a coroutine.
+
+        Returns:
+            bytes: The frame, or None when the connection is closed.
+
+        Raises:
+            ConnectionError: The peer sent a frame that is too large.
+        """
+        while not self._frames:
+            if self._error is not None:
+                raise self._error
+            if self._closed:
+                return None
+            self._waiter = self.loop.create_future()
+            await self._waiter
+        return self._frames.popleft()
+
+    async def drain(self):
+        """Wait until the transport's write buffer is below its high mark."""
+        if self._closed:
+            raise ConnectionResetError('connection lost')
+        if self._paused:
+            self._drain_waiter = self.loop.create_future()
+            await self._drain_waiter
+
+
+class ProtocolWriter(FrameWriter):
+    """FrameWriter that writes through a FrameProtocol's transport."""
+
+    def __init__(self, protocol, **kwargs):
+        self._protocol = protocol
+        sock = protocol.transport.get_extra_info('socket')
+        super().__init__(sock, loop=protocol.loop, **kwargs)
+
+    async def _write(self, buffers):
+        self._protocol.transport.writelines(buffers)
+        await self._protocol.drain()
+
+
+class ProtocolConnection:
+    """A framed connection over a FrameProtocol."""
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.reader = protocol
+
+    def writer(self, **kwargs):
+        return ProtocolWriter(self.protocol, **kwargs)
+
+    def close(self):
+        self.protocol.transport.close()
+
+
+class ProtocolListener:
+    """Accept ProtocolConnections, the server starts on the first accept."""
+
+    def __init__(self, sock, loop):
+        sock.listen()
+        self._socket = sock
+        self.loop = loop
+        self._server = None
+        self._accepted = asyncio.Queue(loop=loop)
+
+    @property
+    def port(self):
+        return self._socket.getsockname()[1]
+
+    def _protocol(self):
+        return FrameProtocol(self.loop, on_connect=self._accepted.put_nowait)
+
+    async def accept(self):
+        if self._server is None:
+            self._server = await self.loop.create_server(
+                self._protocol, sock=self._socket)
+        protocol = await self._accepted.get()
+        return ProtocolConnection(protocol)
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        else:
+            self._socket.close()
+
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+    """Datagram endpoint with the recvfrom and sendto coroutines of AsyncSocket."""
+
+    QUEUE_SIZE = 1024
+
+    def __init__(self, sock, loop):
+        self._socket = sock
+        self.loop = loop
+        self.transport = None
+        self._opening = None
+        self._received = asyncio.Queue(maxsize=self.QUEUE_SIZE, loop=loop)
+
+    def setsockopt(self, *args):
+        self._socket.setsockopt(*args)
+
+    def getsockname(self):
+        return self._socket.getsockname()
+
+    def datagram_received(self, data, addr):
+        if not self._received.full():
+            self._received.put_nowait((data, addr))
+
+    async def _open(self):
+        if self._opening is None:
+            self._opening = self.loop.create_task(
+                self.loop.create_datagram_endpoint(lambda: self, sock=self._socket))
+        await asyncio.shield(self._opening, loop=self.loop)
+
+    async def recvfrom(self, bufsize):
+        if self.transport is None:
+            await self._open()
+        data, addr = await self._received.get()
+        return data[:bufsize], addr
+
+    async def sendto(self, data, address):
+        if self.transport is None:
+            await self._open()
+        self.transport.sendto(data, address)
+        return len(data)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        else:
+            self._socket.close()
+
+
+class ProtocolTransport:
+    """Transport using asyncio protocols."""
+
+    name = 'protocol'
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    async def connect(self, address):
+        _, protocol = await self.loop.create_connection(
+            lambda: FrameProtocol(self.loop), *address)
+        return ProtocolConnection(protocol)
+
+    def listen(self, bind):
+        return ProtocolListener(create_socket('tcp', bind=bind), self.loop)
+
+    def datagram(self, bind):
+        return DatagramProtocol(create_socket('udp', bind=bind), self.loop)
+
+    def multicast(self, address):
+        return DatagramProtocol(create_multicast_socket(address), self.loop)
+
+
+_TRANSPORTS = {
+    SocketTransport.name: SocketTransport,
+    ProtocolTransport.name: ProtocolTransport,
+}
+
+
+def get_transport(name, loop):
+    """Create the transport called name for loop."""
+    return _TRANSPORTS[name](loop)
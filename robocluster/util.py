@@ -1,9 +1,10 @@
 """Utility functions for robocluster."""
 
+import asyncio
 import re
 import socket
 import ipaddress
-from functools import wraps
+from functools import partial, wraps
 from inspect import iscoroutinefunction
 
 def ip_info(addr):
@@ -14,10 +15,16 @@ def ip_info(addr):
     else:
         return socket.AF_INET, addr
 
-def as_coroutine(func):
+def as_coroutine(func, executor=None):
     """
     Convert a function to a coroutine that can be awaited.
 
+    Args:
+        func: The function to convert.
+        executor (concurrent.futures.Executor, bool, optional): Run func in
+            this executor instead of on the event loop, True for the event
+            loop's default executor. Use this for slow blocking functions.
+
     Notes:
     If the function is already a coroutine, it is returned directly.
 
@@ -26,8 +33,16 @@ def as_coroutine(func):
     async def _wrapper(*args, **kwargs):
         return func(*args, **kwargs)
 
+    @wraps(func)
+    async def _executor_wrapper(*args, **kwargs):
+        loop = asyncio.get_event_loop()
+        pool = None if executor is True else executor
+        return await loop.run_in_executor(pool, partial(func, *args, **kwargs))
+
     if iscoroutinefunction(func):
         return func
+    if executor is not None and executor is not False:
+        return _executor_wrapper
     return _wrapper
 
 
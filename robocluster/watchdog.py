@@ -0,0 +1,241 @@
+"""
+Event loop watchdog for robocluster.
+
+Every callback, ``every`` loop and connection of the devices in a context
+share one event loop, so a callback that blocks stalls all of them. The
+watchdog of a loop notices:
+
+- Lag: a probe sleeps for a short interval and measures how much later
+  than asked it woke up.
+- Slow steps: the tasks of every :class:`~robocluster.looper.Looper` on
+  the loop, and the handlers of its members, are run step by step. A
+  step, the code between two awaits, that takes longer than the
+  threshold is kept in a ring buffer of the worst offenders, named after
+  the coroutine that took it. Time spent in a handler only counts for
+  the handler, not for the task that called it.
+- Stacks: a thread checks on the probe. When it is late by more than the
+  threshold, the stack of the loop's thread is captured and kept with
+  the step that was running.
+
+The watchdog stays the one of its loop as long as a looper that enabled
+it runs, after that nothing is timed any more.
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import deque
+
+from .metrics import Histogram
+
+
+__all__ = [
+    'Watchdog',
+]
+
+
+log = logging.getLogger(__name__)
+
+
+class Watchdog:
+    """Measures the lag of an event loop and the steps that caused it."""
+
+    # seconds between lag measurements
+    INTERVAL = 0.05
+    # how many slow steps are kept
+    SIZE = 32
+
+    # the watchdog of every event loop that has one
+    _watchdogs = weakref.WeakKeyDictionary()
+
+    def __init__(self, loop, threshold=0.1, log_slow=False):
+        """
+        Initialize the watchdog of loop, see :meth:`of` to find it again.
+
+        Args:
+            loop (asyncio.AbstractEventLoop): The loop to watch.
+            threshold (float): Seconds a step may block the loop before it
+                is reported.
+            log_slow (bool): Log a warning, with the stack if one was
+                captured, for every slow step.
+        """
+        self.loop = loop
+        self.threshold = threshold
+        self.log_slow = log_slow
+        self.lag = Histogram()
+        self.last_lag = 0.0
+        self.steps = 0
+        self.slow_steps = 0
+        self._slow = deque(maxlen=self.SIZE)
+        # [name, start, seconds spent in nested steps, stack] of the step
+        # running now, only changed on the loop's thread
+        self._current = None
+        # stack captured while no step was running
+        self._stack = None
+        self._beat = None
+        self._thread_id = None
+        self._stopping = threading.Event()
+        # how many run daemons there are, and the probe they share
+        self._owners = 0
+        self._probe = None
+        self._watchdogs[loop] = self
+
+    @classmethod
+    def of(cls, loop):
+        """The watchdog of loop, or None."""
+        return cls._watchdogs.get(loop)
+
+    def timed(self, coro, name):
+        """Run coro, timing every step it takes under name."""
+        if self._watchdogs.get(self.loop) is not self:
+            # stopped, whoever still holds on to it pays nothing
+            return coro
+        return _timed(self, coro, name)
+
+    def _step(self, name, method, arg):
+        outer = self._current
+        current = self._current = [name, time.perf_counter(), 0.0, None]
+        try:
+            return method(arg)
+        finally:
+            elapsed = time.perf_counter() - current[1]
+            self._current = outer
+            if outer is not None:
+                outer[2] += elapsed
+            self._record(name, elapsed - current[2], current[3])
+
+    def _record(self, name, seconds, stack):
+        self.steps += 1
+        if seconds < self.threshold:
+            return
+        self.slow_steps += 1
+        self._slow.append({
+            'name': name,
+            'seconds': seconds,
+            'time': time.time(),
+            'stack': stack,
+        })
+        if self.log_slow:
+            log.warning('%s blocked the event loop for %.0f ms%s', name,
+                        seconds * 1e3, '\n' + stack if stack else '')
+
+    async def run(self):
+        """
+        Measure the lag until cancelled, run this as a daemon.
+
+        Every looper that enables the watchdog runs it. Once the last of
+        them is cancelled, the watchdog is no longer the one of its loop.
+        """
+        watchdog = self._watchdogs.setdefault(self.loop, self)
+        if watchdog is not self:
+            # the loop got another watchdog while our owners were stopped
+            await watchdog.run()
+            return
+        self._owners += 1
+        if self._probe is None:
+            self._probe = self.loop.create_task(self._measure())
+        try:
+            await self.loop.create_future()
+        finally:
+            self._owners -= 1
+            if not self._owners:
+                self._probe.cancel()
+                self._probe = None
+                if self._watchdogs.get(self.loop) is self:
+                    del self._watchdogs[self.loop]
+
+    async def _measure(self):
+        self._thread_id = threading.get_ident()
+        self._stopping.clear()
+        thread = threading.Thread(target=self._watch, daemon=True,
+                                  name='robocluster-watchdog')
+        thread.start()
+        try:
+            while ...:
+                self._beat = expected = time.monotonic() + self.INTERVAL
+                await asyncio.sleep(self.INTERVAL, loop=self.loop)
+                lag = max(time.monotonic() - expected, 0.0)
+                self.last_lag = lag
+                self.lag.record(lag)
+                stack, self._stack = self._stack, None
+                if stack is not None:
+                    # nothing the watchdog runs was to blame
+                    self._record('<untracked>', lag, stack)
+        finally:
+            self._beat = None
+            self._stopping.set()
+
+    def _watch(self):
+        sampled = None
+        while not self._stopping.wait(self.INTERVAL):
+            beat = self._beat
+            if (beat is None or beat == sampled
+                    or time.monotonic() - beat < self.threshold):
+                continue
+            sampled = beat
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = ''.join(traceback.format_stack(frame))
+            current = self._current
+            if current is not None:
+                current[3] = stack
+            else:
+                self._stack = stack
+
+    def worst(self):
+        """The slow steps kept, slowest first."""
+        return sorted(self._slow, key=lambda step: -step['seconds'])
+
+    def report(self):
+        """
+        Everything the watchdog measured.
+
+        Returns:
+            dict: The lag as a histogram summary, the number of steps timed
+                and of slow steps, and the worst steps kept, slowest first,
+                with their name, seconds, time and stack, if one was
+                captured.
+        """
+        return {
+            'lag': self.lag.summary(),
+            'steps': self.steps,
+            'slow_steps': self.slow_steps,
+            'worst': self.worst(),
+        }
+
+
+async def _timed(watchdog, coro, name):
+    return await _Steps(watchdog, coro, name)
+
+
+class _Steps:
+    """Drives a coroutine like a task would, one timed step at a time."""
+
+    def __init__(self, watchdog, coro, name):
+        self.watchdog = watchdog
+        self.coro = coro
+        self.name = name
+
+    def __await__(self):
+        coro = self.coro
+        step = self.watchdog._step
+        method, arg = coro.send, None
+        while ...:
+            try:
+                yielded = step(self.name, method, arg)
+            except StopIteration as e:
+                return e.value
+            try:
+                arg = yield yielded
+                method = coro.send
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e:  # pylint: disable=W0703
+                # cancellation and the like go to the coroutine
+                method, arg = coro.throw, e
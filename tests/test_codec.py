@@ -0,0 +1,50 @@
+import pytest
+
+from robocluster.codec import JsonCodec, MsgpackCodec, available, get_codec
+
+
+PACKETS = [
+    None, True, False, 0, 1, -1, -32, -33, 127, 128, 255, 256, 65536,
+    2**32, 2**63 - 1, -2**63, 0.5, -1.25e100, '', 'a', 'x' * 40, 'x' * 300,
+    'x' * 70000, [], list(range(20)), {}, {'key': 'Hello', 'values': 1234},
+    {str(i): i for i in range(20)},
+    ['send', ['device/topic', {'x': 1.5, 'y': -2.0, 'ok': True}]],
+]
+
+
+@pytest.mark.parametrize('packet', PACKETS)
+def test_msgpack_roundtrip(packet):
+    assert MsgpackCodec.decode(MsgpackCodec.encode(packet)) == packet
+
+
+def test_msgpack_bytes():
+    data = bytes(range(256)) * 300
+    assert MsgpackCodec.decode(MsgpackCodec.encode(data)) == data
+    assert MsgpackCodec.decode(MsgpackCodec.encode(b'')) == b''
+
+
+def test_msgpack_tuples_decode_as_lists():
+    assert MsgpackCodec.decode(MsgpackCodec.encode(('a', (1, 2)))) == ['a', [1, 2]]
+
+
+def test_msgpack_known_encoding():
+    assert MsgpackCodec.encode([1, 'a', None]) == b'\x93\x01\xa1a\xc0'
+    assert MsgpackCodec.encode({'a': -1}) == b'\x81\xa1a\xff'
+
+
+@pytest.mark.parametrize('data', [b'', b'\x93\x01', b'\xc1', b'\x01\x02'])
+def test_msgpack_invalid(data):
+    with pytest.raises(ValueError):
+        MsgpackCodec.decode(data)
+
+
+def test_json_memoryview():
+    data = memoryview(JsonCodec.encode(['send', ['a', 1]]))
+    assert JsonCodec.decode(data) == ['send', ['a', 1]]
+
+
+def test_registry():
+    assert available()[:2] == ['json', 'msgpack']
+    assert get_codec('json') is JsonCodec
+    with pytest.raises(KeyError):
+        get_codec('nope')
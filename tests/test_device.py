@@ -1,9 +1,13 @@
+import asyncio
+import json
 from uuid import uuid4
 import random
+import socket
 from time import sleep, time
 from contextlib import suppress
 
-from robocluster import Device
+from robocluster import ContextPool, Device, trace
+from robocluster.member import RemoteError, RequestTimeout
 
 
 def test_pubsub():
@@ -133,6 +137,82 @@ def test_send():
     device_b.stop()
     assert message_received
 
+def test_send_msgpack():
+    group = str(uuid4())
+    device_a = Device('device_a', group, codec='msgpack', local=None)
+    device_b = Device('device_b', group, codec='msgpack', local=None)
+    message_received = False
+
+    TEST_DATA = {'key': b'\x00\x01', 'values': [1.5, -2]}
+
+    @device_b.on('direct-msg')
+    async def callback(sender, data):  # pylint: disable=W0612
+        nonlocal message_received
+        assert sender == 'device_a'
+        assert data == TEST_DATA
+        message_received = True
+
+    @device_a.task
+    async def send_msg():  # pylint: disable=W0612
+        await device_a.send('device_b', 'direct-msg', TEST_DATA)
+
+    device_b.start()
+    device_a.start()
+    sleep(0.5)
+    device_a.stop()
+    device_b.stop()
+    assert message_received
+
+def test_send_large():
+    group = str(uuid4())
+    device_a = Device('device_a', group, codec='msgpack', local=None)
+    device_b = Device('device_b', group, codec='msgpack', local=None)
+    received = []
+
+    TEST_DATA = bytes(range(256)) * 1024
+
+    @device_b.on('scan')
+    async def callback(sender, data):  # pylint: disable=W0612
+        received.append(data)
+
+    @device_a.task
+    async def send_msg():  # pylint: disable=W0612
+        for _ in range(3):
+            await device_a.send('device_b', 'scan', TEST_DATA)
+
+    device_b.start()
+    device_a.start()
+    sleep(0.5)
+    device_a.stop()
+    device_b.stop()
+    assert received == [TEST_DATA] * 3
+
+def test_protocol_transport():
+    group = str(uuid4())
+    device_a = Device('device_a', group, transport='protocol', local=None)
+    device_b = Device('device_b', group, transport='protocol', local=None)
+    received = []
+
+    @device_b.on('direct-msg')
+    async def callback(sender, data):  # pylint: disable=W0612
+        received.append(data)
+
+    @device_b.on_request('double')
+    async def double(value):  # pylint: disable=W0612
+        return value * 2
+
+    @device_a.task
+    async def send_msg():  # pylint: disable=W0612
+        await device_a.send('device_b', 'direct-msg', 1)
+        received.append(await device_a.request('device_b', 'double', 2))
+
+    device_b.start()
+    device_a.start()
+    sleep(0.5)
+    device_a.stop()
+    device_b.stop()
+    assert sorted(received) == [1, 4]
+
 def test_storage():
     device = Device('device', 'test')
     device.storage.counter = 0
@@ -176,3 +256,600 @@ def test_request():
     assert deviceB.storage.message_received
 
 
+def test_request_kwargs():
+    group = str(uuid4())
+    device_a = Device('device_a', group)
+    device_b = Device('device_b', group)
+    results = []
+
+    @device_a.on_request('scale')
+    async def scale(value, factor=1):  # pylint: disable=W0612
+        return value * factor
+
+    @device_b.task
+    async def request():  # pylint: disable=W0612
+        results.append(await device_b.request('device_a', 'scale', 2, factor=3))
+
+    device_a.start()
+    device_b.start()
+    sleep(0.2)
+    device_b.stop()
+    device_a.stop()
+    assert results == [6]
+
+
+def test_request_unencodable_result():
+    group = str(uuid4())
+    device_a = Device('device_a', group, local=None)
+    device_b = Device('device_b', group, local=None)
+    results = []
+
+    @device_a.on_request('good')
+    async def good():  # pylint: disable=W0612
+        return 42
+
+    @device_a.on_request('bad')
+    async def bad():  # pylint: disable=W0612
+        return {1, 2}
+
+    @device_b.task
+    async def request():  # pylint: disable=W0612
+        results.extend(await device_b.request_many(
+            [('device_a', 'good'), ('device_a', 'bad'), ('device_a', 'good')],
+            return_exceptions=True))
+        results.append(device_b._member._peers['device_a'].state)
+
+    device_a.start()
+    device_b.start()
+    sleep(0.3)
+    device_b.stop()
+    device_a.stop()
+    good_1, error, good_2, state = results
+    assert (good_1, good_2, state) == (42, 42, 'connected')
+    assert isinstance(error, RemoteError)
+
+
+def test_request_timeout():
+    group = str(uuid4())
+
+    deviceA = Device('deviceA', group)
+    deviceA.storage.cancelled = False
+
+    deviceB = Device('deviceB', group)
+    deviceB.storage.errors = []
+
+    @deviceA.on_request('slow')
+    async def slow():  # pylint: disable=W0612
+        try:
+            await deviceA.sleep(10)
+        except asyncio.CancelledError:
+            deviceA.storage.cancelled = True
+            raise
+
+    @deviceA.on_request('broken')
+    async def broken():  # pylint: disable=W0612
+        raise RuntimeError('broken')
+
+    @deviceB.task
+    async def get_data():  # pylint: disable=W0612
+        for endpoint in ('slow', 'broken'):
+            try:
+                await deviceB.request('deviceA', endpoint, timeout=0.1)
+            except (RequestTimeout, RemoteError) as e:
+                deviceB.storage.errors.append(type(e))
+
+    deviceA.start()
+    deviceB.start()
+    sleep(0.5)
+    deviceB.stop()
+    deviceA.stop()
+    assert deviceB.storage.errors == [RequestTimeout, RemoteError]
+    assert deviceA.storage.cancelled
+
+def test_request_many():
+    group = str(uuid4())
+
+    deviceA = Device('deviceA', group)
+    deviceA.storage.calls = 0
+
+    deviceB = Device('deviceB', group)
+    deviceB.storage.results = None
+
+    @deviceA.on_request('add')
+    async def add(a, b=0):  # pylint: disable=W0612
+        deviceA.storage.calls += 1
+        await deviceA.sleep(0.01 * a)
+        return a + b
+
+    calls = [
+        ('deviceA', 'add', (3,), {'b': 1}),
+        ('deviceA', 'add', (1,)),
+        ('deviceA', 'add', (3,), {'b': 1}),
+        ('deviceA', 'add', (2, 2)),
+    ]
+
+    @deviceB.task
+    async def get_data():  # pylint: disable=W0612
+        deviceB.storage.results = await deviceB.request_many(calls)
+        deviceB.storage.coalesced = await deviceB.request_many(
+            calls, coalesce=True)
+
+    deviceA.start()
+    deviceB.start()
+    sleep(0.5)
+    deviceB.stop()
+    deviceA.stop()
+    assert deviceB.storage.results == [4, 1, 4, 4]
+    assert deviceB.storage.coalesced == [4, 1, 4, 4]
+    # every call is served, identical ones only once with coalesce
+    assert deviceA.storage.calls == 4 + 3
+    assert deviceB.request_stats()['deviceA/add']['count'] == 4 + 3
+
+def test_pubsub_multicast():
+    group = str(uuid4())
+    device_a = Device('device-a', group, multicast=True, local=None)
+    device_b = Device('device-b', group, multicast=True, local=None)
+    device_c = Device('device-c', group, local=None)
+    received = {'device-b': [], 'device-c': []}
+
+    @device_a.every(0.05)
+    async def publish():  # pylint: disable=W0612
+        await device_a.publish('reading', 1.5, best_effort=True)
+
+    for device in (device_b, device_c):
+        @device.on('device-a/reading')
+        async def callback(event, data, name=device.name):  # pylint: disable=W0612
+            assert event == 'device-a/reading'
+            received[name].append(data)
+
+    device_a.start()
+    device_b.start()
+    device_c.start()
+    sleep(0.5)
+    device_a.stop()
+    device_b.stop()
+    device_c.stop()
+    assert received['device-b'] and set(received['device-b']) == {1.5}
+    # without multicast the data still comes over the connection
+    assert received['device-c']
+    stats = device_b._member.multicast_stats()
+    assert stats['received'] == len(received['device-b'])
+    assert device_c._member.multicast_stats() is None
+
+def test_request_shared_memory():
+    group = str(uuid4())
+    results = {}
+
+    for shared_memory in (True, False):
+        deviceA = Device('deviceA', group, shared_memory=shared_memory,
+                         local=None)
+        deviceB = Device('deviceB', group, shared_memory=shared_memory,
+                         local=None)
+        deviceA.on_request('echo', lambda data: data)
+
+        @deviceB.task
+        async def get_data(shared_memory=shared_memory):  # pylint: disable=W0612
+            data = 'x' * (3 * 1024 * 1024)
+            assert await deviceB.request('deviceA', 'echo', data) == data
+            conn = deviceB._member._peers['deviceA']._conn
+            results[shared_memory] = type(conn).__name__
+
+        deviceA.start()
+        deviceB.start()
+        sleep(1)
+        deviceA.stop()
+        deviceB.stop()
+        group = str(uuid4())
+
+    assert results == {
+        True: 'SharedMemoryConnection', False: 'SocketConnection'}
+
+def test_local_delivery():
+    for local_copy in (False, True):
+        group = str(uuid4())
+        device_a = Device('device_a', group, local=True,
+                          local_copy=local_copy)
+        device_b = Device('device_b', group, local=True,
+                          local_copy=local_copy)
+        data = {'values': [1, 2]}
+        received = []
+
+        @device_b.on('device_a/topic')
+        async def on_topic(event, value):  # pylint: disable=W0612
+            received.append(value)
+
+        @device_b.on('direct-msg')
+        async def on_direct(sender, value):  # pylint: disable=W0612
+            assert sender == 'device_a'
+            received.append(value)
+
+        @device_b.on_request('echo')
+        async def echo(value):  # pylint: disable=W0612
+            return value
+
+        @device_b.on_request('broken')
+        async def broken():  # pylint: disable=W0612
+            raise RuntimeError('broken')
+
+        @device_a.task
+        async def send():  # pylint: disable=W0612
+            await device_a.send('device_b', 'direct-msg', data)
+            received.append(await device_a.request('device_b', 'echo', data))
+            try:
+                await device_a.request('device_b', 'broken')
+            except RemoteError:
+                received.append('error')
+            # wait for device_b to subscribe
+            await device_a.sleep(0.05)
+            await device_a.publish('topic', data)
+
+        device_b.start()
+        device_a.start()
+        sleep(0.3)
+        device_a.stop()
+        device_b.stop()
+        assert received == [data, data, 'error', data]
+        identical = [value is data for value in received if value != 'error']
+        assert identical == [not local_copy] * 3
+        # nothing went over the network
+        peer = device_a._member._peers.get('device_b')
+        assert peer is None or peer._conn is None
+
+def test_local_slow_subscriber():
+    group = str(uuid4())
+    device_a = Device('device_a', group, local=True)
+    device_b = Device('device_b', group, local=True)
+    assert device_a.loop is device_b.loop
+    received = []
+    publishing = []
+
+    @device_b.on('device_a/topic')
+    async def on_topic(event, value):  # pylint: disable=W0612
+        sleep(0.05)
+        received.append(value)
+
+    @device_a.task
+    async def publish():  # pylint: disable=W0612
+        # wait for device_b to subscribe
+        await device_a.sleep(0.05)
+        start = device_a.loop.time()
+        for value in range(5):
+            await device_a.publish('topic', value)
+        publishing.append(device_a.loop.time() - start)
+
+    device_b.start()
+    device_a.start()
+    sleep(0.6)
+    device_a.stop()
+    device_b.stop()
+    # the publisher never waited for the subscriber to catch up
+    assert publishing[0] < 0.05
+    assert received == [0, 1, 2, 3, 4]
+
+def test_local_queue_policy():
+    expected = {'drop-oldest': list(range(16, 20)), 'block': list(range(20))}
+    for policy in expected:
+        group = str(uuid4())
+        device_a = Device('device_a', group, local=True, queue_policy=policy)
+        device_b = Device('device_b', group, local=True, queue_size=4)
+        received = []
+
+        @device_b.on('device_a/topic')
+        async def on_topic(event, value):  # pylint: disable=W0612
+            received.append(value)
+
+        @device_a.task
+        async def publish():  # pylint: disable=W0612
+            # wait for device_b to subscribe
+            await device_a.sleep(0.05)
+            for value in range(20):
+                await device_a.publish('topic', value)
+
+        device_b.start()
+        device_a.start()
+        sleep(0.3)
+        device_a.stop()
+        device_b.stop()
+        assert received == expected[policy]
+
+def test_local_publish_skips_non_subscribers():
+    group = str(uuid4())
+    ctl = Device('ctl', group, local=True)
+    pub = Device('pub', group, local=True)
+    rx = Device('rx', group, local=True, queue_size=4)
+    received = []
+
+    @rx.on('command')
+    async def on_command(sender, value):  # pylint: disable=W0612
+        received.append(value)
+
+    @ctl.task
+    async def send():  # pylint: disable=W0612
+        await ctl.send('rx', 'command', 'stop-motors')
+
+    @pub.task
+    async def publish():  # pylint: disable=W0612
+        for value in range(100):
+            await pub.publish('telemetry', value)
+
+    rx.start()
+    ctl.start()
+    pub.start()
+    sleep(0.3)
+    for device in (ctl, pub, rx):
+        device.stop()
+    assert received == ['stop-motors']
+    assert rx._member.metrics.counter('local.dropped').value == 0
+
+def test_context_pool():
+    group = str(uuid4())
+    with ContextPool(2) as pool:
+        device_a = Device('device_a', group, context=pool, local=True)
+        device_b = pool.spawn(
+            lambda context: Device('device_b', group, context=context,
+                                   local=True))
+        assert device_a.loop is not device_b.loop
+        assert pool.context(affinity=0) is device_a.context
+        received = []
+
+        @device_b.on('device_a/topic')
+        async def on_topic(event, value):  # pylint: disable=W0612
+            received.append(value)
+
+        @device_b.on('direct-msg')
+        async def on_direct(sender, value):  # pylint: disable=W0612
+            received.append(value)
+
+        @device_b.on_request('echo')
+        async def echo(value):  # pylint: disable=W0612
+            return value
+
+        @device_a.task
+        async def send():  # pylint: disable=W0612
+            await device_a.send('device_b', 'direct-msg', 1)
+            received.append(await device_a.request('device_b', 'echo', 2))
+            await device_a.sleep(0.05)
+            await device_a.publish('topic', 3)
+
+        device_b.start()
+        device_a.start()
+        sleep(0.3)
+        device_a.stop()
+        device_b.stop()
+    assert sorted(received) == [1, 2, 3]
+    # nothing went over the network
+    peer = device_a._member._peers.get('device_b')
+    assert peer is None or peer._conn is None
+
+def test_conflate_latest():
+    group = str(uuid4())
+    device_a = Device('device_a', group)
+    device_b = Device('device_b', group)
+    received = []
+
+    @device_b.on('device_a/reading', dispatch='conflate')
+    async def on_reading(event, value):  # pylint: disable=W0612
+        received.append(value)
+        await device_b.sleep(0.05)
+
+    @device_a.task
+    async def publish():  # pylint: disable=W0612
+        # wait for device_b to subscribe
+        await device_a.sleep(0.05)
+        for i in range(100):
+            await device_a.publish('reading', i)
+        await device_a.sleep(0.2)
+
+    assert device_b.latest('device_a/reading', 'nothing') == 'nothing'
+    device_b.start()
+    device_a.start()
+    sleep(0.4)
+    device_a.stop()
+    device_b.stop()
+    assert device_b.latest('device_a/reading') == 99
+    assert received[-1] == 99
+    assert len(received) < 10
+
+def test_conflate_direct_per_endpoint():
+    group = str(uuid4())
+    device_a = Device('device_a', group)
+    device_b = Device('device_b', group)
+    received = []
+
+    @device_b.on('set_*', dispatch='conflate')
+    async def on_set(sender, value):  # pylint: disable=W0612
+        received.append((sender, value))
+        await device_b.sleep(0.05)
+
+    @device_a.task
+    async def send():  # pylint: disable=W0612
+        await device_a.send('device_b', 'set_x', 1)
+        await device_a.send('device_b', 'set_speed', 5)
+        await device_a.send('device_b', 'set_mode', 'auto')
+        await device_a.send('device_b', 'set_speed', 6)
+
+    device_b.start()
+    device_a.start()
+    sleep(0.4)
+    device_a.stop()
+    device_b.stop()
+    # the sender is the same, only set_speed=5 may be replaced
+    values = sorted(str(value) for _, value in received)
+    assert values in (['1', '6', 'auto'], ['1', '5', '6', 'auto'])
+    assert {sender for sender, _ in received} == {'device_a'}
+
+def test_max_rate():
+    for local in (None, {}):
+        group = str(uuid4())
+        device_a = Device('device_a', group, local=local)
+        device_b = Device('device_b', group, local=local)
+        received = {'fast': 0, 'slow': 0}
+
+        @device_b.on('device_a/fast')
+        async def on_fast(event, value):  # pylint: disable=W0612
+            received['fast'] += 1
+
+        @device_b.on('device_a/slow', max_rate=10)
+        async def on_slow(event, value):  # pylint: disable=W0612
+            received['slow'] += 1
+
+        @device_a.task
+        async def publish():  # pylint: disable=W0612
+            # wait for device_b to subscribe
+            await device_a.sleep(0.2)
+            for _ in range(100):
+                await device_a.publish('fast', 1)
+                await device_a.publish('slow', 1)
+                await device_a.sleep(0.005)
+
+        device_b.start()
+        device_a.start()
+        sleep(1.2)
+        device_a.stop()
+        device_b.stop()
+        assert received['fast'] == 100
+        # 100 messages over at least half a second
+        assert 3 <= received['slow'] <= 11
+
+def test_connection_events():
+    group = str(uuid4())
+    device_a = Device('device_a', group, local=None)
+    device_b = Device('device_b', group, local=None)
+    events = []
+    received = []
+
+    @device_a.on_connection
+    async def connection(name, state):  # pylint: disable=W0612
+        events.append((name, state))
+
+    @device_b.on('direct-msg')
+    async def callback(sender, data):  # pylint: disable=W0612
+        received.append(data)
+
+    @device_a.task
+    async def send_msg():  # pylint: disable=W0612
+        # clients that never say hello do not hold up the devices
+        silent = [
+            socket.create_connection(('127.0.0.1', device._member._accepter.port))
+            for device in (device_a, device_b)
+        ]
+        await device_a.send('device_b', 'direct-msg', 1)
+        for conn in silent:
+            conn.close()
+
+    device_b.start()
+    device_a.start()
+    sleep(0.5)
+    assert received == [1]
+    assert ('device_b', 'connected') in events
+    assert device_a.connection_state('device_b') == 'connected'
+    assert device_a.connection_state('nobody') is None
+    device_a.stop()
+    device_b.stop()
+
+def test_stats():
+    group = str(uuid4())
+    device_a = Device('device_a', group, local=None)
+    device_b = Device('device_b', group, local=None)
+    results = {}
+
+    @device_b.on('direct-msg')
+    async def callback(sender, data):  # pylint: disable=W0612
+        pass
+
+    @device_a.task
+    async def get_stats():  # pylint: disable=W0612
+        for i in range(3):
+            await device_a.send('device_b', 'direct-msg', i)
+        results['b'] = await device_a.request('device_b', Device.STATS_ENDPOINT)
+
+    device_b.start()
+    device_a.start()
+    sleep(0.5)
+    device_a.stop()
+    device_b.stop()
+    stats_a = device_a.stats()
+    assert stats_a['peer.device_b.sent'] >= 4
+    assert stats_a['peer.device_b.connects'] == 1
+    assert stats_a['peer.device_b.state'] in ('connected', 'stopped')
+    assert stats_a['latency.device_b/robocluster.stats']['count'] == 1
+    assert stats_a['gossip.sent'] > 0
+    stats_b = results['b']
+    assert stats_b['handler.direct-msg']['count'] == 3
+    assert stats_b['peer.device_a.received'] >= 4
+
+def test_trace(tmpdir):
+    group = str(uuid4())
+    device_a = Device('device_a', group, local=None, shared_memory=False,
+                      trace_rate=1)
+    device_b = Device('device_b', group, local=None, shared_memory=False)
+    received = []
+
+    @device_b.on('direct-msg')
+    async def callback(sender, data):  # pylint: disable=W0612
+        received.append(data)
+
+    @device_a.task
+    async def send_msg():  # pylint: disable=W0612
+        await device_a.send('device_b', 'direct-msg', 1)
+
+    device_b.start()
+    device_a.start()
+    sleep(0.5)
+    device_a.stop()
+    device_b.stop()
+    assert received == [1]
+
+    path_a, path_b = str(tmpdir.join('a.json')), str(tmpdir.join('b.json'))
+    device_a.export_trace(path_a)
+    device_b.export_trace(path_b)
+    output = str(tmpdir.join('trace.json'))
+    trace.merge([path_a, path_b], output)
+    with open(output) as f:
+        events = json.load(f)['traceEvents']
+    names = {(event['name'], event['ph']) for event in events}
+    assert names >= {
+        ('send device_b/direct-msg', 'X'), ('encode', 'X'), ('write', 'X'),
+        ('decode', 'X'), ('callback direct-msg', 'X'),
+        ('message', 's'), ('message', 'f'),
+    }
+    flows = [event for event in events if event['name'] == 'message']
+    assert len({event['id'] for event in flows}) == 1
+    # one trace, started by device_a
+    assert {
+        event['args']['origin'] for event in events if event['ph'] != 'M'
+    } == {'device_a'}
+
+def test_watchdog():
+    group = str(uuid4())
+    device_a = Device('device_a', group, local=None)
+    assert device_a.watchdog_report() is None
+
+    pool = ContextPool(1)
+    device_b = Device('device_b', group, context=pool, local=None,
+                      watchdog=0.05)
+    device_c = Device('device_c', group, context=pool, local=None)
+
+    @device_c.on('direct-msg')
+    def blocking(sender, data):  # pylint: disable=W0612
+        sleep(0.1)
+
+    @device_b.task
+    async def send_msg():  # pylint: disable=W0612
+        await device_b.send('device_c', 'direct-msg', 1)
+
+    device_b.start()
+    device_c.start()
+    sleep(0.5)
+    # devices in the same context share the watchdog
+    assert device_c.watchdog is device_b.watchdog
+    report = device_c.watchdog_report()
+    device_b.stop()
+    sleep(0.05)
+    # it went away with the device that enabled it
+    assert device_c.watchdog_report() is None
+    device_c.stop()
+    pool.close()
+    names = [step['name'] for step in report['worst']]
+    assert names == ['test_watchdog.<locals>.blocking']
+    assert report['lag']['count'] > 0
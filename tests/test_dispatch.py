@@ -0,0 +1,156 @@
+import asyncio
+import threading
+
+import pytest
+
+from robocluster.dispatch import EndpointIndex, Handler
+
+
+def test_literal_match():
+    index = EndpointIndex()
+    index['device/a'] = 1
+    index['device/b'] = 2
+    assert index.match('device/a') == (('device/a', 1),)
+    assert index.match('device/c') == ()
+
+
+def test_glob_match():
+    index = EndpointIndex()
+    index['*/heartbeat'] = 1
+    index['device/*'] = 2
+    index['device/heartbeat'] = 3
+    index['other/[ab]'] = 4
+    assert index.match('device/heartbeat') == (
+        ('*/heartbeat', 1),
+        ('device/*', 2),
+        ('device/heartbeat', 3),
+    )
+    assert index.match('rover/heartbeat') == (('*/heartbeat', 1),)
+    assert index.match('other/a') == (('other/[ab]', 4),)
+    assert index.match('other/c') == ()
+
+
+def test_cache_invalidation():
+    index = EndpointIndex()
+    index['device/*'] = 1
+    assert index.match('device/a') == (('device/*', 1),)
+    index['device/*'] = 2
+    assert index.match('device/a') == (('device/*', 2),)
+    index['*'] = 3
+    assert index.match('device/a') == (('device/*', 2), ('*', 3))
+    del index['device/*']
+    assert index.match('device/a') == (('*', 3),)
+
+
+def test_cache_size():
+    index = EndpointIndex(cache_size=2)
+    index['*'] = 1
+    for i in range(10):
+        assert index.match(str(i)) == (('*', 1),)
+    assert len(index._cache) == 2
+
+
+def test_fromkeys():
+    index = EndpointIndex.fromkeys(['a/*', 'b'], True)
+    assert set(index) == {'a/*', 'b'}
+    assert index.match('a/x') == (('a/*', True),)
+    assert index.match('b') == (('b', True),)
+
+
+def run(loop, coro):
+    return loop.run_until_complete(coro)
+
+
+def test_handler_inline():
+    loop = asyncio.new_event_loop()
+    handler = Handler(lambda x: x * 2, loop)
+    assert run(loop, handler(2)) == 4
+    loop.close()
+
+
+def test_handler_task_limit():
+    loop = asyncio.new_event_loop()
+    running, most = 0, 0
+
+    async def callback(value):
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    handler = Handler(callback, loop, dispatch='task', limit=2)
+
+    async def main():
+        for i in range(6):
+            assert await handler(i) is None
+        await asyncio.sleep(0.1)
+
+    run(loop, main())
+    assert most == 2
+    assert running == 0
+    loop.close()
+
+
+def test_handler_ordered():
+    loop = asyncio.new_event_loop()
+    seen = []
+
+    async def callback(value):
+        await asyncio.sleep(0.001 * (5 - value))
+        seen.append(value)
+
+    handler = Handler(callback, loop, dispatch='ordered')
+
+    async def main():
+        for i in range(5):
+            await handler(i)
+        assert seen == []
+        await asyncio.sleep(0.1)
+
+    run(loop, main())
+    assert seen == list(range(5))
+    handler.stop()
+    run(loop, asyncio.sleep(0.01))
+    loop.close()
+
+
+def test_handler_conflate():
+    loop = asyncio.new_event_loop()
+    seen = []
+
+    async def callback(endpoint, value):
+        await asyncio.sleep(0.01)
+        seen.append((endpoint, value))
+
+    handler = Handler(callback, loop, dispatch='conflate')
+
+    async def main():
+        for i in range(5):
+            await handler('a', i)
+            await handler('b', i)
+        # the worker is busy with 'a'
+        await asyncio.sleep(0.005)
+        await handler('a', 5)
+        await asyncio.sleep(0.1)
+
+    run(loop, main())
+    assert seen == [('a', 4), ('b', 4), ('a', 5)]
+    assert handler.dropped == 8
+    handler.stop()
+    run(loop, asyncio.sleep(0.01))
+    loop.close()
+
+
+def test_handler_executor():
+    loop = asyncio.new_event_loop()
+    handler = Handler(lambda: threading.get_ident(), loop, executor=True)
+    assert run(loop, handler()) != threading.get_ident()
+    loop.close()
+
+
+def test_handler_invalid():
+    loop = asyncio.new_event_loop()
+    with pytest.raises(ValueError):
+        Handler(print, loop, dispatch='nope')
+    loop.close()
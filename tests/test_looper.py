@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+from robocluster.looper import Looper
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_finished_tasks_are_forgotten(loop):
+    looper = Looper(loop)
+    done = []
+
+    async def task(value):
+        done.append(value)
+
+    async def main():
+        looper.start()
+        for value in range(300):
+            looper.create_task(task, value)
+        await asyncio.sleep(0.05, loop=loop)
+        running = len(looper._running_tasks)
+        looper.stop()
+        return running
+
+    assert loop.run_until_complete(main()) == 0
+    assert len(done) == 300
+
+
+def test_task_after_stop(loop):
+    looper = Looper(loop)
+
+    async def task():
+        pass
+
+    async def main():
+        looper.start()
+        looper.create_task(task)
+        # stopped before the loop got to create the task
+        looper.stop()
+        await asyncio.sleep(0, loop=loop)
+
+    loop.run_until_complete(main())
+    assert looper._running_tasks is None
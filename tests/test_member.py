@@ -0,0 +1,433 @@
+import asyncio
+import socket
+import threading
+import time
+import zlib
+from uuid import uuid4
+
+import pytest
+
+from robocluster.device import group_to_port
+from robocluster.member import ConnectionLost, Member, UnknownPeer, _Peer
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def create_member(loop, name='member', **options):
+    port = group_to_port(str(uuid4()))
+    return Member(name, '127.0.0.1/32', port, loop=loop, **options)
+
+
+@pytest.mark.parametrize('policy, expected', [
+    ('drop-oldest', [2, 3]),
+    ('drop-newest', [0, 1]),
+])
+def test_queue_drop_policy(loop, policy, expected):
+    member = create_member(loop, queue_size=2, queue_policy=policy)
+    peer = _Peer(member, 'peer', 1)
+    for i in range(4):
+        assert peer.queue((i, None, None)) is None
+    assert peer.dropped == 2
+    assert [peer._outbox.get_nowait()[0] for _ in range(2)] == expected
+
+
+def test_queue_block_policy(loop):
+    member = create_member(loop, queue_size=1, queue_policy='block')
+    peer = _Peer(member, 'peer', 1)
+    assert peer.queue(0) is None
+    put = peer.queue(1)
+    assert put is not None
+    assert peer._outbox.get_nowait() == 0
+    loop.run_until_complete(put)
+    assert peer._outbox.get_nowait() == 1
+    assert peer.dropped == 0
+
+
+def test_publish_to_dead_subscriber(loop):
+    member = create_member(loop, name='pub', queue_size=4)
+    peer = member._peers['dead'] = _Peer(member, 'dead', 1)
+    peer.subscriptions = {'pub/*'}
+
+    async def publish():
+        for i in range(10):
+            await member.publish('topic', i)
+
+    # never connects, publish has to keep going anyway
+    loop.run_until_complete(asyncio.wait_for(publish(), 1, loop=loop))
+    assert peer.dropped == 6
+    assert [peer._outbox.get_nowait()[0][1][1] for _ in range(4)] == [6, 7, 8, 9]
+
+
+def test_local_registry_threads():
+    local = {}
+    port = group_to_port(str(uuid4()))
+    loops = [asyncio.new_event_loop() for _ in range(5)]
+    members = [
+        Member('member-{}'.format(i), '127.0.0.1/32', port, loop=loop,
+               local=local)
+        for i, loop in enumerate(loops)
+    ]
+    reader, others = members[0], members[1:]
+    reader._register_local(True)
+    errors = []
+
+    def churn(member):
+        try:
+            for _ in range(500):
+                member._register_local(True)
+                member._register_local(False)
+        except Exception as e:  # pylint: disable=W0703
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=churn, args=(member,)) for member in others]
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for name, member in reader._local_members().items():
+                assert member.name == name
+    finally:
+        for thread in threads:
+            thread.join()
+        for loop in loops:
+            loop.close()
+    assert not errors
+    assert list(local[reader._gossiper.key]) == ['member-0']
+    assert reader._local_members() == {}
+
+
+def test_queue_policy_invalid(loop):
+    with pytest.raises(ValueError):
+        create_member(loop, queue_policy='nope')
+
+
+def test_publish_encodes_once(loop):
+    member = create_member(loop, name='pub')
+    for name, uid in (('a', 1), ('b', 2), ('c', 3)):
+        peer = member._peers[name] = _Peer(member, name, uid)
+        peer.subscriptions = {'pub/*'} if name != 'c' else {'other/*'}
+
+    loop.run_until_complete(member.publish('topic', 1.5))
+    (packet_a, codec_a, frame_a), = [member._peers['a']._outbox.get_nowait()]
+    (packet_b, codec_b, frame_b), = [member._peers['b']._outbox.get_nowait()]
+    assert member._peers['c']._outbox.empty()
+    assert packet_a == ('send', ('pub/topic', 1.5))
+    assert frame_a is frame_b
+    assert codec_a.decode(frame_a[4:]) == ['send', ['pub/topic', 1.5]]
+
+
+class FakeConnection:
+    reader = None
+
+    def writer(self, **kwargs):
+        return self
+
+    def close(self):
+        pass
+
+
+def test_close_fails_pending(loop):
+    member = create_member(loop)
+    peer = _Peer(member, 'peer', 1)
+    peer._conn = FakeConnection()
+    peer._writer = peer._conn
+    future = peer._pending[0] = loop.create_future()
+    peer.close()
+    assert isinstance(future.exception(), ConnectionLost)
+    assert not peer._pending
+
+
+class FakeWriter:
+    def __init__(self, error=None):
+        self.error = error
+        self.frames = []
+
+    def write_framed(self, frame):
+        if self.error:
+            raise self.error
+        self.frames.append(frame)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_replay_after_failed_write(loop):
+    member = create_member(loop, replay_size=2)
+    peer = _Peer(member, 'peer', 1)
+    peer._conn = FakeConnection()
+    peer._writer = FakeWriter(ConnectionResetError())
+    packets = [(i, peer.codec, str(i).encode()) for i in range(3)]
+    loop.run_until_complete(peer._send_framed(packets))
+    assert peer._conn is None
+    assert [packet for packet, _, _ in peer._replay] == [1, 2]
+    assert peer.dropped == 1
+
+    peer._conn = peer._writer = FakeWriter()
+    loop.run_until_complete(peer._send_framed([packets[0]]))
+    assert peer._writer.frames == [b'1', b'2', b'0']
+    assert not peer._replay
+
+
+class IdleConnection(FakeConnection):
+    def __init__(self, loop):
+        self.loop = loop
+        self.reader = self
+        self.written = FakeWriter()
+
+    async def read(self):
+        await asyncio.sleep(3600, loop=self.loop)
+
+    def writer(self, **kwargs):
+        return self.written
+
+
+def test_replay_on_reconnect(loop):
+    member = create_member(loop)
+    peer = _Peer(member, 'peer', 1)
+    # what the last connection could not send
+    peer._keep([(i, peer.codec, str(i).encode()) for i in range(2)])
+    conn = IdleConnection(loop)
+    peer.start()
+    try:
+        loop.run_until_complete(peer.accept(conn, peer.codec, reply=False))
+        loop.run_until_complete(asyncio.sleep(0.05, loop=loop))
+    finally:
+        peer.stop()
+        loop.run_until_complete(asyncio.sleep(0, loop=loop))
+    assert conn.written.frames == [b'0', b'1']
+    assert not peer._replay
+
+
+def test_reconnect_backoff(loop):
+    member = create_member(loop)
+    events = []
+    member.on_connection(lambda name, state: events.append(state))
+    # a port nobody listens on
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    address = listener.getsockname()
+    listener.close()
+
+    # the higher uid makes us the one to connect
+    peer = _Peer(member, 'peer', 2 ** 32)
+    peer.address = address
+    peer._is_wanted.set()
+    member.start()
+    peer.start()
+    loop.run_until_complete(asyncio.sleep(1))
+    peer.stop()
+    member.stop()
+    loop.run_until_complete(asyncio.sleep(0.01))
+    # a fixed 0.1s retry would have made 10 attempts
+    assert 2 <= peer.failures <= 6
+    assert events[:3] == ['connecting', 'backoff', 'connecting']
+    assert peer.state == 'stopped'
+
+
+def test_gossip_delta(loop):
+    member = create_member(loop, name='member')
+    gossiper = member._gossiper
+    peer = member._peers['peer'] = _Peer(member, 'peer', 1)
+    address = '127.0.0.1', 1234
+
+    gossiper._handle_state('peer', 1, address, 3, ['member'], ['member/a'])
+    assert peer.version == 3
+    assert peer.is_subscribed('member/a')
+    assert peer._is_wanted.is_set()
+
+    gossiper._handle_delta(
+        'peer', 1, address, 3, 4, [], ['member'], ['member/b'], ['member/a'])
+    assert peer.version == 4
+    assert peer.subscriptions == {'member/b'}
+    assert not peer._is_wanted.is_set()
+
+    # heartbeats with the known version need nothing else
+    gossiper._handle_hb('peer', 1, address, 4)
+    assert gossiper._tasks == []
+
+
+def test_gossip_rates(loop):
+    member = create_member(loop, name='member')
+    gossiper = member._gossiper
+    peer = member._peers['peer'] = _Peer(member, 'peer', 1)
+    address = '127.0.0.1', 1234
+
+    gossiper._handle_state(
+        'peer', 1, address, 1, [], ['member/*', 'member/a'], {},
+        {'member/*': 10})
+    assert peer.rates == {'member/*': 10}
+    # the unlimited subscription wins
+    assert all(peer.due('member/a', 0) for _ in range(3))
+    assert peer.due('member/b', 0)
+    assert not peer.due('member/b', 0.05)
+    assert peer.due('member/b', 0.1)
+
+    gossiper._handle_delta(
+        'peer', 1, address, 1, 2, [], [], [], ['member/a'], {'member/*': 5})
+    assert peer.rates == {'member/*': 5}
+    assert peer.due('member/a', 0)
+    assert not peer.due('member/a', 0.1)
+    gossiper._handle_delta(
+        'peer', 1, address, 2, 3, [], [], [], [], {'member/*': None})
+    assert peer.rates == {}
+
+    member.subscribe('peer', 'topic', print, max_rate=5)
+    assert gossiper.state()[-1] == {'peer/topic': 5}
+    version = gossiper.version
+    member.subscribe('peer', 'topic', print, max_rate=5)
+    assert gossiper.version == version
+    member.subscribe('peer', 'topic', print)
+    assert gossiper.version == version + 1
+    assert member._rates == {}
+
+
+def test_gossip_pull_on_missed_version(loop):
+    member = create_member(loop, name='member')
+    gossiper = member._gossiper
+    peer = member._peers['peer'] = _Peer(member, 'peer', 1)
+    peer.version = 1
+    address = '127.0.0.1', 1234
+
+    gossiper._handle_delta('peer', 1, address, 2, 3, [], [], ['member/a'], [])
+    assert peer.version == 1
+    assert not peer.is_subscribed('member/a')
+    (_, (packet,), _), = gossiper._tasks
+    assert packet[0] == 'pull' and packet[-1] == 'peer'
+
+    # pulls are rate limited
+    gossiper._handle_hb('peer', 1, address, 3)
+    assert len(gossiper._tasks) == 1
+
+
+def test_state_version(loop):
+    member = create_member(loop, name='member')
+    version = member._gossiper.version
+    member.subscribe('peer', 'topic', print)
+    assert member._gossiper.version == version + 1
+    member.subscribe('peer', 'topic', print)
+    member.want('peer')
+    assert member._gossiper.version == version + 1
+
+
+def test_gossip_evicts_dead_peers(loop):
+    member = create_member(loop, name='member')
+    gossiper = member._gossiper
+    peer = member._peers['peer'] = _Peer(member, 'peer', 1)
+    address = '127.0.0.1', 1234
+
+    gossiper._handle_hb('peer', 1, address, None, 2.0)
+    assert peer.expires - time.monotonic() > 2.0 * gossiper.MISSED_HEARTBEATS - 1
+    gossiper.reap()
+    assert member._peers['peer'] is peer
+
+    gossiper.interval = gossiper.MAX_GOSSIP_RATE
+    peer.expires = time.monotonic() - 1
+    gossiper.reap()
+    assert 'peer' not in member._peers
+    assert gossiper.interval == gossiper.GOSSIP_RATE
+    loop.run_until_complete(asyncio.sleep(0))
+
+
+def test_try_peer_discovery(loop):
+    member = create_member(loop, name='member')
+    gossiper = member._gossiper
+
+    async def announce():
+        await asyncio.sleep(0.01)
+        gossiper._handle_state('peer', 1, ('127.0.0.1', 1234), 0, [], [])
+
+    async def main():
+        peer, _ = await asyncio.gather(member.try_peer('peer'), announce())
+        return peer
+
+    peer = loop.run_until_complete(main())
+    assert peer is member._peers['peer']
+    assert member._discovering == {}
+    # the probe asking the peer for its state
+    _, (packet,), _ = gossiper._tasks[0]
+    assert packet[0] == 'pull' and packet[-1] == 'peer'
+    peer.stop()
+    loop.run_until_complete(asyncio.sleep(0.01))
+
+
+def test_try_peer_timeout(loop):
+    member = create_member(loop, name='member', probe=False)
+    with pytest.raises(UnknownPeer):
+        loop.run_until_complete(member.try_peer('peer', timeout=0.01))
+    assert member._discovering == {}
+    assert member._gossiper._tasks == []
+
+
+def test_gossip_compressed(loop):
+    member = create_member(loop, name='member')
+    gossiper = member._gossiper
+    packet = ['state', 'peer', 1, 1234, 0, [], ['peer/topic%d' % i for i in range(200)]]
+    encoded = gossiper._encode(packet)
+    assert len(encoded) <= gossiper.MAX_DATAGRAM
+    assert gossiper._decode(encoded[4:]) == packet
+
+
+def test_gossip_inflate_limit(loop):
+    member = create_member(loop, name='member')
+    gossiper = member._gossiper
+    bomb = zlib.compress(bytes(16 * 1024 * 1024))
+    with pytest.raises(ValueError):
+        gossiper._decode(bomb)
+    # states that inflate too much are not compressed, they get fetched
+    packet = ['state', 'peer', 1, 1234, 0, [], ['a' * 100] * 100]
+    assert len(gossiper._encode(packet)) > gossiper.MAX_DATAGRAM
+
+
+def test_gossip_fetch_large_state(loop):
+    port = group_to_port(str(uuid4()))
+    a = Member('a', '0.0.0.0/0', port, loop=loop)
+    b = Member('b', '0.0.0.0/0', port, loop=loop)
+    topics = [str(uuid4()) for _ in range(200)]
+    for topic in topics:
+        a.subscribe('b', topic, print)
+    assert len(a._gossiper._encode(a._gossiper.state())) > a._gossiper.MAX_DATAGRAM
+
+    async def main():
+        for _ in range(100):
+            peer = b._peers.get('a')
+            if peer is not None and peer.version == a._gossiper.version:
+                return peer
+            await asyncio.sleep(0.02)
+
+    a.start()
+    b.start()
+    peer = loop.run_until_complete(main())
+    a.stop()
+    b.stop()
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert peer.subscriptions == {'b/' + topic for topic in topics}
+
+
+def test_multicast_sequence(loop):
+    member = create_member(loop, name='member', multicast=True)
+    multicaster = member._multicaster
+    assert multicaster._track(7, 1)
+    assert multicaster._track(7, 2)
+    assert multicaster._track(7, 5)
+    assert not multicaster._track(7, 4)
+    assert multicaster._track(8, 10)
+    assert member.multicast_stats() == {
+        'sent': 0, 'received': 4, 'lost': 2, 'late': 1}
+
+
+def test_multicast_too_large(loop):
+    member = create_member(loop, name='member', multicast=True)
+    multicaster = member._multicaster
+    assert multicaster.encode('member/topic', b'x' * 1400) is None
+    assert multicaster.encode('member/topic', b'x' * 1000) is not None
+    assert multicaster.encode('member/topic', 1) is not None
+    assert multicaster._sequence == 2
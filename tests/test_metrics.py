@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+from robocluster.metrics import Histogram, Registry
+
+
+def test_histogram_empty():
+    histogram = Histogram()
+    assert histogram.count == 0
+    assert histogram.percentile(50) is None
+    assert histogram.mean is None
+
+
+def test_histogram_percentiles():
+    histogram = Histogram()
+    values = [random.uniform(0.0001, 0.1) for _ in range(10000)]
+    for value in values:
+        histogram.record(value)
+    values.sort()
+    assert histogram.count == len(values)
+    assert histogram.min == values[0]
+    assert histogram.max == values[-1]
+    for percent in (50, 90, 99):
+        exact = values[int(len(values) * percent / 100) - 1]
+        assert abs(histogram.percentile(percent) - exact) <= exact / 2**5 + 1e-6
+    # memory does not grow with the number of values
+    assert len(histogram._buckets) < 32 * 20
+
+
+def test_histogram_summary():
+    histogram = Histogram()
+    histogram.record(0.001)
+    summary = histogram.summary()
+    assert summary['count'] == 1
+    assert summary['p50'] == summary['min'] == summary['max'] == 0.001
+
+
+def test_registry():
+    registry = Registry()
+    counter = registry.counter('a.sent')
+    counter.inc()
+    counter.inc(2)
+    assert registry.counter('a.sent') is counter
+    queue = []
+    registry.gauge('a.queued', queue.__len__)
+    queue.append(1)
+    registry.histogram('b.latency').record(0.5)
+    with pytest.raises(TypeError):
+        registry.gauge('a.sent')
+
+    snapshot = registry.snapshot()
+    assert snapshot['a.sent'] == 3
+    assert snapshot['a.queued'] == 1
+    assert snapshot['b.latency']['count'] == 1
+    assert set(registry.snapshot('a.')) == {'a.sent', 'a.queued'}
+    registry.remove('a.')
+    assert set(registry.snapshot()) == {'b.latency'}
@@ -0,0 +1,156 @@
+import asyncio
+import struct
+
+import pytest
+
+from robocluster.net import FrameReader, FrameWriter
+from robocluster.transport import FrameProtocol
+
+
+class ChunkedSocket:
+    """Fake socket that hands out data in fixed size chunks."""
+
+    def __init__(self, data, chunk):
+        self.data = data
+        self.chunk = chunk
+        self.calls = 0
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    async def recv_into(self, buffer):
+        self.calls += 1
+        count = min(len(buffer), self.chunk, len(self.data))
+        buffer[:count] = self.data[:count]
+        self.data = self.data[count:]
+        return count
+
+
+def frame(payload):
+    return struct.pack('>I', len(payload)) + payload
+
+
+def read_all(reader):
+    async def _read():
+        frames = []
+        while ...:
+            data = await reader.read()
+            if data is None:
+                return frames
+            frames.append(bytes(data))
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_read())
+    finally:
+        loop.close()
+
+
+def test_many_frames_per_recv():
+    payloads = [str(i).encode() * i for i in range(100)]
+    sock = ChunkedSocket(b''.join(frame(p) for p in payloads), 1 << 20)
+    assert read_all(FrameReader(sock)) == payloads
+    assert sock.calls == 2
+
+
+def test_partial_frames():
+    payloads = [bytes(range(256)) * i for i in range(20)]
+    sock = ChunkedSocket(b''.join(frame(p) for p in payloads), 7)
+    assert read_all(FrameReader(sock, size=64)) == payloads
+
+
+def test_large_frame():
+    payload = bytes(range(256)) * 4096
+    sock = ChunkedSocket(frame(b'small') + frame(payload) + frame(b'end'), 1500)
+    reader = FrameReader(sock, size=1024)
+    assert read_all(reader) == [b'small', payload, b'end']
+
+
+def test_frame_too_large():
+    sock = ChunkedSocket(frame(b'small') + b'\xff\xff\xff\xff', 1500)
+    with pytest.raises(ConnectionError):
+        read_all(FrameReader(sock))
+    assert sock.closed
+
+
+class FakeTransport:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_protocol_frame_too_large():
+    loop = asyncio.new_event_loop()
+    protocol = FrameProtocol(loop)
+    protocol.connection_made(FakeTransport())
+    protocol.data_received(frame(b'small') + b'\xff\xff\xff\xff')
+    protocol.data_received(b'more' * 1024)
+    assert protocol.transport.closed
+    assert not protocol._buffer
+    try:
+        assert loop.run_until_complete(protocol.read()) == b'small'
+        with pytest.raises(ConnectionError):
+            loop.run_until_complete(protocol.read())
+    finally:
+        loop.close()
+
+
+class PartialSocket:
+    """Fake socket that accepts at most chunk bytes per write."""
+
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self.data = b''
+        self.calls = 0
+
+    def setsockopt(self, *args):
+        pass
+
+    async def sendmsg(self, buffers):
+        self.calls += 1
+        data = b''.join(bytes(b) for b in buffers)[:self.chunk]
+        self.data += data
+        return len(data)
+
+
+def test_writer_partial_writes():
+    loop = asyncio.new_event_loop()
+    sock = PartialSocket(5)
+    writer = FrameWriter(sock, loop=loop)
+    payloads = [b'hello', b'', b'world' * 10]
+    for payload in payloads:
+        loop.run_until_complete(writer.send(payload))
+    assert sock.data == b''.join(frame(p) for p in payloads)
+    assert writer.pending == 0
+    loop.close()
+
+
+def test_writer_batches():
+    loop = asyncio.new_event_loop()
+    sock = PartialSocket(1 << 20)
+    writer = FrameWriter(sock, loop=loop, delay=0.01, threshold=1 << 20)
+    payloads = [str(i).encode() for i in range(100)]
+
+    async def burst():
+        for payload in payloads:
+            await writer.send(payload)
+        assert sock.calls == 0
+        await asyncio.sleep(0.05)
+
+    loop.run_until_complete(burst())
+    assert sock.calls == 1
+    assert sock.data == b''.join(frame(p) for p in payloads)
+    loop.close()
+
+
+def test_writer_threshold():
+    loop = asyncio.new_event_loop()
+    sock = PartialSocket(1 << 20)
+    writer = FrameWriter(sock, loop=loop, delay=10, threshold=40)
+    for _ in range(4):
+        loop.run_until_complete(writer.send(b'x' * 6))
+    assert sock.calls == 1
+    assert writer.pending == 0
+    writer.close()
+    loop.close()
@@ -0,0 +1,123 @@
+import asyncio
+import os
+
+import pytest
+
+from robocluster import shm
+
+pytestmark = pytest.mark.skipif(
+    not shm.available(), reason='shared memory not available')
+
+
+class FakeConnection:
+    """A connection that never closes on its own."""
+
+    def __init__(self, loop):
+        self.closed = loop.create_future()
+        self.reader = self
+
+    async def read(self):
+        await self.closed
+
+    def close(self):
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def connect(loop, size):
+    offer = shm.offer(size)
+    server = shm.accept(offer.describe(), FakeConnection(loop), loop)
+    client = offer.connect(FakeConnection(loop), loop)
+    return client, server, offer.prefix
+
+
+def close(loop, *conns):
+    for conn in conns:
+        conn.close()
+    loop.run_until_complete(asyncio.sleep(0))
+
+
+def test_ring_wraps(tmpdir):
+    ring = shm.Ring.create(str(tmpdir.join('ring')), 8)
+    out = bytearray(8)
+    assert ring.write(b'abcdef') == 6
+    assert ring.read_into(memoryview(out)[:4]) == 4
+    assert ring.write(b'ghijkl') == 6
+    assert ring.write(b'x') == 0
+    assert ring.read_into(memoryview(out)) == 8
+    assert bytes(out) == b'efghijkl'
+    ring.close()
+
+
+def test_offer_cleans_up(loop):
+    client, server, prefix = connect(loop, 1024)
+    directory, name = os.path.split(prefix)
+    assert not [path for path in os.listdir(directory) if path.startswith(name)]
+    close(loop, client, server)
+
+
+def test_frames_larger_than_ring(loop):
+    client, server, _ = connect(loop, 1024)
+    frames = [os.urandom(size) for size in (10, 5000, 1, 20000)]
+
+    async def send():
+        writer = client.writer()
+        for frame in frames:
+            await writer.send(frame)
+
+    async def receive():
+        return [bytes(await server.reader.read()) for _ in frames]
+
+    async def main():
+        _, received = await asyncio.gather(send(), receive())
+        return received
+
+    assert loop.run_until_complete(main()) == frames
+    close(loop, client, server)
+
+
+def test_idle_without_wakeups(loop):
+    client, server, _ = connect(loop, 1024)
+    wakeups = []
+    wakeup = server.channel._wakeup
+    server.channel._wakeup = lambda: wakeups.append(1) or wakeup()
+
+    async def main():
+        read = loop.create_task(server.reader.read())
+        await asyncio.sleep(0.2)
+        # an idle channel sleeps until the other side rings
+        assert not wakeups and not read.done()
+        writer = client.writer()
+        await writer.send(b'frame')
+        return await asyncio.wait_for(read, 1)
+
+    assert bytes(loop.run_until_complete(main())) == b'frame'
+    assert len(wakeups) == 1
+    close(loop, client, server)
+
+
+def test_close_ends_reads(loop):
+    client, server, _ = connect(loop, 1024)
+
+    async def main():
+        read = loop.create_task(server.reader.read())
+        await asyncio.sleep(0.01)
+        client.close()
+        return await asyncio.wait_for(read, 1)
+
+    assert loop.run_until_complete(main()) is None
+    close(loop, server)
+
+
+def test_accept_other_host(loop):
+    offer = shm.offer(1024)
+    description = dict(offer.describe(), host='elsewhere')
+    assert shm.accept(description, FakeConnection(loop), loop) is None
+    offer.close()
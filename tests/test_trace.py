@@ -0,0 +1,44 @@
+import json
+
+from robocluster.trace import Tracer
+
+
+def test_sample_rate():
+    assert Tracer('member').sample() is None
+    assert all(Tracer('member', 0).sample() is None for _ in range(100))
+    trace_id, origin, sent_at = Tracer('member', 1).sample()
+    assert origin == 'member'
+    assert sent_at > 0
+    # fits a double, for codecs that only have floats
+    assert trace_id < 2**53
+
+
+def test_buffer_size():
+    tracer = Tracer('member', 1, size=10)
+    context = tracer.sample()
+    for i in range(20):
+        tracer.span('span {}'.format(i), context, i, i + 1)
+    assert len(tracer.events) == 10
+    assert tracer.events[0]['name'] == 'span 10'
+
+
+def test_export(tmpdir):
+    sender, receiver = Tracer('sender', 1), Tracer('receiver')
+    context = sender.sample()
+    sender.span('write', context, 1.0, 1.5, peer='receiver')
+    sender.flow_start(context, 'receiver', 1.5)
+    receiver.flow_end(context, 2.0)
+
+    path = str(tmpdir.join('trace.json'))
+    sender.export(path)
+    with open(path) as f:
+        events = json.load(f)['traceEvents']
+    meta, span, flow = events
+    assert meta['ph'] == 'M' and meta['args'] == {'name': 'sender'}
+    assert span['ts'] == 1e6 and span['dur'] == 0.5e6
+    assert span['args']['peer'] == 'receiver'
+    assert span['args']['trace'] == context[0]
+    # the flow ends at the receiver it was sent to
+    end = receiver.events[0]
+    assert (flow['ph'], end['ph']) == ('s', 'f')
+    assert flow['id'] == end['id']
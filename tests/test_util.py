@@ -49,3 +49,15 @@ def test_as_coroutine():
     assert(iscoroutinefunction(as_coroutine(dummy)))
     assert(iscoroutinefunction(as_coroutine(dummy_coro)))
 
+
+def test_as_coroutine_executor():
+    import asyncio
+    import threading
+
+    def ident():
+        return threading.get_ident()
+
+    loop = asyncio.new_event_loop()
+    assert(loop.run_until_complete(as_coroutine(ident)()) == threading.get_ident())
+    assert(loop.run_until_complete(as_coroutine(ident, executor=True)()) != threading.get_ident())
+    loop.close()
@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+import pytest
+
+from robocluster.looper import Looper
+from robocluster.watchdog import Watchdog
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_of(loop):
+    assert Watchdog.of(loop) is None
+    looper = Looper(loop)
+    watchdog = looper.enable_watchdog()
+    assert Watchdog.of(loop) is watchdog
+    # shared by every looper on the loop
+    assert Looper(loop).watchdog is watchdog
+    assert Looper(loop).enable_watchdog(threshold=1) is watchdog
+
+
+def test_stops_with_owners(loop):
+    first, second = Looper(loop), Looper(loop)
+    watchdog = first.enable_watchdog()
+    assert second.enable_watchdog() is watchdog
+
+    async def main():
+        first.start()
+        second.start()
+        await asyncio.sleep(0.2, loop=loop)
+        first.stop()
+        await asyncio.sleep(0.05, loop=loop)
+        # still measured for the other looper
+        assert Watchdog.of(loop) is watchdog
+        measured = watchdog.lag.count
+        await asyncio.sleep(0.2, loop=loop)
+        assert watchdog.lag.count > measured
+        second.stop()
+        await asyncio.sleep(0.05, loop=loop)
+
+    loop.run_until_complete(main())
+    assert Watchdog.of(loop) is None
+    # a stopped watchdog times nothing
+    coro = asyncio.sleep(0, loop=loop)
+    assert watchdog.timed(coro, 'sleep') is coro
+    loop.run_until_complete(coro)
+    assert Looper(loop).enable_watchdog() is not watchdog
+
+
+def test_slow_step(loop):
+    looper = Looper(loop)
+    watchdog = looper.enable_watchdog(threshold=0.1)
+
+    async def blocking():
+        await asyncio.sleep(0.1, loop=loop)
+        time.sleep(0.25)
+
+    async def main():
+        looper.start()
+        looper.create_task(blocking)
+        await asyncio.sleep(0.5, loop=loop)
+        looper.stop()
+
+    loop.run_until_complete(main())
+    step, = watchdog.worst()
+    assert step['name'] == 'test_slow_step.<locals>.blocking'
+    assert step['seconds'] >= 0.25
+    # captured while the step was running
+    assert 'time.sleep(0.25)' in step['stack']
+    assert watchdog.slow_steps == 1
+    assert watchdog.lag.max >= 0.15
+    assert watchdog.report()['worst'] == [step]
+
+
+def test_nested_steps(loop):
+    watchdog = Watchdog(loop, threshold=0.05)
+
+    async def inner():
+        time.sleep(0.1)
+        return 'done'
+
+    async def outer():
+        time.sleep(0.01)
+        return await watchdog.timed(inner(), 'inner')
+
+    result = loop.run_until_complete(watchdog.timed(outer(), 'outer'))
+    assert result == 'done'
+    # the time spent in inner only counts for inner
+    assert [step['name'] for step in watchdog.worst()] == ['inner']
+
+
+def test_cancel(loop):
+    watchdog = Watchdog(loop)
+    cancelled = False
+
+    async def waiting():
+        nonlocal cancelled
+        try:
+            await asyncio.sleep(10, loop=loop)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+
+    task = loop.create_task(watchdog.timed(waiting(), 'waiting'))
+    loop.run_until_complete(asyncio.sleep(0.01, loop=loop))
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        loop.run_until_complete(task)
+    assert cancelled